@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+小说生成系统 - 整本批量生成
+按 xiaoshuo/zhangjiexigang/<小说ID>/<章节>.txt 的细纲顺序生成章节，中断后重新运行即从检查点继续
+用法:
+    python batch_generate.py --novel-id 003 --start 1 --end 50 --template-id 001 --update-state
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from main import NovelGenerator, NovelBatchDriver
+
+TEMPLATES_DIR = "./templates"
+
+def load_template_prompt(template_id):
+    """读取模版的写作角色和写作规则，组合为系统提示"""
+    index_file = os.path.join(TEMPLATES_DIR, "template_index.json")
+    if not os.path.exists(index_file):
+        raise ValueError(f"模版索引不存在: {index_file}")
+    with open(index_file, 'r', encoding='utf-8') as f:
+        templates = json.load(f).get("templates", {})
+    if template_id not in templates:
+        raise ValueError(f"模版不存在: {template_id}")
+
+    parts = []
+    for key in ("writer_role", "writing_rules"):
+        file_path = os.path.join(TEMPLATES_DIR, templates[template_id]["files"][key])
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                parts.append(f.read())
+    return "\n\n".join(parts).strip()
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="按章节细纲批量生成整本小说")
+    parser.add_argument("--novel-id", required=True, help="小说ID")
+    parser.add_argument("--start", type=int, default=1, help="起始章节（含）")
+    parser.add_argument("--end", type=int, required=True, help="结束章节（含）")
+    parser.add_argument("--template-id", help="模版ID（templates/template_index.json）")
+    parser.add_argument("--model", default="deepseek_chat", help="生成模型")
+    parser.add_argument("--update-model", default=None, help="状态更新模型，默认同生成模型")
+    parser.add_argument("--update-state", action="store_true", help="每章生成后更新角色状态")
+    parser.add_argument("--no-state", action="store_true", help="不加载角色状态")
+    parser.add_argument("--no-world-bible", action="store_true", help="不加载世界设定")
+    parser.add_argument("--previous-chapters", type=int, default=1, help="读取前面章节数量，0表示不读取")
+    parser.add_argument("--summary-chapters", type=int, default=0, help="更早章节使用摘要的数量，0表示不使用")
+    parser.add_argument("--retrieval", action="store_true", help="检索相关前文片段")
+    parser.add_argument("--prompt-layout", choices=["default", "stable_prefix"], default=None,
+                        help="提示词布局，stable_prefix把系统提示与世界设定固定在前以复用服务商前缀缓存")
+    args = parser.parse_args()
+
+    generate_kwargs = {
+        "model_name": args.model,
+        "system_prompt": load_template_prompt(args.template_id) if args.template_id else "",
+        "use_state": not args.no_state,
+        "use_world_bible": not args.no_world_bible,
+        "update_state": args.update_state,
+        "update_model_name": args.update_model,
+        "use_previous_chapters": args.previous_chapters > 0,
+        "previous_chapters_count": max(1, args.previous_chapters),
+        "previous_chapters_mode": "hierarchical" if args.summary_chapters > 0 else "verbatim",
+        "summary_chapters_count": args.summary_chapters,
+        "use_retrieval": args.retrieval,
+        "prompt_layout": args.prompt_layout
+    }
+
+    generator = NovelGenerator()
+    driver = NovelBatchDriver(generator, args.novel_id, args.start, args.end, generate_kwargs)
+    pending = driver.pending_chapters()
+    print(f"📚 小说 {args.novel_id}: 第{args.start}-{args.end}章，待生成 {len(pending)} 章")
+    if not pending:
+        return 0
+
+    try:
+        status = driver.run()
+    except KeyboardInterrupt:
+        print("\n⏹️  已中断，重新运行同一命令即可从检查点继续")
+        return 1
+
+    throughput = status["throughput"]
+    print(f"\n状态: {status['status']}，本次完成 {status['run']['chapters']} 章，"
+          f"用时 {throughput['elapsed_seconds']} 秒")
+    print(f"吞吐量: {throughput['chapters_per_hour']} 章/小时，{throughput['tokens_per_minute']} tokens/分钟（估算）")
+    if status["error"]:
+        print(f"❌ 第{status['current_chapter']}章: {status['error']}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+小说生成系统 - 性能基准测试
+使用模拟模型（LLMConfigManager.MOCK_MODELS，不产生API费用）在临时目录中压测章节生成、对话、
+记忆读写和Web接口，结果写成JSON报告，可与其他版本的报告对比
+用法:
+    python benchmark.py --scale small --output before.json
+    python benchmark.py --scale large --concurrency 1,8,32 --output after.json --compare before.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from main import NovelGenerator, ChapterState, LLMConfigManager, PerfMetrics, Tracer
+
+REPORT_VERSION = 1
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 数据规模: chapters与messages为总数，分摊到各小说/会话；operations为每个场景每个并发级别的操作数
+SCALES = {
+    "small": {"novels": 20, "chapters": 200, "sessions": 10, "messages": 10000, "operations": 200},
+    "medium": {"novels": 200, "chapters": 2000, "sessions": 100, "messages": 100000, "operations": 1000},
+    "large": {"novels": 1000, "chapters": 10000, "sessions": 1000, "messages": 1000000, "operations": 5000}
+}
+SCENARIOS = ("memory", "generate", "chat", "http")
+
+CHAPTER_TEXT = "山门外的石阶上落满了枯叶，少年握紧手中的长剑，灵气在经脉中缓缓流转。" * 100
+WORLD_BIBLE = {
+    "world": "青云大陆",
+    "power_system": ["炼气", "筑基", "金丹", "元婴"],
+    "factions": {"青云宗": "正道第一大宗", "血煞门": "魔道宗门"}
+}
+
+def make_state(chapter_index):
+    return ChapterState(
+        chapter_index=chapter_index,
+        protagonist={
+            "name": "林凡", "age": 18, "level": "炼气三层", "status": "健康",
+            "personality": "坚毅", "abilities": ["基础剑法"], "goal": "进入内门"
+        },
+        inventory=[{"item_name": "青钢剑", "description": "宗门配发的长剑"}],
+        relationships=[{"name": "苏晴", "relation": "师姐", "status": "友好"}],
+        current_plot_summary=f"第{chapter_index}章：林凡在外门修炼。"
+    )
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def run_load(operation, operations, concurrency):
+    """用concurrency个线程共执行operations次operation(i)，返回吞吐量与延迟分位数"""
+    latencies = [0.0] * operations
+    counter = itertools.count()
+    errors = []
+    errors_lock = threading.Lock()
+
+    def worker():
+        while True:
+            i = next(counter)
+            if i >= operations:
+                return
+            started = time.perf_counter()
+            try:
+                operation(i)
+            except Exception as e:
+                with errors_lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+            latencies[i] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    result = {
+        "operations": operations,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "ops_per_second": round(operations / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+            "p50": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99": round(percentile(ordered, 0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3) if ordered else 0.0
+        }
+    }
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.generator = None
+        self.novel_ids = [f"bench_{i:04d}" for i in range(args.novels)]
+        self.session_ids = [f"bench_s{i:04d}" for i in range(args.sessions)]
+        self.chapters_per_novel = max(1, args.chapters // max(1, args.novels))
+        # 每部小说下一个要生成的章节号，并发生成时保证不重复
+        self._next_chapter = {novel_id: self.chapters_per_novel + 1 for novel_id in self.novel_ids}
+        self._chapter_lock = threading.Lock()
+        self.results = {}
+        self.seed = {}
+
+    def log(self, message):
+        print(message, flush=True)
+
+    def next_chapter(self, i):
+        novel_id = self.novel_ids[i % len(self.novel_ids)]
+        with self._chapter_lock:
+            chapter_index = self._next_chapter[novel_id]
+            self._next_chapter[novel_id] += 1
+        return novel_id, chapter_index
+
+    def record(self, scenario, concurrency, result):
+        self.results.setdefault(scenario, {})[f"c{concurrency}"] = result
+        latency = result["latency_ms"]
+        errors = f"，失败 {result['errors']}" if result["errors"] else ""
+        self.log(f"   {scenario} c={concurrency}: {result['ops_per_second']} 次/秒，"
+                 f"p50 {latency['p50']}ms，p95 {latency['p95']}ms{errors}")
+
+    # ===== 准备数据 =====
+    def seed_novels(self):
+        self.log(f"📚 写入 {len(self.novel_ids)} 部小说，每部 {self.chapters_per_novel} 章")
+        started = time.perf_counter()
+        state_manager = self.generator.state_manager
+        for novel_id in self.novel_ids:
+            state_manager.save_world_bible(WORLD_BIBLE, novel_id, 1)
+            for chapter_index in range(1, self.chapters_per_novel + 1):
+                file_path = self.generator.chapter_file_path(chapter_index, novel_id, for_write=True)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(CHAPTER_TEXT)
+                state_manager.save_state(make_state(chapter_index), novel_id)
+        self.seed["novels"] = {
+            "novels": len(self.novel_ids),
+            "chapters": len(self.novel_ids) * self.chapters_per_novel,
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+
+    def seed_messages(self):
+        total = self.args.messages
+        self.log(f"💬 写入 {total} 条消息到 {len(self.session_ids)} 个会话")
+        memory_manager = self.generator.memory_manager
+        started = time.perf_counter()
+        for i in range(total):
+            role = "user" if i % 2 == 0 else "assistant"
+            memory_manager.save_message(
+                self.session_ids[i % len(self.session_ids)],
+                {"role": role, "content": f"第{i}条消息：今天的修炼进展如何？"}
+            )
+            if (i + 1) % 100000 == 0:
+                self.log(f"   已写入 {i + 1} 条")
+        memory_manager.flush()
+        elapsed = time.perf_counter() - started
+        self.seed["messages"] = {
+            "messages": total,
+            "sessions": len(self.session_ids),
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(total / elapsed, 2) if elapsed else 0.0
+        }
+
+    def seed_template(self):
+        os.makedirs("templates", exist_ok=True)
+        for filename, text in (("bench_writer_role.txt", "你是一名网络小说作者。"),
+                               ("bench_writing_rules.txt", "每章2000字以上，情节紧凑。")):
+            with open(os.path.join("templates", filename), 'w', encoding='utf-8') as f:
+                f.write(text)
+        index = {"version": "1.0", "templates": {"bench": {
+            "id": "bench", "name": "基准测试模版",
+            "files": {"writer_role": "bench_writer_role.txt", "writing_rules": "bench_writing_rules.txt"}
+        }}}
+        with open(os.path.join("templates", "template_index.json"), 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+
+    # ===== 场景 =====
+    def bench_memory(self, concurrency):
+        memory_manager = self.generator.memory_manager
+        rng = random.Random(concurrency)
+        sessions = [rng.choice(self.session_ids) for _ in range(self.args.operations)]
+
+        def save(i):
+            memory_manager.save_message(sessions[i], {"role": "user", "content": f"基准测试消息{i}"})
+
+        def load(i):
+            memory_manager.load_recent_messages(sessions[i], count=20)
+
+        self.record("memory.save_message", concurrency, run_load(save, self.args.operations, concurrency))
+        memory_manager.flush()
+        self.record("memory.load_recent_messages", concurrency, run_load(load, self.args.operations, concurrency))
+
+    def generate_kwargs(self, novel_id, chapter_index):
+        return dict(
+            chapter_outline=f"第{chapter_index}章 林凡参加外门大比",
+            model_name=self.args.model,
+            system_prompt="你是一名网络小说作者。",
+            novel_id=novel_id,
+            chapter_index=chapter_index,
+            use_state=True,
+            use_world_bible=True,
+            update_state=True,
+            use_previous_chapters=True,
+            previous_chapters_count=2
+        )
+
+    def bench_generate(self, concurrency):
+        def generate(i):
+            self.generator.generate_chapter(**self.generate_kwargs(*self.next_chapter(i)))
+
+        self.record("generate_chapter", concurrency, run_load(generate, self.args.operations, concurrency))
+        self.generator.state_updates.wait_all()
+
+    def bench_chat(self, concurrency):
+        rng = random.Random(concurrency)
+        sessions = [rng.choice(self.session_ids) for _ in range(self.args.operations)]
+
+        def chat(i):
+            self.generator.chat(f"第{i}个问题：接下来该怎么修炼？", model_name=self.args.model,
+                                session_id=sessions[i], recent_count=20)
+
+        self.record("chat", concurrency, run_load(chat, self.args.operations, concurrency))
+
+    def bench_http(self, concurrency):
+        import web_server
+        web_server.generator = self.generator
+        local = threading.local()
+
+        def client():
+            if not hasattr(local, "client"):
+                local.client = web_server.app.test_client()
+            return local.client
+
+        def check(response):
+            if response.status_code >= 400:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+        def generate(i):
+            novel_id, chapter_index = self.next_chapter(i)
+            check(client().post("/api/generate", json={
+                "template_id": "bench",
+                "chapter_outline": f"第{chapter_index}章 林凡参加外门大比",
+                "model_name": self.args.model,
+                "novel_id": novel_id,
+                "use_previous_chapters": True,
+                "previous_chapters_count": 2
+            }))
+
+        endpoints = {
+            "GET /api/health": lambda i: check(client().get("/api/health")),
+            "GET /api/novels": lambda i: check(client().get("/api/novels")),
+            "GET /api/novels/<novel_id>/info": lambda i: check(
+                client().get(f"/api/novels/{self.novel_ids[i % len(self.novel_ids)]}/info")),
+            "GET /api/novels/<novel_id>/latest-state": lambda i: check(
+                client().get(f"/api/novels/{self.novel_ids[i % len(self.novel_ids)]}/latest-state")),
+            "GET /metrics": lambda i: check(client().get("/metrics")),
+            "POST /api/generate": generate
+        }
+        for name, operation in endpoints.items():
+            # 列表类接口随数据量变慢，操作数减半以免拖长整体用时
+            operations = self.args.operations if name != "GET /api/novels" else max(1, self.args.operations // 2)
+            self.record(f"http:{name}", concurrency, run_load(operation, operations, concurrency))
+
+    # ===== 运行 =====
+    def run(self):
+        self.generator = NovelGenerator()
+        self.seed_template()
+        self.seed_novels()
+        if "memory" in self.args.scenarios or "chat" in self.args.scenarios:
+            self.seed_messages()
+
+        runners = {
+            "memory": self.bench_memory,
+            "generate": self.bench_generate,
+            "chat": self.bench_chat,
+            "http": self.bench_http
+        }
+        for scenario in self.args.scenarios:
+            self.log(f"🚀 {scenario}")
+            for concurrency in self.args.concurrency:
+                runners[scenario](concurrency)
+        self.drain()
+
+    def drain(self):
+        """等待后台状态更新与摘要，写入延迟落盘的数据；数据路径都是相对路径，必须在离开数据目录前完成"""
+        self.generator.state_updates.wait_all()
+        self.generator.chapter_summaries.wait_all()
+        self.generator.memory_manager.flush()
+        self.generator.retrieval_index.flush()
+        Tracer.default().flush()
+
+    def metrics_snapshot(self):
+        """运行期间累计的存储I/O耗时与缓存命中，便于定位吞吐变化的来源"""
+        storage_io = {
+            f"{component}.{op}": {"count": counts[-1], "seconds": round(counts[-2], 4)}
+            for (component, op), counts in sorted(PerfMetrics.storage_io.collect().items())
+        }
+        cache = {}
+        for (name, result), count in sorted(PerfMetrics.cache_requests.collect().items()):
+            cache.setdefault(name, {"hit": 0, "miss": 0})[result] = count
+        for stats in cache.values():
+            total = stats["hit"] + stats["miss"]
+            stats["hit_rate"] = round(stats["hit"] / total, 4) if total else 0.0
+        return {"storage_io": storage_io, "cache": cache}
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare_reports(report, baseline, threshold):
+    """对比两次报告中相同场景、相同并发的吞吐量与p95延迟，返回退化的条目数"""
+    print(f"\n📊 与基准报告对比（基准版本 {baseline.get('environment', {}).get('git_commit')}，阈值 {threshold:.0%}）")
+    regressions = 0
+    for scenario, levels in report["results"].items():
+        for level, result in levels.items():
+            base = baseline.get("results", {}).get(scenario, {}).get(level)
+            if not base or not base["ops_per_second"] or not base["latency_ms"]["p95"]:
+                continue
+            throughput = result["ops_per_second"] / base["ops_per_second"] - 1
+            p95 = result["latency_ms"]["p95"] / base["latency_ms"]["p95"] - 1
+            regressed = throughput < -threshold or p95 > threshold
+            regressions += regressed
+            mark = "⚠️ " if regressed else "   "
+            print(f"{mark}{scenario} {level}: 吞吐 {throughput:+.1%}，p95 {p95:+.1%}")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="使用模拟模型压测小说生成系统，输出可对比的JSON报告")
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="数据规模预设")
+    parser.add_argument("--novels", type=int, help="小说数量")
+    parser.add_argument("--chapters", type=int, help="已有章节总数（分摊到各小说）")
+    parser.add_argument("--sessions", type=int, help="对话会话数量")
+    parser.add_argument("--messages", type=int, help="已有消息总数（分摊到各会话）")
+    parser.add_argument("--operations", type=int, help="每个场景每个并发级别的操作数")
+    parser.add_argument("--concurrency", default="1,8", help="并发线程数，逗号分隔，如 1,8,32")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"要运行的场景，逗号分隔: {','.join(SCENARIOS)}")
+    parser.add_argument("--model", choices=list(LLMConfigManager.MOCK_MODELS), default="mock", help="模拟模型")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟模型首字延迟（秒）")
+    parser.add_argument("--chars-per-second", type=float, default=0, help="模拟模型输出速度（字/秒），0表示不限")
+    parser.add_argument("--output-chars", type=int, default=3000, help="模拟模型每次输出字数")
+    parser.add_argument("--workdir", help="数据目录，默认使用临时目录并在结束后删除")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据目录")
+    parser.add_argument("--output", default="benchmark_report.json", help="报告输出路径")
+    parser.add_argument("--compare", help="与之对比的基准报告")
+    parser.add_argument("--threshold", type=float, default=0.1, help="对比时视为退化的变化比例")
+    parser.add_argument("--fail-on-regression", action="store_true", help="对比出现退化时返回非0退出码")
+    args = parser.parse_args()
+
+    for key, value in SCALES[args.scale].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+    return args
+
+def main():
+    """主函数"""
+    args = parse_args()
+    LLMConfigManager.MOCK_MODELS[args.model].update(
+        latency=args.latency,
+        chars_per_second=args.chars_per_second or None,
+        output_chars=args.output_chars
+    )
+    output_path = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="novel_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    original_dir = os.getcwd()
+    # 调用记录与追踪可能在后台线程中晚于切回原目录写入，使用数据目录下的绝对路径
+    os.environ.setdefault("LLM_CALL_LOG_DIR", os.path.join(workdir, "metrics"))
+    os.environ.setdefault("TRACE_DIR", os.path.join(workdir, "traces"))
+    print(f"📁 数据目录: {workdir}")
+    benchmark = Benchmark(args)
+    started = time.time()
+    try:
+        # 所有数据路径都是相对路径，切换到数据目录后运行
+        os.chdir(workdir)
+        benchmark.run()
+        metrics = benchmark.metrics_snapshot()
+    finally:
+        os.chdir(original_dir)
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "report_version": REPORT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration_seconds": round(time.time() - started, 1),
+        "environment": {
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "storage_layout": os.getenv("NOVEL_STORAGE_LAYOUT", "flat"),
+            "tracing": os.getenv("TRACING", "1"),
+            "llm_call_log": os.getenv("LLM_CALL_LOG", "1")
+        },
+        "config": {
+            "scale": args.scale,
+            "novels": args.novels,
+            "chapters": args.chapters,
+            "sessions": args.sessions,
+            "messages": args.messages,
+            "operations": args.operations,
+            "concurrency": args.concurrency,
+            "scenarios": args.scenarios,
+            "model": args.model,
+            "mock_settings": LLMConfigManager.get_mock_settings(args.model)
+        },
+        "seed": benchmark.seed,
+        "results": benchmark.results,
+        "metrics": metrics
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False, sort_keys=True)
+    print(f"\n✅ 报告已保存: {output_path}")
+
+    if baseline is not None:
+        regressions = compare_reports(report, baseline, args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,31 @@
 import os
 import json
 import glob
+import copy
 import re
 import time
-from typing import List, Dict, Any, Optional
+import threading
+import asyncio
+import weakref
+import atexit
+import uuid
+import queue
+import hashlib
+import heapq
+import math
+import bisect
+import random
+import contextvars
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，file_lock只在进程内生效
+    fcntl = None
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures, FIRST_COMPLETED
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator, Callable
 from dotenv import load_dotenv
 from pydantic import BaseModel
 
@@ -35,11 +57,667 @@ class ChapterState(BaseModel):
     relationships: List[Relationship]
     current_plot_summary: str
 
+# === 运行指标 ===
+class _ShardedMetric:
+    """按线程分片的指标：每个线程只写自己的分片（无锁），导出时再合并各分片
+
+    只有线程首次写入时登记分片需要加锁；已退出线程的分片在导出时并入 _retired。
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[tuple] = []  # [(线程, {标签值元组: 值})]
+        self._retired: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def _values(self) -> Dict[tuple, Any]:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _merge(self, target: Dict[tuple, Any], values: Dict[tuple, Any]):
+        for labels, value in values.items():
+            target[labels] = target.get(labels, 0) + value
+
+    def collect(self) -> Dict[tuple, Any]:
+        """合并所有线程分片，返回 {标签值元组: 值}"""
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self._retired, values)
+            self._shards = alive
+            merged: Dict[tuple, Any] = {}
+            self._merge(merged, self._retired)
+            for _, values in alive:
+                # dict.copy() 在GIL下是原子的，写线程无需加锁
+                self._merge(merged, values.copy())
+        return merged
+
+class MetricCounter(_ShardedMetric):
+    """只增计数器"""
+
+    TYPE = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        values = self._values()
+        values[labels] = values.get(labels, 0) + amount
+
+class MetricGauge(MetricCounter):
+    """可增减的计数（如进行中的任务数），增减可发生在不同线程，合并后为当前值"""
+
+    TYPE = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+class MetricHistogram(_ShardedMetric):
+    """固定分桶的直方图，每个标签组合的分片值为 [各桶计数..., +Inf桶计数, 总和, 样本数]"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()):
+        values = self._values()
+        counts = values.get(labels)
+        if counts is None:
+            counts = values[labels] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _merge(self, target: Dict[tuple, Any], values: Dict[tuple, Any]):
+        for labels, counts in values.items():
+            merged = target.get(labels)
+            if merged is None:
+                target[labels] = list(counts)
+            else:
+                for i, value in enumerate(counts):
+                    merged[i] += value
+
+class MetricsRegistry:
+    """指标注册表，按Prometheus文本格式(0.0.4)导出"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: Dict[str, _ShardedMetric] = {}
+        # 导出时调用的取值函数: 名称 -> (说明, 标签名, 函数)，函数返回数值或 {标签值元组: 数值}
+        self._callbacks: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _ShardedMetric) -> _ShardedMetric:
+        with self._lock:
+            if metric.name in self._metrics or metric.name in self._callbacks:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> MetricCounter:
+        return self._register(MetricCounter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> MetricGauge:
+        return self._register(MetricGauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = ()) -> MetricHistogram:
+        return self._register(MetricHistogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name: str, documentation: str, func: Callable[[], Any], labelnames: tuple = ()):
+        """注册导出时取值的仪表，同名重复注册时替换取值函数"""
+        with self._lock:
+            if name in self._metrics:
+                raise ValueError(f"指标已存在: {name}")
+            self._callbacks[name] = (documentation, tuple(labelnames), func)
+
+    @staticmethod
+    def _escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    @classmethod
+    def _labels(cls, names: tuple, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{cls._escape(value)}"' for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @staticmethod
+    def _number(value: float) -> str:
+        if value == math.inf:
+            return "+Inf"
+        if isinstance(value, float) and not value.is_integer():
+            return repr(value)
+        return str(int(value))
+
+    def expose(self) -> str:
+        """导出全部指标的文本"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            callbacks = list(self._callbacks.items())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            values = metric.collect()
+            if not values and not metric.labelnames and not isinstance(metric, MetricHistogram):
+                values = {(): 0}
+            for labels, value in sorted(values.items()):
+                if isinstance(metric, MetricHistogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (math.inf,), value):
+                        cumulative += count
+                        le = 'le="' + self._number(bound) + '"'
+                        lines.append(f"{metric.name}_bucket{self._labels(metric.labelnames, labels, le)} {cumulative}")
+                    label_text = self._labels(metric.labelnames, labels)
+                    lines.append(f"{metric.name}_sum{label_text} {self._number(value[-2])}")
+                    lines.append(f"{metric.name}_count{label_text} {value[-1]}")
+                else:
+                    lines.append(f"{metric.name}{self._labels(metric.labelnames, labels)} {self._number(value)}")
+        for name, (documentation, labelnames, func) in callbacks:
+            try:
+                values = func()
+            except Exception as e:
+                print(f"读取指标 {name} 失败: {e}")
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{self._labels(labelnames, labels)} {self._number(value)}")
+        return "\n".join(lines) + "\n"
+
+class PerfMetrics:
+    """进程内的性能指标，由 web_server.py 的 /metrics 导出
+
+    热路径只做线程分片计数，标签值用常量元组，避免每次请求分配新对象。
+    """
+
+    HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    LLM_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+    IO_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+    registry = MetricsRegistry()
+    http_requests = registry.counter(
+        "novel_http_requests_total", "HTTP请求数", ("route", "method", "status"))
+    http_duration = registry.histogram(
+        "novel_http_request_duration_seconds", "HTTP请求耗时（流式接口为返回响应头的时间）", ("route",), HTTP_BUCKETS)
+    generations_in_flight = registry.gauge(
+        "novel_generations_in_flight", "正在生成的章节数（含批量与调度任务）")
+    llm_requests = registry.counter(
+        "novel_llm_requests_total", "实际发出的LLM请求数（含重试、对冲与备用模型）", ("model", "status"))
+    llm_duration = registry.histogram(
+        "novel_llm_request_duration_seconds", "LLM请求耗时", ("model",), LLM_BUCKETS)
+    llm_ttft = registry.histogram(
+        "novel_llm_ttft_seconds", "LLM流式请求首字延迟", ("model",), LLM_BUCKETS)
+    llm_tokens = registry.counter(
+        "novel_llm_tokens_total", "LLM token数，kind为input/cached/output", ("model", "kind"))
+    storage_io = registry.histogram(
+        "novel_storage_io_seconds", "状态与记忆文件的读写耗时", ("component", "op"), IO_BUCKETS)
+    cache_requests = registry.counter(
+        "novel_cache_requests_total", "进程内缓存查询次数，result为hit/miss", ("cache", "result"))
+
+    @classmethod
+    @contextmanager
+    def generation(cls):
+        """统计进行中的章节生成"""
+        cls.generations_in_flight.inc()
+        try:
+            yield
+        finally:
+            cls.generations_in_flight.dec()
+
+# === 链路追踪 ===
+def prune_dated_files(directory: str, prefix: str, retention_days: int):
+    """删除目录中 {prefix}YYYYMMDD.jsonl 格式、日期早于保留天数的文件，retention_days<=0 时全部保留"""
+    if retention_days <= 0 or not os.path.isdir(directory):
+        return
+    cutoff = time.strftime('%Y%m%d', time.localtime(time.time() - retention_days * 86400))
+    for filename in os.listdir(directory):
+        date = filename[len(prefix):-len(".jsonl")]
+        if filename.startswith(prefix) and filename.endswith(".jsonl") and date.isdigit() and date < cutoff:
+            try:
+                os.remove(os.path.join(directory, filename))
+                print(f"🗑️ 已删除过期记录文件: {filename}")
+            except OSError as e:
+                print(f"删除过期记录文件失败 {filename}: {e}")
+
+class TraceSpan:
+    """一次被追踪的操作，由 Tracer.span() 创建"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_span_id", "sampled", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str], sampled: bool, attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        """W3C traceparent，可传给下游服务延续同一条追踪"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+class Tracer:
+    """轻量链路追踪 - 记录一次生成中各环节（读取前文、加载状态、组装提示词、LLM调用、保存、状态更新）的耗时
+
+    span按OpenTelemetry OTLP/JSON格式导出到本地 traces/traces_YYYYMMDD.jsonl（每行一个
+    ExportTraceServiceRequest，与OTel Collector文件导出器格式相同），不需要网络，
+    可用Collector的otlpjsonfile接收器转发到Jaeger等后端查看。
+    当前span保存在contextvar中，同一线程/协程内嵌套的span自动成为子span。
+    """
+
+    _current: contextvars.ContextVar = contextvars.ContextVar("trace_span", default=None)
+    _default: Optional["Tracer"] = None
+    _default_lock = threading.Lock()
+    TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+    # 缓冲的span达到该数量时即使追踪未结束也写入文件
+    FLUSH_SPANS = 512
+
+    def __init__(self, trace_path: str = "./traces", enabled: bool = True, sample_rate: float = 1.0,
+                 service_name: str = "novel-generator", retention_days: int = 7):
+        """
+        Args:
+            trace_path: 追踪文件存储目录
+            enabled: 是否记录追踪
+            sample_rate: 新追踪的采样比例（0-1），未采样的追踪仍有trace id但不写入文件
+            service_name: 导出时的service.name资源属性
+            retention_days: 追踪文件保留天数，每天首次写入时删除更早的文件，0表示全部保留
+        """
+        self.trace_path = trace_path
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.service_name = service_name
+        self.retention_days = retention_days
+        self._current_file: Optional[str] = None
+        self._buffer: List[TraceSpan] = []
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @classmethod
+    def default(cls) -> "Tracer":
+        """全局追踪器（TRACING=0关闭，TRACE_DIR指定目录，TRACE_SAMPLE_RATE指定采样比例，
+        TRACE_RETENTION_DAYS指定文件保留天数）"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls(
+                    trace_path=os.getenv("TRACE_DIR", "./traces"),
+                    enabled=os.getenv("TRACING", "1") == "1",
+                    sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "1.0")),
+                    retention_days=int(os.getenv("TRACE_RETENTION_DAYS", "7"))
+                )
+            return cls._default
+
+    @classmethod
+    def current_span(cls) -> Optional[TraceSpan]:
+        return cls._current.get()
+
+    @classmethod
+    def current_trace_id(cls) -> Optional[str]:
+        span = cls._current.get()
+        return span.trace_id if span else None
+
+    @classmethod
+    def parse_traceparent(cls, traceparent: Optional[str]) -> Optional[tuple]:
+        """解析W3C traceparent，返回 (trace_id, span_id, sampled)，格式不对返回None"""
+        match = cls.TRACEPARENT_RE.match((traceparent or "").strip().lower())
+        if not match or match.group(1) == "0" * 32:
+            return None
+        return match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1
+
+    @classmethod
+    def trace_id_for(cls, traceparent: Optional[str] = None) -> Optional[str]:
+        """为即将开始的追踪预先确定trace id（沿用traceparent中的trace id，否则新建），追踪关闭时返回None"""
+        if not cls.default().enabled:
+            return None
+        remote = cls.parse_traceparent(traceparent)
+        return remote[0] if remote else os.urandom(16).hex()
+
+    @classmethod
+    @contextmanager
+    def span(cls, name: str, root: bool = True, traceparent: Optional[str] = None,
+             trace_id: Optional[str] = None, **attributes) -> Iterator[Optional[TraceSpan]]:
+        """追踪一段操作
+
+        Args:
+            name: span名称
+            root: 没有上级span时是否开始新的追踪；底层I/O传False，只在已有追踪内记录
+            traceparent: 上游传入的W3C traceparent，没有上级span时延续该追踪
+            trace_id: 没有上级span和traceparent时新追踪使用的trace id
+            attributes: span属性，值为None的属性不导出
+        """
+        tracer = cls.default()
+        parent = cls._current.get()
+        if parent is not None:
+            span = TraceSpan(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+        else:
+            remote = cls.parse_traceparent(traceparent)
+            if not tracer.enabled or (not root and remote is None):
+                yield None
+                return
+            if remote:
+                span = TraceSpan(name, remote[0], remote[1], remote[2], attributes)
+            else:
+                sampled = tracer.sample_rate >= 1 or random.random() < tracer.sample_rate
+                span = TraceSpan(name, trace_id or os.urandom(16).hex(), None, sampled, attributes)
+        token = cls._current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            try:
+                cls._current.reset(token)
+            except ValueError:
+                # 流式生成器在其他上下文中被关闭
+                pass
+            if span.sampled:
+                # 本地最外层span（没有上级或上级已结束，如后台状态更新）结束时写入整条追踪
+                tracer._export(span, parent is None or parent.end_ns is not None)
+
+    @classmethod
+    def record(cls, name: str, duration: float, error: Optional[Exception] = None, **attributes):
+        """在当前追踪内补记一段刚结束的操作（如一次LLM请求），没有进行中的追踪时忽略"""
+        parent = cls._current.get()
+        if parent is None or not parent.sampled:
+            return
+        span = TraceSpan(name, parent.trace_id, parent.span_id, True, attributes)
+        span.end_ns = span.start_ns
+        span.start_ns -= int(duration * 1e9)
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        cls.default()._export(span, parent.end_ns is not None)
+
+    def _export(self, span: TraceSpan, flush: bool):
+        with self._lock:
+            self._buffer.append(span)
+            if not flush and len(self._buffer) < self.FLUSH_SPANS:
+                return
+            spans, self._buffer = self._buffer, []
+        self._write(spans)
+
+    def flush(self):
+        """写入缓冲中的span"""
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+        if spans:
+            self._write(spans)
+
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _otlp_span(self, span: TraceSpan) -> Dict[str, Any]:
+        data = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [
+                {"key": key, "value": self._otlp_value(value)}
+                for key, value in span.attributes.items() if value is not None
+            ],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent_span_id:
+            data["parentSpanId"] = span.parent_span_id
+        return data
+
+    def _write(self, spans: List[TraceSpan]):
+        record = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "novel_generator"}, "spans": [self._otlp_span(span) for span in spans]}]
+        }]}
+        file_path = os.path.join(self.trace_path, f"traces_{time.strftime('%Y%m%d')}.jsonl")
+        if file_path != self._current_file:
+            # 换到新一天的文件时清理过期文件
+            self._current_file = file_path
+            prune_dated_files(self.trace_path, "traces_", self.retention_days)
+        try:
+            os.makedirs(self.trace_path, exist_ok=True)
+            with open(file_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"写入追踪记录失败: {e}")
+
 # === 全局大模型配置获取器 ===
 # 🚨 重要提醒：请勿修改以下模型配置，这些是用户自定义的固定配置 🚨
 class LLMConfigManager:
+    # 客户端连接池设置（独立于上面的固定模型配置维护）
+    # pool_size: 每个客户端的最大连接数/保活连接数
+    # idle_timeout: 客户端空闲多少秒后关闭并释放连接
+    # max_concurrency: 异步调用(acall)时同一服务商的最大并发请求数
+    # rpm / tpm: 每分钟请求数/令牌数预算，None表示不限制
+    DEFAULT_CLIENT_SETTINGS: Dict[str, Any] = {
+        "pool_size": 10,
+        "idle_timeout": 300,
+        "max_concurrency": 16,
+        "rpm": None,
+        "tpm": None
+    }
+    CLIENT_SETTINGS: Dict[str, Dict[str, Any]] = {
+        "deepseek_chat": {"pool_size": 20, "idle_timeout": 600, "max_concurrency": 32},
+        "deepseek_reasoner": {"pool_size": 10, "idle_timeout": 600, "max_concurrency": 32},
+        "dsf5": {"pool_size": 10, "idle_timeout": 300, "max_concurrency": 8, "rpm": 60, "tpm": 200000},
+        "mock": {"max_concurrency": 256},
+        "mock_fast": {"max_concurrency": 256}
+    }
+
+    # 提示词上下文预算（同样独立于固定模型配置维护）
+    # context_tokens: 模型上下文窗口token数
+    # output_reserve: 为模型输出预留的token数，其余为提示词可用预算
+    DEFAULT_CONTEXT_BUDGET: Dict[str, int] = {"context_tokens": 32000, "output_reserve": 8192}
+    CONTEXT_BUDGETS: Dict[str, Dict[str, int]] = {
+        "deepseek_chat": {"context_tokens": 64000, "output_reserve": 8192},
+        "deepseek_reasoner": {"context_tokens": 64000, "output_reserve": 32000},
+        "openai_gpt4": {"context_tokens": 8192, "output_reserve": 2048},
+        "openai_gpt35": {"context_tokens": 16385, "output_reserve": 4096},
+        "anthropic_claude": {"context_tokens": 200000, "output_reserve": 4096},
+        "google_gemini": {"context_tokens": 32760, "output_reserve": 8192}
+    }
+
+    # 调用策略（同样独立于固定模型配置维护）
+    # timeout: 单次请求的读取超时秒数，流式调用为相邻两段输出之间的最长等待
+    # max_retries: 超时、连接错误、429/5xx的最大重试次数
+    # backoff_base / backoff_max: 指数退避的初始/最大等待秒数（带随机抖动），服务端返回Retry-After时按其等待
+    # fallback_retries: 还有备用模型时，当前模型重试多少次后切换
+    # hedge_percentile: 对冲请求在该模型近期延迟的此分位数后发出；样本不足时使用hedge_delay秒
+    DEFAULT_CALL_POLICY: Dict[str, Any] = {
+        "timeout": 180,
+        "max_retries": 3,
+        "fallback_retries": 1,
+        "backoff_base": 1.0,
+        "backoff_max": 30.0,
+        "hedge_percentile": 0.95,
+        "hedge_delay": 20.0
+    }
+    CALL_POLICIES: Dict[str, Dict[str, Any]] = {
+        "deepseek_reasoner": {"timeout": 600},
+        "dsf5": {"timeout": 300}
+    }
+
+    # 模型价格（美元/百万token，同样独立于固定模型配置维护，实际价格以服务商官网为准）
+    # input: 未命中缓存的输入；cached_input: 命中服务商提示词缓存的输入；cache_write: 写入缓存的输入（未配置按input计）
+    MODEL_PRICING: Dict[str, Dict[str, float]] = {
+        "deepseek_chat": {"input": 0.27, "cached_input": 0.07, "output": 1.10},
+        "deepseek_reasoner": {"input": 0.55, "cached_input": 0.14, "output": 2.19},
+        "openai_gpt4": {"input": 30.0, "cached_input": 30.0, "output": 60.0},
+        "openai_gpt35": {"input": 0.5, "cached_input": 0.5, "output": 1.5},
+        "anthropic_claude": {"input": 3.0, "cached_input": 0.3, "cache_write": 3.75, "output": 15.0},
+        "google_gemini": {"input": 0.5, "cached_input": 0.5, "output": 1.5},
+        "mock": {"input": 0.0, "output": 0.0},
+        "mock_fast": {"input": 0.0, "output": 0.0}
+    }
+
+    @staticmethod
+    def get_cost(model_name: str, usage: Dict[str, int]) -> Optional[float]:
+        """按MODEL_PRICING估算一次调用的费用（美元），未配置价格的模型返回None"""
+        pricing = LLMConfigManager.MODEL_PRICING.get(model_name)
+        if not pricing:
+            return None
+        cache_write = usage.get("cache_write_tokens", 0)
+        uncached = max(0, usage.get("uncached_tokens", 0) - cache_write)
+        cost = (
+            uncached * pricing["input"]
+            + usage.get("cached_tokens", 0) * pricing.get("cached_input", pricing["input"])
+            + cache_write * pricing.get("cache_write", pricing["input"])
+            + usage.get("output_tokens", 0) * pricing["output"]
+        )
+        return cost / 1_000_000
+
+    # 备用模型链（同样独立于固定模型配置维护）：主模型不可用时依次尝试，未配置API Key的模型自动跳过；
+    # 按MODEL_PRICING单价（输入+输出）超过主模型FALLBACK_MAX_PRICE_RATIO倍的备用模型默认不使用，
+    # 任一方未配置价格时不限制；LLM_FALLBACK_MAX_PRICE_RATIO=0 取消限制
+    FALLBACK_MAX_PRICE_RATIO = 2.0
+    FALLBACK_CHAINS: Dict[str, List[str]] = {
+        "deepseek_chat": ["dsf5", "openai_gpt4"],
+        "deepseek_reasoner": ["deepseek_chat", "dsf5"],
+        "dsf5": ["deepseek_chat"]
+    }
+
+    @staticmethod
+    def _unit_price(model_name: str) -> Optional[float]:
+        pricing = LLMConfigManager.MODEL_PRICING.get(model_name)
+        return pricing["input"] + pricing["output"] if pricing else None
+
+    @staticmethod
+    def get_fallback_chain(model_name: str) -> List[str]:
+        """获取模型的调用链：主模型在前，其后为已配置API Key且单价不超过上限的备用模型；
+        LLM_FALLBACK=0时只返回主模型"""
+        chain = [model_name]
+        if os.getenv("LLM_FALLBACK", "1") == "0":
+            return chain
+        max_ratio = float(os.getenv("LLM_FALLBACK_MAX_PRICE_RATIO", LLMConfigManager.FALLBACK_MAX_PRICE_RATIO))
+        primary_price = LLMConfigManager._unit_price(model_name)
+        for fallback in LLMConfigManager.FALLBACK_CHAINS.get(model_name, []):
+            fallback_price = LLMConfigManager._unit_price(fallback)
+            if max_ratio > 0 and primary_price and fallback_price and fallback_price > primary_price * max_ratio:
+                continue
+            config = LLMConfigManager.get_config(fallback)
+            if fallback not in chain and config.get("model") and config.get("api_key"):
+                chain.append(fallback)
+        return chain
+
+    @staticmethod
+    def get_call_policy(model_name: str) -> Dict[str, Any]:
+        """获取模型的超时、重试与对冲策略"""
+        policy = dict(LLMConfigManager.DEFAULT_CALL_POLICY)
+        policy.update(LLMConfigManager.CALL_POLICIES.get(model_name, {}))
+        return policy
+
+    # 服务商分组与限额（多小说调度器使用，同样独立于固定模型配置维护）
+    # 同一分组的模型共用API Key，共享限额
+    # max_in_flight: 同时进行的章节生成数，为None时取分组内模型的max_concurrency
+    # rpm / tpm: 分组共享的每分钟请求数/令牌数预算，为None时取分组内模型的设置
+    PROVIDER_GROUPS: Dict[str, str] = {
+        "deepseek_chat": "deepseek",
+        "deepseek_reasoner": "deepseek",
+        "dsf5": "dsf5",
+        "openai_gpt4": "openai",
+        "openai_gpt35": "openai",
+        "anthropic_claude": "anthropic",
+        "google_gemini": "google",
+        "mock": "mock",
+        "mock_fast": "mock"
+    }
+    PROVIDER_LIMITS: Dict[str, Dict[str, Any]] = {
+        "deepseek": {"max_in_flight": 32}
+    }
+
+    @staticmethod
+    def get_provider(model_name: str) -> str:
+        """获取模型所属的服务商分组"""
+        return LLMConfigManager.PROVIDER_GROUPS.get(model_name, model_name)
+
+    @staticmethod
+    def get_provider_limits(provider: str) -> Dict[str, Any]:
+        """获取服务商分组的限额，未配置的项取分组内第一个模型的客户端设置"""
+        models = [m for m, p in LLMConfigManager.PROVIDER_GROUPS.items() if p == provider] or [provider]
+        settings = LLMConfigManager.get_client_settings(models[0])
+        limits = {"max_in_flight": settings["max_concurrency"], "rpm": settings["rpm"], "tpm": settings["tpm"]}
+        for key, value in LLMConfigManager.PROVIDER_LIMITS.get(provider, {}).items():
+            if value is not None:
+                limits[key] = value
+        return limits
+
+    # 模拟模型（同样独立于固定模型配置维护）：不发出网络请求，按提示词确定性地生成文本，用于压测与性能回归
+    # latency: 首字延迟秒数；chars_per_second: 输出速度（字/秒），为None时一次返回
+    # output_chars: 输出字数；stream_chunk_chars: 流式每段字数
+    # input_tokens / output_tokens: 返回的token用量，为None时按文本估算
+    # 各项可用环境变量 MOCK_LLM_<项名大写> 覆盖，如 MOCK_LLM_LATENCY=0.2
+    MOCK_MODELS: Dict[str, Dict[str, Any]] = {
+        "mock": {
+            "latency": 1.0, "chars_per_second": 500, "output_chars": 3000, "stream_chunk_chars": 20,
+            "input_tokens": None, "output_tokens": None
+        },
+        "mock_fast": {
+            "latency": 0.0, "chars_per_second": None, "output_chars": 3000, "stream_chunk_chars": 200,
+            "input_tokens": None, "output_tokens": None
+        }
+    }
+
+    @staticmethod
+    def get_mock_settings(model_name: str) -> Dict[str, Any]:
+        """获取模拟模型的设置（含环境变量覆盖）"""
+        settings = dict(LLMConfigManager.MOCK_MODELS[model_name])
+        for key in settings:
+            value = os.getenv(f"MOCK_LLM_{key.upper()}")
+            if value is not None:
+                settings[key] = None if value.lower() in ("", "none") else float(value)
+        return settings
+
+    @staticmethod
+    def get_prompt_budget(model_name: str) -> int:
+        """获取模型可用于提示词的token预算"""
+        budget = dict(LLMConfigManager.DEFAULT_CONTEXT_BUDGET)
+        budget.update(LLMConfigManager.CONTEXT_BUDGETS.get(model_name, {}))
+        return budget["context_tokens"] - budget["output_reserve"]
+
+    @staticmethod
+    def get_client_settings(model_name: str) -> Dict[str, Any]:
+        """获取模型对应的客户端连接池设置"""
+        settings = dict(LLMConfigManager.DEFAULT_CLIENT_SETTINGS)
+        settings.update(LLMConfigManager.CLIENT_SETTINGS.get(model_name, {}))
+        return settings
+
     @staticmethod
     def get_config(model_name: str) -> Dict[str, Any]:
+        # 模拟模型不属于下面的固定配置
+        if model_name in LLMConfigManager.MOCK_MODELS:
+            config = {"provider": "mock", "model": model_name, "api_key": "mock", "base_url": None, "temperature": 0.7}
+            config.update(LLMConfigManager.get_client_settings(model_name))
+            return config
         configs = {
             "deepseek_chat": {
                 "provider": "openai",
@@ -92,214 +770,2096 @@ class LLMConfigManager:
             }
         }
         # 默认返回deepseek_chat模型
-        return configs.get(model_name, configs["deepseek_chat"])
+        if model_name not in configs:
+            model_name = "deepseek_chat"
+        config = configs[model_name]
+        config.update(LLMConfigManager.get_client_settings(model_name))
+        return config
+
+# === 模拟模型 ===
+class MockChatModel:
+    """模拟模型客户端 - 与langchain聊天模型的invoke/stream/ainvoke接口一致，不发出网络请求
+
+    同一提示词总是得到相同的输出；耗时与token用量按 LLMConfigManager.MOCK_MODELS 模拟，
+    设置在每次调用时读取，压测中途修改立即生效。
+    最后一条消息要求输出JSON且其中含有JSON对象时返回该对象（chapter_index加1，模拟状态随章节推进），
+    使状态更新完整执行解析与保存。
+    """
+
+    PHRASES = (
+        "夜色渐深，", "山门外的石阶上落满了枯叶，", "他握紧手中的长剑，", "灵气在经脉中缓缓流转，",
+        "远处传来一声悠长的钟鸣。", "少年抬起头，目光坚定。", "她轻声说道：“小心。”", "风卷起衣角，",
+        "众人屏住了呼吸。", "一道金光自天际落下，", "丹田中的真元再次凝聚，", "这一战，他不能退。"
+    )
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
 
-# === 全局大模型调用器 ===
-class LLMCaller:
     @staticmethod
-    def call(
-        messages: List[Dict[str, str]],
-        model_name: str = "deepseek_chat",
-        memory: Optional[Any] = None,
-        temperature: Optional[float] = None
-    ) -> str:
-        config = LLMConfigManager.get_config(model_name)
-        
-        if temperature is not None:
-            config["temperature"] = temperature
-            
-        # 根据provider创建对应的LLM实例
+    def _text_of(message: Any) -> str:
+        content = message.content
+        return content if isinstance(content, str) else "".join(block.get("text", "") for block in content)
+
+    @staticmethod
+    def _json_in(text: str) -> Any:
+        decoder = json.JSONDecoder()
+        start = text.find("{")
+        while start != -1:
+            try:
+                return decoder.raw_decode(text, start)[0]
+            except ValueError:
+                start = text.find("{", start + 1)
+        return None
+
+    def _respond(self, messages: List[Any]) -> tuple:
+        """返回 (输出文本, 设置, usage_metadata)"""
+        settings = LLMConfigManager.get_mock_settings(self.model_name)
+        prompt = "\n".join(self._text_of(m) for m in messages)
+        last_text = self._text_of(messages[-1]) if messages else ""
+        data = self._json_in(last_text) if "JSON" in last_text else None
+        if isinstance(data, dict) and isinstance(data.get("chapter_index"), int):
+            data["chapter_index"] += 1
+        text = json.dumps(data, ensure_ascii=False) if data is not None else None
+        if text is None:
+            rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+            target = int(settings["output_chars"])
+            parts, length = [], 0
+            while length < target:
+                phrase = rng.choice(self.PHRASES)
+                parts.append(phrase)
+                length += len(phrase)
+            text = "".join(parts)[:target]
+        input_tokens = estimate_tokens(prompt) if settings["input_tokens"] is None else int(settings["input_tokens"])
+        output_tokens = estimate_tokens(text) if settings["output_tokens"] is None else int(settings["output_tokens"])
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        return text, settings, usage
+
+    @staticmethod
+    def _duration(settings: Dict[str, Any], chars: int) -> float:
+        return chars / settings["chars_per_second"] if settings["chars_per_second"] else 0.0
+
+    def invoke(self, messages: List[Any], **kwargs) -> Any:
+        from langchain_core.messages import AIMessage
+        text, settings, usage = self._respond(messages)
+        time.sleep(settings["latency"] + self._duration(settings, len(text)))
+        return AIMessage(content=text, usage_metadata=usage)
+
+    async def ainvoke(self, messages: List[Any], **kwargs) -> Any:
+        from langchain_core.messages import AIMessage
+        text, settings, usage = self._respond(messages)
+        await asyncio.sleep(settings["latency"] + self._duration(settings, len(text)))
+        return AIMessage(content=text, usage_metadata=usage)
+
+    def stream(self, messages: List[Any], **kwargs) -> Iterator[Any]:
+        from langchain_core.messages import AIMessageChunk
+        text, settings, usage = self._respond(messages)
+        time.sleep(settings["latency"])
+        chunk_chars = max(1, int(settings["stream_chunk_chars"]))
+        for start in range(0, len(text), chunk_chars):
+            chunk = text[start:start + chunk_chars]
+            time.sleep(self._duration(settings, len(chunk)))
+            yield AIMessageChunk(content=chunk)
+        yield AIMessageChunk(content="", usage_metadata=usage)
+
+# === LLM客户端注册表 ===
+class LLMClientRegistry:
+    """LLM客户端注册表 - 按(provider, model, base_url, temperature, api_key)复用已建立连接的客户端
+
+    异步客户端的连接绑定在事件循环上，因此异步调用按事件循环单独建立客户端和并发信号量。
+    """
+
+    _clients: Dict[tuple, Dict[str, Any]] = {}
+    _semaphores: Dict[tuple, Dict[str, Any]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(config: Dict[str, Any], loop: Optional[asyncio.AbstractEventLoop] = None) -> tuple:
+        key = (
+            config["provider"],
+            config["model"],
+            config.get("base_url"),
+            config["temperature"],
+            config.get("api_key")
+        )
+        if loop is not None:
+            key += (id(loop),)
+        return key
+
+    @classmethod
+    def acquire(cls, config: Dict[str, Any], loop: Optional[asyncio.AbstractEventLoop] = None) -> Any:
+        """获取(或创建)客户端，调用结束后必须调用release
+
+        Args:
+            config: 模型配置
+            loop: 异步调用所在的事件循环，为None时返回同步客户端
+        """
+        key = cls._make_key(config, loop)
+        with cls._lock:
+            cls._evict_idle_locked(time.time())
+            entry = cls._clients.get(key)
+            if entry is not None and loop is not None and entry["loop"]() is not loop:
+                # id复用导致的过期条目
+                cls._close_entry(cls._clients.pop(key))
+                entry = None
+            if entry is None:
+                entry = cls._build_entry(config, loop)
+                cls._clients[key] = entry
+            entry["in_flight"] += 1
+            entry["last_used"] = time.time()
+            entry["uses"] += 1
+            return entry["llm"]
+
+    @classmethod
+    def release(cls, config: Dict[str, Any], loop: Optional[asyncio.AbstractEventLoop] = None):
+        """归还客户端"""
+        key = cls._make_key(config, loop)
+        with cls._lock:
+            entry = cls._clients.get(key)
+            if entry is not None:
+                entry["in_flight"] = max(0, entry["in_flight"] - 1)
+                entry["last_used"] = time.time()
+
+    @classmethod
+    def get_semaphore(cls, config: Dict[str, Any], loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        """获取事件循环内按服务商(provider, base_url)共享的并发信号量"""
+        key = (id(loop), config["provider"], config.get("base_url"))
+        with cls._lock:
+            item = cls._semaphores.get(key)
+            if item is None or item["loop"]() is not loop:
+                max_concurrency = config.get(
+                    "max_concurrency", LLMConfigManager.DEFAULT_CLIENT_SETTINGS["max_concurrency"]
+                )
+                item = {
+                    "semaphore": asyncio.Semaphore(max_concurrency),
+                    "loop": weakref.ref(loop)
+                }
+                cls._semaphores[key] = item
+            return item["semaphore"]
+
+    @classmethod
+    def _build_entry(cls, config: Dict[str, Any], loop: Optional[asyncio.AbstractEventLoop] = None) -> Dict[str, Any]:
+        """根据provider创建对应的LLM实例（openai系使用带连接池的httpx客户端）"""
+        pool_size = config.get("pool_size", LLMConfigManager.DEFAULT_CLIENT_SETTINGS["pool_size"])
+        idle_timeout = config.get("idle_timeout", LLMConfigManager.DEFAULT_CLIENT_SETTINGS["idle_timeout"])
+        timeout = config.get("timeout", LLMConfigManager.DEFAULT_CALL_POLICY["timeout"])
+        http_client = None
+
         if config["provider"] == "openai":
+            import httpx
             from langchain_openai import ChatOpenAI
+            limits = httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=idle_timeout
+            )
+            # 重试由LLMCaller统一处理，关闭SDK自带的重试
             llm_params = {
                 "model": config["model"],
                 "api_key": config["api_key"],
-                "temperature": config["temperature"]
+                "temperature": config["temperature"],
+                "timeout": timeout,
+                "max_retries": 0,
+                "stream_usage": True
             }
+            http_timeout = httpx.Timeout(timeout, connect=min(timeout, 10))
+            if loop is not None:
+                http_client = httpx.AsyncClient(limits=limits, timeout=http_timeout)
+                llm_params["http_async_client"] = http_client
+            else:
+                http_client = httpx.Client(limits=limits, timeout=http_timeout)
+                llm_params["http_client"] = http_client
             if config["base_url"]:
                 llm_params["base_url"] = config["base_url"]
             llm = ChatOpenAI(**llm_params)
         elif config["provider"] == "anthropic":
+            import anthropic
+            from anthropic import _base_client
             from langchain_anthropic import ChatAnthropic
             llm = ChatAnthropic(
                 model=config["model"],
                 api_key=config["api_key"],
-                temperature=config["temperature"]
+                temperature=config["temperature"],
+                timeout=timeout,
+                max_retries=0
+            )
+            # ChatAnthropic不接受自定义HTTP客户端，预先放入它缓存的SDK客户端使连接池设置生效；
+            # 新版SDK改用httpx2，Limits需取自SDK实际使用的httpx模块
+            sdk_httpx = getattr(_base_client, "httpx2", None) or _base_client.httpx
+            limits = sdk_httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=idle_timeout
             )
+            client_params = {"api_key": config["api_key"], "max_retries": 0, "timeout": timeout}
+            if config.get("base_url"):
+                client_params["base_url"] = config["base_url"]
+            if loop is not None:
+                http_client = anthropic.DefaultAsyncHttpxClient(limits=limits, timeout=timeout)
+                llm.__dict__["_async_client"] = anthropic.AsyncAnthropic(http_client=http_client, **client_params)
+            else:
+                http_client = anthropic.DefaultHttpxClient(limits=limits, timeout=timeout)
+                llm.__dict__["_client"] = anthropic.Anthropic(http_client=http_client, **client_params)
         elif config["provider"] == "google":
+            import httpx
             from langchain_google_genai import ChatGoogleGenerativeAI
-            llm = ChatGoogleGenerativeAI(
-                model=config["model"],
-                google_api_key=config["api_key"],
-                temperature=config["temperature"]
-            )
+            # Google SDK把max_retries=0当作使用其默认重试次数，1才表示只请求一次
+            google_params = {
+                "model": config["model"],
+                "google_api_key": config["api_key"],
+                "temperature": config["temperature"],
+                "timeout": timeout,
+                "max_retries": 1
+            }
+            if "client_args" in ChatGoogleGenerativeAI.model_fields:
+                # 同时作用于SDK的同步与异步httpx客户端
+                google_params["client_args"] = {"limits": httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=idle_timeout
+                )}
+            llm = ChatGoogleGenerativeAI(**google_params)
+        elif config["provider"] == "mock":
+            llm = MockChatModel(config["model"])
         else:
             raise ValueError(f"Unsupported provider: {config['provider']}")
-        
-        # 如果有记忆，使用对话链
-        if memory:
-            from langchain.chains import ConversationChain
-            chain = ConversationChain(llm=llm, memory=memory, verbose=False)
-            # 将messages转换为单个输入
-            user_input = messages[-1]["content"] if messages else ""
-            return chain.predict(input=user_input)
-        else:
-            # 直接调用LLM
-            from langchain_core.messages import HumanMessage, SystemMessage
-            lang_messages = []
-            for msg in messages:
-                if msg["role"] == "system":
-                    lang_messages.append(SystemMessage(content=msg["content"]))
-                else:
-                    lang_messages.append(HumanMessage(content=msg["content"]))
-            
-            response = llm.invoke(lang_messages)
-            return response.content
 
-# === 状态管理器 ===
-class StateManager:
-    def __init__(self, data_path: str = "./data"):
-        self.data_path = data_path
-        os.makedirs(self.data_path, exist_ok=True)
+        return {
+            "llm": llm,
+            "http_client": http_client,
+            "loop": weakref.ref(loop) if loop is not None else None,
+            "idle_timeout": idle_timeout,
+            "created_at": time.time(),
+            "last_used": time.time(),
+            "in_flight": 0,
+            "uses": 0
+        }
 
-    def _find_latest_file(self, pattern: str, novel_id: Optional[str] = None) -> Optional[str]:
-        """查找最新文件，支持小说ID过滤"""
-        if novel_id:
-            # 如果指定了小说ID，添加ID前缀到模式中
-            pattern = f"{novel_id}_{pattern}"
-        
-        files = glob.glob(os.path.join(self.data_path, pattern))
-        if not files:
-            return None
-        
-        def get_numeric_part(filename):
-            # 提取文件名中的章节编号（忽略小说ID部分）
-            basename = os.path.basename(filename)
-            if novel_id:
-                # 移除小说ID前缀后再提取数字
-                basename = basename.replace(f"{novel_id}_", "", 1)
-            numbers = re.findall(r'\d+', basename)
-            return int(numbers[0]) if numbers else 0
-        
-        return max(files, key=get_numeric_part)
+    @classmethod
+    def _evict_idle_locked(cls, now: float):
+        """关闭超过空闲时间且没有进行中请求的客户端，清理已关闭事件循环的条目（调用方需持有锁）"""
+        expired = [
+            key for key, entry in cls._clients.items()
+            if (entry["in_flight"] == 0 and now - entry["last_used"] > entry["idle_timeout"])
+            or cls._loop_closed(entry["loop"])
+        ]
+        for key in expired:
+            cls._close_entry(cls._clients.pop(key))
 
-    def load_latest_state(self, novel_id: Optional[str] = None) -> Optional[ChapterState]:
-        """加载最新状态，支持小说ID过滤"""
-        latest_file = self._find_latest_file("chapter_*_state.json", novel_id)
-        if not latest_file:
-            return None
+        for key in [k for k, item in cls._semaphores.items() if cls._loop_closed(item["loop"])]:
+            del cls._semaphores[key]
 
-        with open(latest_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return ChapterState(**data)
+    @staticmethod
+    def _loop_closed(loop_ref: Optional[Any]) -> bool:
+        if loop_ref is None:
+            return False
+        loop = loop_ref()
+        return loop is None or loop.is_closed()
 
-    def save_state(self, state: ChapterState, novel_id: Optional[str] = None):
-        """保存状态，支持小说ID"""
-        if novel_id:
-            file_path = os.path.join(
-                self.data_path, 
-                f"{novel_id}_chapter_{state.chapter_index:03d}_state.json"
-            )
-        else:
-            # 兼容旧格式
-            file_path = os.path.join(
-                self.data_path, 
-                f"chapter_{state.chapter_index:03d}_state.json"
-            )
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(state.model_dump_json(indent=2))
+    @classmethod
+    async def aclose_loop(cls, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """关闭绑定在事件循环（默认当前循环）上的异步客户端，需在循环结束前调用
 
-    def load_world_bible(self, novel_id: Optional[str] = None) -> Dict[str, Any]:
-        """加载世界设定，支持小说ID过滤"""
-        latest_file = self._find_latest_file("world_bible_*.json", novel_id)
-        if not latest_file:
-            return {}
+        事件循环关闭后其中的异步客户端已无法关闭，只能丢弃；run_coroutine_sync结束前会自动调用，
+        自行用asyncio.run调用acall时应在协程末尾 await LLMClientRegistry.aclose_loop()。
+        """
+        loop = loop or asyncio.get_running_loop()
+        with cls._lock:
+            keys = [key for key, entry in cls._clients.items() if entry["loop"] is not None and entry["loop"]() is loop]
+            entries = [cls._clients.pop(key) for key in keys]
+            for key in [k for k, item in cls._semaphores.items() if item["loop"]() is loop]:
+                del cls._semaphores[key]
+        for entry in entries:
+            if entry.get("http_client") is None:
+                continue
+            try:
+                await entry["http_client"].aclose()
+            except Exception as e:
+                print(f"关闭LLM客户端失败: {e}")
 
-        with open(latest_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    @staticmethod
+    def _close_entry(entry: Dict[str, Any]):
+        http_client = entry.get("http_client")
+        if http_client is None:
+            return
+        try:
+            if entry["loop"] is None:
+                http_client.close()
+            else:
+                # 异步客户端只能在其所属的事件循环中关闭
+                loop = entry["loop"]()
+                if loop is not None and loop.is_running():
+                    asyncio.run_coroutine_threadsafe(http_client.aclose(), loop)
+        except Exception as e:
+            print(f"关闭LLM客户端失败: {e}")
 
-    def save_world_bible(self, world_bible: Dict[str, Any], novel_id: Optional[str] = None, version: int = 0):
-        """保存世界设定，支持小说ID"""
-        if novel_id:
-            file_path = os.path.join(
-                self.data_path,
-                f"{novel_id}_world_bible_{version:02d}.json"
-            )
-        else:
-            # 兼容旧格式
-            file_path = os.path.join(
-                self.data_path,
-                f"world_bible_{version:02d}.json"
-            )
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(world_bible, f, indent=2, ensure_ascii=False)
-    
-    def list_novel_states(self, novel_id: str) -> List[str]:
-        """列出指定小说的所有状态文件"""
-        pattern = f"{novel_id}_chapter_*_state.json"
-        files = glob.glob(os.path.join(self.data_path, pattern))
-        return sorted(files)
-    
-    def list_novels(self) -> List[str]:
-        """列出所有小说ID"""
-        pattern = "*_chapter_*_state.json"
-        files = glob.glob(os.path.join(self.data_path, pattern))
-        novel_ids = set()
-        
-        for file_path in files:
-            filename = os.path.basename(file_path)
-            # 提取小说ID（第一个下划线之前的部分）
-            parts = filename.split('_')
-            if len(parts) >= 3 and parts[1] == 'chapter':
-                novel_ids.add(parts[0])
-        
-        return sorted(list(novel_ids))
+    @classmethod
+    def close_all(cls):
+        """关闭所有客户端"""
+        with cls._lock:
+            for entry in cls._clients.values():
+                cls._close_entry(entry)
+            cls._clients.clear()
+            cls._semaphores.clear()
 
-# === 记忆分片存储管理器 ===
-class MemoryChunkManager:
-    """分片存储管理器 - 处理消息的分片存储和索引"""
-    
-    def __init__(self, chunk_size: int = 100):
-        self.chunk_size = chunk_size
-    
-    def get_chunk_index(self, message_number: int) -> int:
-        """获取消息所属的分片索引"""
-        return (message_number - 1) // self.chunk_size + 1
-    
-    def get_chunk_range(self, chunk_index: int) -> tuple:
-        """获取分片的消息范围 (start, end)"""
-        start = (chunk_index - 1) * self.chunk_size + 1
-        end = chunk_index * self.chunk_size
-        return start, end
-    
-    def get_chunk_filename(self, session_id: str, chunk_index: int) -> str:
-        """生成分片文件名"""
-        return f"{session_id}_chunk_{chunk_index:03d}.json"
-    
-    def calculate_required_chunks(self, start_msg: int, end_msg: int) -> List[int]:
-        """计算需要读取的分片索引列表"""
-        start_chunk = self.get_chunk_index(start_msg)
-        end_chunk = self.get_chunk_index(end_msg)
-        return list(range(start_chunk, end_chunk + 1))
+    @classmethod
+    def get_stats(cls) -> List[Dict[str, Any]]:
+        """获取客户端池统计信息"""
+        with cls._lock:
+            return [
+                {
+                    "provider": key[0],
+                    "model": key[1],
+                    "base_url": key[2],
+                    "temperature": key[3],
+                    "async": entry["loop"] is not None,
+                    "in_flight": entry["in_flight"],
+                    "uses": entry["uses"],
+                    "idle_seconds": round(time.time() - entry["last_used"], 1)
+                }
+                for key, entry in cls._clients.items()
+            ]
 
-class MemoryCompressor:
-    """记忆压缩器 - 独立的压缩模块"""
-    
-    def __init__(self):
-        pass
-    
-    def compress_messages(
-        self, 
-        messages: List[Dict[str, Any]], 
-        model_name: str = "deepseek_chat",
+# === 速率限制器 ===
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数：中日韩字符按1个token计，其余字符按4个字符1个token计"""
+    if not text:
+        return 0
+    cjk_count = len(re.findall(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]', text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+async def _run_closing_clients(coro):
+    """运行协程，结束前关闭在本事件循环中创建的LLM客户端（循环关闭后无法再关闭）"""
+    try:
+        return await coro
+    finally:
+        await LLMClientRegistry.aclose_loop()
+
+def run_coroutine_sync(coro):
+    """在同步代码中运行协程并返回结果
+
+    当前线程没有运行中的事件循环时直接asyncio.run；已在事件循环内（如从异步框架中调用同步接口）
+    时asyncio.run会抛RuntimeError，改为在辅助线程的新事件循环中运行并阻塞等待结果。
+    两种方式都会在新事件循环结束前关闭其中创建的异步LLM客户端。
+    """
+    coro = _run_closing_clients(coro)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    outcome = {}
+    context = contextvars.copy_context()
+
+    def runner():
+        try:
+            outcome["result"] = context.run(asyncio.run, coro)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=runner, name="coroutine-runner", daemon=True)
+    thread.start()
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("result")
+
+def executor_for_process(
+    executor: Optional[ThreadPoolExecutor],
+    max_workers: int,
+    thread_name_prefix: str
+) -> ThreadPoolExecutor:
+    """返回当前进程可用的线程池：尚未创建或创建于fork前的父进程时新建（线程不会随fork复制）"""
+    if executor is None or getattr(executor, "_owner_pid", None) != os.getpid():
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        executor._owner_pid = os.getpid()
+    return executor
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True) -> Iterator[bool]:
+    """跨进程文件锁（fcntl.flock），产出是否取得锁；blocking=False时取不到锁产出False
+
+    同一进程内分别打开的锁文件也互斥，可同时用于多个实例之间；没有fcntl的平台上总是产出True。
+    """
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, 'a') as f:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class RateLimiter:
+    """按模型的令牌桶限速器 - 同时限制每分钟请求数(rpm)和每分钟token数(tpm)"""
+
+    _limiters: Dict[str, "RateLimiter"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_model(cls, model_name: str) -> "RateLimiter":
+        """获取模型共享的限速器（预算来自LLMConfigManager）"""
+        with cls._registry_lock:
+            limiter = cls._limiters.get(model_name)
+            if limiter is None:
+                config = LLMConfigManager.get_config(model_name)
+                limiter = cls(config.get("rpm"), config.get("tpm"))
+                cls._limiters[model_name] = limiter
+            return limiter
+
+    @classmethod
+    def for_provider(cls, provider: str) -> "RateLimiter":
+        """获取服务商分组共享的限速器（预算来自LLMConfigManager.get_provider_limits）"""
+        key = f"provider:{provider}"
+        with cls._registry_lock:
+            limiter = cls._limiters.get(key)
+            if limiter is None:
+                limits = LLMConfigManager.get_provider_limits(provider)
+                limiter = cls(limits.get("rpm"), limits.get("tpm"))
+                cls._limiters[key] = limiter
+            return limiter
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """非阻塞地尝试扣除一次请求与tokens个token的额度，成功返回0，否则不扣除并返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated_at
+            self._updated_at = now
+            if self.rpm:
+                self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+            if self.tpm:
+                self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)
+                # 单次请求超过整分钟预算时按满桶处理，避免永远等待
+                tokens = min(tokens, self.tpm)
+
+            wait = 0.0
+            if self.rpm and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+            if self.tpm and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+            if wait > 0:
+                return wait
+
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= tokens
+            return 0.0
+
+    def wait(self, tokens: int = 0):
+        """阻塞直到有足够额度"""
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    async def await_capacity(self, tokens: int = 0):
+        """异步等待直到有足够额度"""
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+# === LLM响应缓存 ===
+class LLMResponseCache:
+    """按内容寻址的LLM响应磁盘缓存
+
+    键为(模型配置, temperature, 规范化后的消息)的sha256，每条响应存为一个JSON文件。
+    总大小超过上限时按最近访问时间淘汰，超过TTL的条目在读取时失效。
+    通过环境变量开启: LLM_CACHE=1，可选 LLM_CACHE_DIR、LLM_CACHE_MAX_MB、LLM_CACHE_TTL(秒)。
+    全局开关只作用于temperature为0的调用，其他调用需显式传入cache=True。
+    """
+
+    # 不影响模型输出的配置项不参与缓存键
+    KEY_EXCLUDED_FIELDS = ("api_key", "timeout") + tuple(LLMConfigManager.DEFAULT_CLIENT_SETTINGS)
+
+    _default: Optional["LLMResponseCache"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(
+        self,
+        cache_path: str = "./cache/llm",
+        max_bytes: int = 200 * 1024 * 1024,
+        ttl: float = 7 * 86400,
+        enabled: bool = True
+    ):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        # key -> 文件大小，按最近访问排序
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "bytes_saved": 0}
+
+    @classmethod
+    def default(cls) -> "LLMResponseCache":
+        """进程共享的缓存实例（配置来自环境变量）"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls(
+                    cache_path=os.getenv("LLM_CACHE_DIR", "./cache/llm"),
+                    max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024),
+                    ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 86400))),
+                    enabled=os.getenv("LLM_CACHE", "0") == "1"
+                )
+            return cls._default
+
+    def should_use(self, cache: Optional[bool], temperature: Optional[float] = None) -> bool:
+        """cache为None时按全局开关且只缓存确定性调用(temperature为0)，True/False为单次调用的强制开启/跳过
+
+        temperature大于0的调用（如章节生成）每次结果不同，重试时应得到新的内容，默认不缓存。
+        """
+        if cache is not None:
+            return cache
+        return self.enabled and temperature is not None and float(temperature) == 0
+
+    @classmethod
+    def make_key(cls, config: Dict[str, Any], messages: List[Dict[str, str]]) -> str:
+        """计算缓存键：换行符统一、去除首尾空白后的消息与影响输出的配置"""
+        key_config = {k: v for k, v in config.items() if k not in cls.KEY_EXCLUDED_FIELDS}
+        normalized = [
+            {
+                "role": msg.get("role", "user"),
+                "content": str(msg.get("content", "")).replace("\r\n", "\n").strip()
+            }
+            for msg in messages
+        ]
+        payload = json.dumps({"config": key_config, "messages": normalized}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_file(self, key: str) -> str:
+        return os.path.join(self.cache_path, key[:2], f"{key}.json")
+
+    def _ensure_loaded_locked(self):
+        """首次使用时扫描缓存目录，按文件修改时间（即最近访问时间）重建LRU顺序"""
+        if self._loaded:
+            return
+        found = []
+        if os.path.isdir(self.cache_path):
+            for shard in os.scandir(self.cache_path):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    def _remove_locked(self, key: str):
+        size = self._entries.pop(key, 0)
+        self._total_bytes -= size
+        try:
+            os.remove(self._entry_file(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的响应，未命中或已过期返回None"""
+        with self._lock:
+            self._ensure_loaded_locked()
+            if key not in self._entries:
+                self._stats["misses"] += 1
+                PerfMetrics.cache_requests.inc(("llm_response", "miss"))
+                return None
+            entry_file = self._entry_file(key)
+            try:
+                with open(entry_file, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self._remove_locked(key)
+                self._stats["misses"] += 1
+                PerfMetrics.cache_requests.inc(("llm_response", "miss"))
+                return None
+            if time.time() - entry.get("created_at", 0) > self.ttl:
+                self._remove_locked(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                PerfMetrics.cache_requests.inc(("llm_response", "miss"))
+                return None
+            
+            self._entries.move_to_end(key)
+            os.utime(entry_file)
+            self._stats["hits"] += 1
+            self._stats["bytes_saved"] += len(entry["content"].encode("utf-8"))
+            PerfMetrics.cache_requests.inc(("llm_response", "hit"))
+            return entry["content"]
+
+    def put(self, key: str, content: str, model_name: str = ""):
+        """写入响应并按总大小淘汰最久未访问的条目"""
+        entry_file = self._entry_file(key)
+        data = json.dumps({
+            "key": key,
+            "model_name": model_name,
+            "created_at": time.time(),
+            "content": content
+        }, ensure_ascii=False)
+        with self._lock:
+            self._ensure_loaded_locked()
+            os.makedirs(os.path.dirname(entry_file), exist_ok=True)
+            tmp_file = entry_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, entry_file)
+            
+            self._total_bytes -= self._entries.pop(key, 0)
+            size = os.path.getsize(entry_file)
+            self._entries[key] = size
+            self._total_bytes += size
+            self._stats["stores"] += 1
+            
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._ensure_loaded_locked()
+            for key in list(self._entries):
+                self._remove_locked(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """命中/未命中次数、节省的响应字节数与当前占用"""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "enabled": self.enabled,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+# === 提示词预算 ===
+class PromptBudgeter:
+    """按token预算组装提示词
+
+    每个部分带有优先级与裁剪方式，总量超出预算时从优先级最低的部分开始裁剪，
+    必需部分（trim=None）不会被裁剪。
+    """
+
+    TRIM_MARKER = "……（已省略）"
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self._sections: List[Dict[str, Any]] = []
+
+    def add(self, name: str, text: str, priority: int = 0, trim: Optional[str] = None, header: str = ""):
+        """添加一个部分
+
+        Args:
+            name: 部分名称，用于报告
+            text: 部分文本
+            priority: 优先级，数值越小越先被裁剪
+            trim: None不可裁剪；"keep_head"保留开头；"keep_tail"保留结尾（如前文章节保留最近的内容）；
+                "json"按整个字段/列表项保留开头，裁剪后仍是合法JSON（text须为JSON）
+            header: 部分标题，裁剪时保留，正文被完全裁掉时一并省略
+        """
+        if text:
+            self._sections.append({
+                "name": name, "header": header, "text": text, "priority": priority, "trim": trim
+            })
+
+    def _truncate(self, text: str, max_tokens: int, trim: str) -> str:
+        """截断文本使其估算token数不超过max_tokens（二分查找保留的字符数）"""
+        marker_tokens = estimate_tokens(self.TRIM_MARKER)
+        if max_tokens <= marker_tokens:
+            return ""
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            kept = text[:mid] if trim == "keep_head" else text[len(text) - mid:]
+            if estimate_tokens(kept) + marker_tokens <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        if low == 0:
+            return ""
+        if trim == "keep_head":
+            return text[:low] + self.TRIM_MARKER
+        return self.TRIM_MARKER + text[len(text) - low:]
+
+    @staticmethod
+    def _dump_json(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    def _truncate_json(self, text: str, max_tokens: int) -> str:
+        """从末尾去掉整个顶层字段或列表项后重新序列化，结果仍是合法JSON，省略标记另起一行"""
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return self._truncate(text, max_tokens, "keep_head")
+        budget = max_tokens - estimate_tokens("\n" + self.TRIM_MARKER)
+        kept = self._trim_json_value(data, budget)
+        if kept is None:
+            return ""
+        result = self._dump_json(kept)
+        if estimate_tokens(result) > budget:
+            return ""
+        return result + "\n" + self.TRIM_MARKER
+
+    def _trim_json_value(self, value: Any, max_tokens: int) -> Any:
+        """保留开头尽可能多的字段/列表项使序列化后不超过max_tokens，放不下的下一项在剩余预算内裁剪其内部
+        （长字符串截断开头部分）；一项都保留不了时返回None"""
+        if estimate_tokens(self._dump_json(value)) <= max_tokens:
+            return value
+        if isinstance(value, str):
+            # 字符串截断后重新序列化，转义字符仍然完整；按序列化后的长度二分保留的字符数
+            low, high = 0, len(value)
+            while low < high:
+                mid = (low + high + 1) // 2
+                if estimate_tokens(self._dump_json(value[:mid] + self.TRIM_MARKER)) <= max_tokens:
+                    low = mid
+                else:
+                    high = mid - 1
+            return value[:low] + self.TRIM_MARKER if low else None
+        if not isinstance(value, (dict, list)) or not value:
+            return None
+        is_dict = isinstance(value, dict)
+        items = list(value.items()) if is_dict else list(value)
+        rebuild = dict if is_dict else list
+        low, high = 0, len(items) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate_tokens(self._dump_json(rebuild(items[:mid]))) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        kept = items[:low]
+        
+        # 下一项整体放不下：用剩余预算保留它的开头部分
+        key, following = items[low] if is_dict else (None, items[low])
+        placeholder = kept + [(key, None) if is_dict else None]
+        remaining = max_tokens - estimate_tokens(self._dump_json(rebuild(placeholder))) + estimate_tokens("null")
+        trimmed = self._trim_json_value(following, remaining)
+        if trimmed is not None:
+            candidate = kept + [(key, trimmed) if is_dict else trimmed]
+            if estimate_tokens(self._dump_json(rebuild(candidate))) <= max_tokens:
+                kept = candidate
+        return rebuild(kept) if kept else None
+
+    def fit(self) -> Dict[str, Any]:
+        """裁剪各部分以满足预算，返回按添加顺序排列的最终文本与各部分token报告"""
+        for section in self._sections:
+            section["final_text"] = section["header"] + section["text"]
+            section["tokens"] = estimate_tokens(section["final_text"])
+            section["final_tokens"] = section["tokens"]
+
+        overflow = sum(section["tokens"] for section in self._sections) - self.max_tokens
+        trimmable = sorted(
+            (section for section in self._sections if section["trim"]),
+            key=lambda section: section["priority"]
+        )
+        for section in trimmable:
+            if overflow <= 0:
+                break
+            target = max(0, section["tokens"] - overflow - estimate_tokens(section["header"]))
+            if section["trim"] == "json":
+                body = self._truncate_json(section["text"], target)
+            else:
+                body = self._truncate(section["text"], target, section["trim"])
+            section["final_text"] = section["header"] + body if body else ""
+            section["final_tokens"] = estimate_tokens(section["final_text"])
+            overflow -= section["tokens"] - section["final_tokens"]
+
+        total = sum(section["final_tokens"] for section in self._sections)
+        return {
+            "texts": [section["final_text"] for section in self._sections if section["final_text"]],
+            "by_name": {section["name"]: section["final_text"] for section in self._sections if section["final_text"]},
+            "report": {
+                "budget": self.max_tokens,
+                "total_tokens": total,
+                "over_budget": total > self.max_tokens,
+                "sections": {
+                    section["name"]: {
+                        "tokens": section["tokens"],
+                        "final_tokens": section["final_tokens"],
+                        "trimmed": section["final_tokens"] < section["tokens"]
+                    }
+                    for section in self._sections
+                }
+            }
+        }
+
+# === 调用延迟统计 ===
+class LLMLatencyTracker:
+    """按(模型, 调用用途)记录最近成功的非流式调用延迟，用于计算对冲请求的触发时间
+
+    同一模型上章节生成与状态更新的耗时相差很大，混在一起时分位数不能反映状态更新的延迟，
+    因此按LLMCallLog.context中的purpose分开统计；流式调用的总耗时取决于输出长度，不计入。
+    """
+
+    _samples: Dict[tuple, deque] = {}
+    _lock = threading.Lock()
+    WINDOW = 200
+    MIN_SAMPLES = 10
+
+    @staticmethod
+    def _key(model_name: str, purpose: Optional[str]) -> tuple:
+        if purpose is None:
+            purpose = LLMCallLog.current_context().get("purpose", "other")
+        return (model_name, purpose)
+
+    @classmethod
+    def record(cls, model_name: str, seconds: float, purpose: Optional[str] = None):
+        """记录一次成功调用的延迟，purpose为None时取当前调用上下文的用途"""
+        key = cls._key(model_name, purpose)
+        with cls._lock:
+            cls._samples.setdefault(key, deque(maxlen=cls.WINDOW)).append(seconds)
+
+    @classmethod
+    def percentile(cls, model_name: str, q: float, purpose: Optional[str] = None) -> Optional[float]:
+        """同一模型、同一用途最近调用延迟的q分位数，样本不足时返回None"""
+        key = cls._key(model_name, purpose)
+        with cls._lock:
+            samples = sorted(cls._samples.get(key, ()))
+        if len(samples) < cls.MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+# === 模型路由与熔断 ===
+class CircuitOpenError(RuntimeError):
+    """模型处于熔断状态，调用被直接拒绝"""
+    status_code = 503
+
+class ModelRouter:
+    """按模型统计滚动延迟与错误率，决定调用链顺序，并对持续失败的模型熔断
+
+    - 连续 FAILURE_THRESHOLD 次临时错误后熔断，COOLDOWN 秒内不再发送请求
+    - 冷却结束后放行一个探测请求：成功则恢复，失败则冷却时间加倍（上限 MAX_COOLDOWN）
+    - 主模型的延迟评分超过最健康备用模型的 SLACK 倍时，优先使用该备用模型
+    - 延迟按调用用途（LLMCallLog.context的purpose）分别统计，只比较同类调用；超过 SCORE_TTL 秒
+      没有新样本的评分视为过期，被降级的主模型因此会重新获得流量并重新评分
+    """
+
+    FAILURE_THRESHOLD = 5
+    COOLDOWN = 30.0
+    MAX_COOLDOWN = 600.0
+    PROBE_TIMEOUT = 300.0
+    EWMA_ALPHA = 0.2
+    MIN_SAMPLES = 5
+    SLACK = 2.0
+    SCORE_TTL = 300.0
+
+    _health: Dict[str, Dict[str, Any]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _entry_locked(cls, model_name: str) -> Dict[str, Any]:
+        entry = cls._health.get(model_name)
+        if entry is None:
+            entry = {
+                # 调用用途 -> {"ewma": 滚动平均延迟, "samples": 样本数, "updated_at": 最近样本时间}
+                "latency": {},
+                "error_rate": 0.0,
+                "samples": 0,
+                "successes": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "state": "closed",
+                "opened_at": None,
+                "cooldown": cls.COOLDOWN,
+                "probe_started": None
+            }
+            cls._health[model_name] = entry
+        return entry
+
+    @staticmethod
+    def _purpose(purpose: Optional[str]) -> str:
+        if purpose is None:
+            purpose = LLMCallLog.current_context().get("purpose", "other")
+        return purpose
+
+    @classmethod
+    def record_success(cls, model_name: str, seconds: float, purpose: Optional[str] = None):
+        """记录一次成功调用，purpose为None时取当前调用上下文的用途"""
+        purpose = cls._purpose(purpose)
+        now = time.time()
+        with cls._lock:
+            entry = cls._entry_locked(model_name)
+            alpha = cls.EWMA_ALPHA
+            latency = entry["latency"].get(purpose)
+            if latency is None or now - latency["updated_at"] > cls.SCORE_TTL:
+                # 过期的评分不再代表当前状况，从新样本重新开始
+                entry["latency"][purpose] = {"ewma": seconds, "samples": 1, "updated_at": now}
+            else:
+                latency["ewma"] = latency["ewma"] * (1 - alpha) + seconds * alpha
+                latency["samples"] += 1
+                latency["updated_at"] = now
+            entry["error_rate"] *= 1 - alpha
+            entry["samples"] += 1
+            entry["successes"] += 1
+            entry["consecutive_failures"] = 0
+            if entry["state"] != "closed":
+                print(f"✅ {model_name} 已恢复，解除熔断")
+                entry.update(state="closed", opened_at=None, cooldown=cls.COOLDOWN, probe_started=None)
+
+    @classmethod
+    def record_failure(cls, model_name: str):
+        """记录一次临时错误（超时、连接错误、429、5xx）"""
+        with cls._lock:
+            entry = cls._entry_locked(model_name)
+            alpha = cls.EWMA_ALPHA
+            entry["error_rate"] = entry["error_rate"] * (1 - alpha) + alpha
+            entry["samples"] += 1
+            entry["failures"] += 1
+            entry["consecutive_failures"] += 1
+            if entry["state"] == "half_open":
+                entry.update(state="open", opened_at=time.time(), probe_started=None,
+                             cooldown=min(cls.MAX_COOLDOWN, entry["cooldown"] * 2))
+                print(f"⛔ {model_name} 探测失败，熔断 {entry['cooldown']:.0f} 秒")
+            elif entry["state"] == "closed" and entry["consecutive_failures"] >= cls.FAILURE_THRESHOLD:
+                entry.update(state="open", opened_at=time.time())
+                print(f"⛔ {model_name} 连续失败 {entry['consecutive_failures']} 次，熔断 {entry['cooldown']:.0f} 秒")
+
+    @classmethod
+    def allow(cls, model_name: str) -> bool:
+        """是否可以向模型发送请求；熔断冷却结束后只放行一个探测请求"""
+        with cls._lock:
+            entry = cls._health.get(model_name)
+            if entry is None or entry["state"] == "closed":
+                return True
+            now = time.time()
+            if entry["state"] == "open" and now - entry["opened_at"] >= entry["cooldown"]:
+                entry.update(state="half_open", probe_started=now)
+                return True
+            if entry["state"] == "half_open" and now - entry["probe_started"] > cls.PROBE_TIMEOUT:
+                # 探测请求未记录结果（如流式调用被中途放弃），重新放行
+                entry["probe_started"] = now
+                return True
+            return False
+
+    @classmethod
+    def is_open(cls, model_name: str) -> bool:
+        """模型是否处于熔断冷却中（不放行探测，供调度器挑选模型时使用）"""
+        with cls._lock:
+            entry = cls._health.get(model_name)
+            if entry is None or entry["state"] == "closed":
+                return False
+            return entry["state"] == "half_open" or time.time() - entry["opened_at"] < entry["cooldown"]
+
+    @classmethod
+    def _score_locked(cls, model_name: str, purpose: str, now: float) -> Optional[float]:
+        entry = cls._health.get(model_name)
+        latency = entry["latency"].get(purpose) if entry else None
+        if (
+            latency is None
+            or latency["samples"] < cls.MIN_SAMPLES
+            or now - latency["updated_at"] > cls.SCORE_TTL
+        ):
+            return None
+        return latency["ewma"] * (1 + 4 * entry["error_rate"])
+
+    @classmethod
+    def route(cls, model_name: str, purpose: Optional[str] = None) -> List[str]:
+        """按健康状况排列调用链：主模型在同类调用上明显慢于或差于最健康的备用模型时，把该备用模型提到最前"""
+        chain = LLMConfigManager.get_fallback_chain(model_name)
+        if len(chain) < 2:
+            return chain
+        purpose = cls._purpose(purpose)
+        now = time.time()
+        with cls._lock:
+            scores = {m: cls._score_locked(m, purpose, now) for m in chain}
+        known = [m for m in chain[1:] if scores[m] is not None]
+        if known and scores[chain[0]] is not None:
+            best = min(known, key=lambda m: scores[m])
+            if scores[chain[0]] > cls.SLACK * scores[best]:
+                chain.remove(best)
+                chain.insert(0, best)
+        return chain
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._lock:
+            return {
+                model_name: {
+                    "state": entry["state"],
+                    "latency": {
+                        purpose: {"ewma": round(latency["ewma"], 3), "samples": latency["samples"]}
+                        for purpose, latency in entry["latency"].items()
+                    },
+                    "error_rate": round(entry["error_rate"], 3),
+                    "successes": entry["successes"],
+                    "failures": entry["failures"],
+                    "consecutive_failures": entry["consecutive_failures"],
+                    "cooldown": entry["cooldown"] if entry["state"] != "closed" else None
+                }
+                for model_name, entry in cls._health.items()
+            }
+
+# === Token用量统计 ===
+class LLMUsageStats:
+    """按模型累计LLM调用的输入、服务商提示词缓存命中与输出token"""
+
+    _totals: Dict[str, Dict[str, int]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def extract(message: Any) -> Dict[str, int]:
+        """从langchain响应中读取token用量，兼容usage_metadata与DeepSeek的prompt_cache_hit_tokens"""
+        usage = getattr(message, "usage_metadata", None) or {}
+        token_usage = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+        details = usage.get("input_token_details") or {}
+        input_tokens = usage.get("input_tokens") or token_usage.get("prompt_tokens") or 0
+        cached_tokens = details.get("cache_read") or token_usage.get("prompt_cache_hit_tokens") or 0
+        return {
+            "input_tokens": input_tokens,
+            "cached_tokens": cached_tokens,
+            "uncached_tokens": max(0, input_tokens - cached_tokens),
+            "cache_write_tokens": details.get("cache_creation") or 0,
+            "output_tokens": usage.get("output_tokens") or token_usage.get("completion_tokens") or 0
+        }
+
+    @classmethod
+    def record(cls, model_name: str, usage: Dict[str, int]):
+        """累计一次调用的用量"""
+        with cls._lock:
+            totals = cls._totals.setdefault(model_name, {"calls": 0, **{key: 0 for key in usage}})
+            totals["calls"] += 1
+            for key, value in usage.items():
+                totals[key] += value
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._lock:
+            return {
+                model_name: dict(
+                    totals,
+                    cache_hit_rate=round(totals["cached_tokens"] / totals["input_tokens"], 4) if totals["input_tokens"] else 0.0
+                )
+                for model_name, totals in cls._totals.items()
+            }
+
+# === LLM调用记录 ===
+class LLMCallLog:
+    """LLM调用记录 - 每次实际发出的请求（含重试、对冲与备用模型）追加一行到
+    metrics/llm_calls_YYYYMMDD.jsonl，并按小说、模型、调用用途累计token、费用与延迟
+
+    调用用途与小说ID通过 LLMCallLog.context(purpose=..., novel_id=...) 设置，
+    同一线程/协程内的LLM调用都会带上这些字段。
+    """
+
+    _context: contextvars.ContextVar = contextvars.ContextVar("llm_call_context", default={})
+    _default: Optional["LLMCallLog"] = None
+    _default_lock = threading.Lock()
+    SUM_FIELDS = ("calls", "errors", "input_tokens", "cached_tokens", "output_tokens", "cost", "latency", "ttft", "ttft_calls")
+
+    def __init__(self, log_path: str = "./metrics", enabled: bool = True, retention_days: int = 30):
+        """
+        Args:
+            log_path: 调用记录存储目录
+            enabled: 是否写入调用记录
+            retention_days: 调用记录保留天数，每天首次写入时删除更早的文件，0表示全部保留
+                （累计统计只包含保留的文件）
+        """
+        self.log_path = log_path
+        self.enabled = enabled
+        self.retention_days = retention_days
+        self._current_file: Optional[str] = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._totals: Dict[str, Dict[str, Dict[str, Any]]] = {"novels": {}, "models": {}, "purposes": {}}
+
+    @classmethod
+    def default(cls) -> "LLMCallLog":
+        """全局调用记录（LLM_CALL_LOG=0关闭，LLM_CALL_LOG_DIR指定目录，LLM_CALL_LOG_RETENTION_DAYS指定保留天数）"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls(
+                    log_path=os.getenv("LLM_CALL_LOG_DIR", "./metrics"),
+                    enabled=os.getenv("LLM_CALL_LOG", "1") == "1",
+                    retention_days=int(os.getenv("LLM_CALL_LOG_RETENTION_DAYS", "30"))
+                )
+            return cls._default
+
+    @classmethod
+    @contextmanager
+    def context(cls, **fields):
+        """设置调用上下文（purpose、novel_id、chapter_index等），嵌套时合并外层字段"""
+        token = cls._context.set({**cls._context.get(), **fields})
+        try:
+            yield
+        finally:
+            try:
+                cls._context.reset(token)
+            except ValueError:
+                # 流式生成器在其他线程或上下文中被关闭（如客户端断开后由其他线程回收）
+                pass
+
+    @classmethod
+    def current_context(cls) -> Dict[str, Any]:
+        return dict(cls._context.get())
+
+    def _log_file(self, timestamp: float) -> str:
+        return os.path.join(self.log_path, f"llm_calls_{time.strftime('%Y%m%d', time.localtime(timestamp))}.jsonl")
+
+    def record(
+        self,
+        model_name: str,
+        usage: Dict[str, int],
+        latency: float,
+        ttft: Optional[float] = None,
+        error: Optional[Exception] = None
+    ) -> Dict[str, Any]:
+        """记录一次请求并返回记录"""
+        context = self.current_context()
+        cost = LLMConfigManager.get_cost(model_name, usage)
+        entry = {
+            "ts": round(time.time(), 3),
+            "model": model_name,
+            "purpose": context.pop("purpose", "other"),
+            "novel_id": context.pop("novel_id", None),
+            **usage,
+            "cost": round(cost, 8) if cost is not None else None,
+            "latency": round(latency, 3),
+            "ttft": round(ttft, 3) if ttft is not None else None,
+            "error": f"{type(error).__name__}: {error}" if error else None,
+            **context
+        }
+        if not self.enabled:
+            return entry
+        with self._lock:
+            file_path = self._log_file(entry["ts"])
+            if file_path != self._current_file:
+                # 换到新一天的文件时清理过期文件
+                self._current_file = file_path
+                prune_dated_files(self.log_path, "llm_calls_", self.retention_days)
+            try:
+                os.makedirs(self.log_path, exist_ok=True)
+                with open(file_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"写入LLM调用记录失败: {e}")
+            if self._loaded:
+                self._add_locked(entry)
+        return entry
+
+    def _add_locked(self, entry: Dict[str, Any]):
+        keys = {"models": entry.get("model"), "purposes": entry.get("purpose")}
+        if entry.get("novel_id"):
+            keys["novels"] = entry["novel_id"]
+        for group, key in keys.items():
+            totals = self._totals[group].setdefault(key, {field: 0 for field in self.SUM_FIELDS})
+            totals["calls"] += 1
+            totals["errors"] += 1 if entry.get("error") else 0
+            for field in ("input_tokens", "cached_tokens", "output_tokens", "cost", "latency"):
+                totals[field] += entry.get(field) or 0
+            if entry.get("ttft") is not None:
+                totals["ttft"] += entry["ttft"]
+                totals["ttft_calls"] += 1
+            if group == "novels":
+                purposes = totals.setdefault("by_purpose", {})
+                by_purpose = purposes.setdefault(entry.get("purpose"), {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0})
+                by_purpose["calls"] += 1
+                for field in ("input_tokens", "output_tokens", "cost"):
+                    by_purpose[field] += entry.get(field) or 0
+
+    def _ensure_loaded_locked(self):
+        """首次查询时从日志文件重建累计值"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.log_path):
+            return
+        for filename in sorted(os.listdir(self.log_path)):
+            if not (filename.startswith("llm_calls_") and filename.endswith(".jsonl")):
+                continue
+            with open(os.path.join(self.log_path, filename), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._add_locked(json.loads(line))
+                    except (ValueError, AttributeError):
+                        # 进程中断留下的不完整行
+                        continue
+
+    @staticmethod
+    def _public(totals: Dict[str, Any]) -> Dict[str, Any]:
+        result = {
+            "calls": totals["calls"],
+            "errors": totals["errors"],
+            "input_tokens": totals["input_tokens"],
+            "cached_tokens": totals["cached_tokens"],
+            "output_tokens": totals["output_tokens"],
+            "cost": round(totals["cost"], 4),
+            "avg_latency": round(totals["latency"] / totals["calls"], 3) if totals["calls"] else 0.0,
+            "avg_ttft": round(totals["ttft"] / totals["ttft_calls"], 3) if totals["ttft_calls"] else None
+        }
+        if "by_purpose" in totals:
+            result["by_purpose"] = {
+                purpose: dict(values, cost=round(values["cost"], 4)) for purpose, values in totals["by_purpose"].items()
+            }
+        return result
+
+    def get_summary(self, novel_id: Optional[str] = None) -> Dict[str, Any]:
+        """按小说、模型、用途汇总的调用次数、token、费用（美元）与平均延迟；指定novel_id时只返回该小说"""
+        with self._lock:
+            self._ensure_loaded_locked()
+            if novel_id is not None:
+                totals = self._totals["novels"].get(novel_id)
+                return self._public(totals) if totals else self._public({field: 0 for field in self.SUM_FIELDS})
+            return {
+                group: {key: self._public(totals) for key, totals in items.items()}
+                for group, items in self._totals.items()
+            }
+
+# === 全局大模型调用器 ===
+class LLMCaller:
+    # 可重试的超时/连接类错误（openai、anthropic、httpx、google各SDK的异常类名）
+    RETRYABLE_ERROR_NAMES = (
+        "APITimeoutError", "APIConnectionError", "TimeoutException", "TransportError",
+        "ServiceUnavailable", "ResourceExhausted", "DeadlineExceeded", "InternalServerError"
+    )
+
+    # 需要在请求中显式标记提示词缓存断点的服务商
+    CACHE_BREAKPOINT_PROVIDERS = ("anthropic",)
+
+    _hedge_executor: Optional[ThreadPoolExecutor] = None
+    _hedge_lock = threading.Lock()
+    _local = threading.local()
+
+    @staticmethod
+    def _status_code(error: Exception) -> Optional[int]:
+        status = getattr(error, "status_code", None)
+        if status is None:
+            status = getattr(getattr(error, "response", None), "status_code", None)
+        return status if isinstance(status, int) else None
+
+    @classmethod
+    def is_retryable(cls, error: Exception) -> bool:
+        """超时、连接错误、408/409/429与5xx视为可重试的临时错误"""
+        status = cls._status_code(error)
+        if status is not None:
+            return status in (408, 409, 429) or status >= 500
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        return any(klass.__name__ in cls.RETRYABLE_ERROR_NAMES for klass in type(error).__mro__)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        """读取响应头中的Retry-After（秒数或HTTP日期）"""
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if not headers:
+            return None
+        value = headers.get("retry-after-ms")
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    @classmethod
+    def _retry_delay(cls, error: Exception, attempt: int, policy: Dict[str, Any]) -> Optional[float]:
+        """第attempt次(从0开始)失败后的等待秒数，不应重试时返回None"""
+        if attempt >= policy["max_retries"] or not cls.is_retryable(error):
+            return None
+        retry_after = cls._retry_after(error)
+        if retry_after is not None:
+            if retry_after > policy["backoff_max"]:
+                # 要求等待的时间超过退避上限时直接失败（交给备用模型），不占住请求线程
+                print(f"⚠️  服务商要求 {retry_after:.0f} 秒后重试，超过上限 {policy['backoff_max']:.0f} 秒，不再重试")
+                return None
+            return retry_after
+        backoff = min(policy["backoff_max"], policy["backoff_base"] * (2 ** attempt))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    @classmethod
+    def _invoke_with_retry(
+        cls,
+        config: Dict[str, Any],
+        lang_messages: List[Any],
+        policy: Dict[str, Any],
+        model_name: str
+    ) -> tuple:
+        """同步调用，临时错误按策略退避重试，返回(响应文本, token用量)"""
+        attempt = 0
+        while True:
+            llm = LLMClientRegistry.acquire(config)
+            started = time.time()
+            try:
+                response = llm.invoke(lang_messages)
+                LLMLatencyTracker.record(model_name, time.time() - started)
+                ModelRouter.record_success(model_name, time.time() - started)
+                return response.content, cls._record_call(model_name, response, started, lang_messages, response.content)
+            except Exception as e:
+                cls._record_call(model_name, None, started, lang_messages, error=e)
+                if cls.is_retryable(e):
+                    ModelRouter.record_failure(model_name)
+                delay = cls._retry_delay(e, attempt, policy)
+                if delay is None:
+                    raise
+                print(f"⚠️  {model_name} 调用失败（第{attempt + 1}次）: {e or type(e).__name__}，{delay:.1f}秒后重试")
+            finally:
+                LLMClientRegistry.release(config)
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    def _hedged_invoke(
+        cls,
+        config: Dict[str, Any],
+        lang_messages: List[Any],
+        policy: Dict[str, Any],
+        model_name: str
+    ) -> tuple:
+        """对冲调用：首个请求超过近期延迟分位数仍未返回时再发一个相同请求，取先成功的结果"""
+        with cls._hedge_lock:
+            cls._hedge_executor = executor_for_process(cls._hedge_executor, 32, "llm-hedge")
+            executor = cls._hedge_executor
+        hedge_delay = LLMLatencyTracker.percentile(model_name, policy["hedge_percentile"]) or policy["hedge_delay"]
+        
+        # 在线程池中保留调用上下文（小说ID、用途）
+        first = executor.submit(contextvars.copy_context().run, cls._invoke_with_retry, config, lang_messages, policy, model_name)
+        done, _ = wait_futures([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+        
+        print(f"⏱️  {model_name} 超过 {hedge_delay:.1f} 秒未返回，发出对冲请求")
+        pending = {first, executor.submit(contextvars.copy_context().run, cls._invoke_with_retry, config, lang_messages, policy, model_name)}
+        error = None
+        while pending:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # 较慢的请求在后台结束，结果丢弃
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    @staticmethod
+    def _record_call(
+        model_name: str,
+        message: Any,
+        started: float,
+        lang_messages: List[Any],
+        content: str = "",
+        ttft: Optional[float] = None,
+        error: Optional[Exception] = None
+    ) -> Dict[str, int]:
+        """记录一次请求的用量与延迟；服务商未返回用量时按文本估算（estimated=1）"""
+        usage = LLMUsageStats.extract(message) if message is not None else None
+        if error is None and (not usage or not usage["input_tokens"]):
+            prompt_text = "".join(
+                m.content if isinstance(m.content, str) else "".join(block.get("text", "") for block in m.content)
+                for m in lang_messages
+            )
+            input_tokens = estimate_tokens(prompt_text)
+            usage = {
+                "input_tokens": input_tokens, "cached_tokens": 0, "uncached_tokens": input_tokens,
+                "cache_write_tokens": 0, "output_tokens": estimate_tokens(content), "estimated": 1
+            }
+        elif usage is None:
+            usage = {"input_tokens": 0, "cached_tokens": 0, "uncached_tokens": 0, "cache_write_tokens": 0, "output_tokens": 0}
+        LLMUsageStats.record(model_name, {k: v for k, v in usage.items() if k != "estimated"})
+        latency = time.time() - started
+        LLMCallLog.default().record(model_name, usage, latency, ttft, error)
+        PerfMetrics.llm_requests.inc((model_name, "error" if error is not None else "ok"))
+        PerfMetrics.llm_duration.observe(latency, (model_name,))
+        if ttft is not None:
+            PerfMetrics.llm_ttft.observe(ttft, (model_name,))
+        PerfMetrics.llm_tokens.inc((model_name, "input"), usage["input_tokens"])
+        PerfMetrics.llm_tokens.inc((model_name, "cached"), usage["cached_tokens"])
+        PerfMetrics.llm_tokens.inc((model_name, "output"), usage["output_tokens"])
+        Tracer.record(
+            "llm_request", latency, error, model=model_name, ttft=ttft,
+            input_tokens=usage["input_tokens"], cached_tokens=usage["cached_tokens"], output_tokens=usage["output_tokens"]
+        )
+        return usage
+
+    @staticmethod
+    def _prepare(model_name: str, temperature: Optional[float], has_fallback: bool = False) -> tuple:
+        """获取模型配置与调用策略；还有备用模型时只重试fallback_retries次"""
+        config = LLMConfigManager.get_config(model_name)
+        policy = LLMConfigManager.get_call_policy(model_name)
+        config["timeout"] = policy["timeout"]
+        if temperature is not None:
+            config["temperature"] = temperature
+        if has_fallback:
+            policy["max_retries"] = min(policy["max_retries"], policy["fallback_retries"])
+        return config, policy
+
+    @staticmethod
+    def _next_route(route: List[str], position: int, error: Exception) -> bool:
+        """当前模型失败后是否切换到调用链中的下一个模型"""
+        if position == len(route) - 1 or not LLMCaller.is_retryable(error):
+            return False
+        print(f"🔀 {route[position]} 不可用（{error or type(error).__name__}），切换到 {route[position + 1]}")
+        return True
+
+    @staticmethod
+    def _all_open_error(model_name: str, route: List[str]) -> CircuitOpenError:
+        return CircuitOpenError(f"{model_name} 调用链中的模型均处于熔断状态: {', '.join(route)}")
+
+    @staticmethod
+    def call(
+        messages: List[Dict[str, str]],
+        model_name: str = "deepseek_chat",
+        memory: Optional[Any] = None,
+        temperature: Optional[float] = None,
+        cache: Optional[bool] = None,
+        hedge: bool = False
+    ) -> str:
+        """同步调用LLM
+
+        cache: None按LLM_CACHE全局开关对temperature为0的调用使用响应缓存，True/False为本次调用强制使用/跳过缓存；
+        带对话记忆的调用不使用缓存。
+        超时与重试按LLMConfigManager.get_call_policy(model_name)执行；hedge为True时启用对冲请求，
+        适合状态更新这类输出较短、对延迟敏感的调用。
+        主模型熔断或重试后仍失败时，按ModelRouter.route(model_name)依次切换备用模型。
+        """
+        config = LLMConfigManager.get_config(model_name)
+        
+        if temperature is not None:
+            config["temperature"] = temperature
+        
+        response_cache = LLMResponseCache.default()
+        cache_key = None
+        if memory is None and response_cache.should_use(cache, config.get("temperature")):
+            cache_key = LLMResponseCache.make_key(config, messages)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                LLMCaller._local.usage = None
+                return cached
+            
+        # 如果有记忆，使用对话链
+        if memory:
+            from langchain.chains import ConversationChain
+            llm = LLMClientRegistry.acquire(config)
+            try:
+                chain = ConversationChain(llm=llm, memory=memory, verbose=False)
+                # 将messages转换为单个输入
+                user_input = messages[-1]["content"] if messages else ""
+                return chain.predict(input=user_input)
+            finally:
+                LLMClientRegistry.release(config)
+        
+        # 直接调用LLM，按调用链依次尝试
+        route = ModelRouter.route(model_name)
+        content = None
+        for position, routed_model in enumerate(route):
+            if not ModelRouter.allow(routed_model):
+                continue
+            routed_config, policy = LLMCaller._prepare(routed_model, temperature, position < len(route) - 1)
+            lang_messages = LLMCaller._to_langchain_messages(messages, routed_config["provider"])
+            try:
+                if hedge:
+                    content, usage = LLMCaller._hedged_invoke(routed_config, lang_messages, policy, routed_model)
+                else:
+                    content, usage = LLMCaller._invoke_with_retry(routed_config, lang_messages, policy, routed_model)
+                LLMCaller._local.usage = usage
+                break
+            except Exception as e:
+                if not LLMCaller._next_route(route, position, e):
+                    raise
+        if content is None:
+            raise LLMCaller._all_open_error(model_name, route)
+        # 只缓存请求的模型自己的响应，避免之后命中时把备用模型的输出当作该模型的结果
+        if cache_key and routed_model == model_name:
+            response_cache.put(cache_key, content, model_name)
+        return content
+
+    @staticmethod
+    async def acall(
+        messages: List[Dict[str, str]],
+        model_name: str = "deepseek_chat",
+        temperature: Optional[float] = None,
+        cache: Optional[bool] = None
+    ) -> str:
+        """异步调用LLM，同一服务商的并发数受max_concurrency限制；cache、超时、重试与备用模型同call"""
+        config = LLMConfigManager.get_config(model_name)
+        
+        if temperature is not None:
+            config["temperature"] = temperature
+        
+        response_cache = LLMResponseCache.default()
+        cache_key = None
+        if response_cache.should_use(cache, config.get("temperature")):
+            cache_key = LLMResponseCache.make_key(config, messages)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        loop = asyncio.get_running_loop()
+        route = ModelRouter.route(model_name)
+        for position, routed_model in enumerate(route):
+            if not ModelRouter.allow(routed_model):
+                continue
+            routed_config, policy = LLMCaller._prepare(routed_model, temperature, position < len(route) - 1)
+            lang_messages = LLMCaller._to_langchain_messages(messages, routed_config["provider"])
+            try:
+                content, _ = await LLMCaller._ainvoke_with_retry(routed_config, lang_messages, policy, routed_model, loop)
+            except Exception as e:
+                if not LLMCaller._next_route(route, position, e):
+                    raise
+                continue
+            if cache_key and routed_model == model_name:
+                response_cache.put(cache_key, content, model_name)
+            return content
+        raise LLMCaller._all_open_error(model_name, route)
+
+    @classmethod
+    async def _ainvoke_with_retry(
+        cls,
+        config: Dict[str, Any],
+        lang_messages: List[Any],
+        policy: Dict[str, Any],
+        model_name: str,
+        loop: asyncio.AbstractEventLoop
+    ) -> tuple:
+        """异步调用，临时错误按策略退避重试，返回(响应文本, token用量)"""
+        attempt = 0
+        while True:
+            # 退避等待期间不占用并发名额
+            async with LLMClientRegistry.get_semaphore(config, loop):
+                llm = LLMClientRegistry.acquire(config, loop)
+                started = time.time()
+                try:
+                    response = await llm.ainvoke(lang_messages)
+                    LLMLatencyTracker.record(model_name, time.time() - started)
+                    ModelRouter.record_success(model_name, time.time() - started)
+                    return response.content, cls._record_call(model_name, response, started, lang_messages, response.content)
+                except Exception as e:
+                    cls._record_call(model_name, None, started, lang_messages, error=e)
+                    if cls.is_retryable(e):
+                        ModelRouter.record_failure(model_name)
+                    delay = cls._retry_delay(e, attempt, policy)
+                    if delay is None:
+                        raise
+                    print(f"⚠️  {model_name} 调用失败（第{attempt + 1}次）: {e or type(e).__name__}，{delay:.1f}秒后重试")
+                finally:
+                    LLMClientRegistry.release(config, loop)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def stream(
+        messages: List[Dict[str, str]],
+        model_name: str = "deepseek_chat",
+        temperature: Optional[float] = None,
+        cache: Optional[bool] = None
+    ) -> Iterator[str]:
+        """流式调用LLM，逐段产出文本增量；cache含义同call，命中时一次性产出完整响应
+
+        超时为相邻两段输出之间的最长等待；只在尚未产出任何内容时重试或切换备用模型，之后的错误直接抛出。
+        """
+        config = LLMConfigManager.get_config(model_name)
+        
+        if temperature is not None:
+            config["temperature"] = temperature
+        
+        response_cache = LLMResponseCache.default()
+        cache_key = None
+        if response_cache.should_use(cache, config.get("temperature")):
+            cache_key = LLMResponseCache.make_key(config, messages)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                LLMCaller._local.usage = None
+                yield cached
+                return
+        
+        route = ModelRouter.route(model_name)
+        for position, routed_model in enumerate(route):
+            if not ModelRouter.allow(routed_model):
+                continue
+            routed_config, policy = LLMCaller._prepare(routed_model, temperature, position < len(route) - 1)
+            lang_messages = LLMCaller._to_langchain_messages(messages, routed_config["provider"])
+            parts = []
+            usage = {}
+            try:
+                for delta in LLMCaller._stream_with_retry(routed_config, lang_messages, policy, routed_model, parts, usage):
+                    yield delta
+                LLMCaller._local.usage = usage
+            except Exception as e:
+                if parts or not LLMCaller._next_route(route, position, e):
+                    raise
+                continue
+            # 只缓存请求的模型完整返回的响应
+            if cache_key and routed_model == model_name:
+                response_cache.put(cache_key, "".join(parts), model_name)
+            return
+        raise LLMCaller._all_open_error(model_name, route)
+
+    @classmethod
+    def _stream_with_retry(
+        cls,
+        config: Dict[str, Any],
+        lang_messages: List[Any],
+        policy: Dict[str, Any],
+        model_name: str,
+        parts: List[str],
+        usage: Dict[str, int]
+    ) -> Iterator[str]:
+        """流式调用，尚未产出内容时临时错误按策略退避重试；产出的内容同时追加到parts，token用量写入usage"""
+        attempt = 0
+        while True:
+            llm = LLMClientRegistry.acquire(config)
+            started = time.time()
+            ttft = None
+            try:
+                last_chunk = None
+                for chunk in llm.stream(lang_messages):
+                    if getattr(chunk, "usage_metadata", None):
+                        last_chunk = chunk
+                    if chunk.content:
+                        if ttft is None:
+                            ttft = time.time() - started
+                        parts.append(chunk.content)
+                        yield chunk.content
+                ModelRouter.record_success(model_name, time.time() - started)
+                usage.update(cls._record_call(model_name, last_chunk, started, lang_messages, "".join(parts), ttft))
+                return
+            except Exception as e:
+                cls._record_call(model_name, None, started, lang_messages, ttft=ttft, error=e)
+                if cls.is_retryable(e):
+                    ModelRouter.record_failure(model_name)
+                delay = None if parts else cls._retry_delay(e, attempt, policy)
+                if delay is None:
+                    raise
+                print(f"⚠️  {model_name} 流式调用失败（第{attempt + 1}次）: {e or type(e).__name__}，{delay:.1f}秒后重试")
+            finally:
+                LLMClientRegistry.release(config)
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def last_usage() -> Optional[Dict[str, int]]:
+        """当前线程最近一次call/stream的token用量（含服务商缓存命中的输入token），命中响应缓存时为None"""
+        return getattr(LLMCaller._local, "usage", None)
+
+    @staticmethod
+    def _to_langchain_messages(messages: List[Dict[str, str]], provider: Optional[str] = None) -> List[Any]:
+        """将字典消息转换为langchain消息对象
+
+        带cache_breakpoint的消息在支持显式缓存断点的服务商（CACHE_BREAKPOINT_PROVIDERS）上
+        转为带cache_control的内容块；其他服务商（DeepSeek、OpenAI）按前缀自动缓存，无需标记。
+        """
+        from langchain_core.messages import HumanMessage, SystemMessage
+        lang_messages = []
+        for msg in messages:
+            content = msg["content"]
+            if msg.get("cache_breakpoint") and provider in LLMCaller.CACHE_BREAKPOINT_PROVIDERS:
+                content = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            if msg["role"] == "system":
+                lang_messages.append(SystemMessage(content=content))
+            else:
+                lang_messages.append(HumanMessage(content=content))
+        return lang_messages
+
+# === 存储布局 ===
+class StorageLayout:
+    """存储布局 - 统一解析 data/、xiaoshuo/、memory/ 等目录下的文件路径
+
+    flat: 所有小说的文件平铺在同一目录（旧格式，默认）
+    sharded: 每部小说一个子目录，如 data/<novel_id>/、xiaoshuo/<novel_id>/
+    读取时总是先查分目录再查平铺目录，两种布局的数据可以混用。
+    """
+
+    LAYOUTS = ("flat", "sharded")
+
+    def __init__(self, layout: Optional[str] = None):
+        layout = layout or os.getenv("NOVEL_STORAGE_LAYOUT", "flat")
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unsupported storage layout: {layout}")
+        self.layout = layout
+        # 目录列表缓存: 目录 -> (mtime_ns, 文件名列表, 子目录名列表)
+        self._listing_cache: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def is_sharded(self) -> bool:
+        return self.layout == "sharded"
+
+    def novel_dir(self, base_dir: str, novel_id: Optional[str]) -> str:
+        """新文件写入的目录"""
+        if self.is_sharded and novel_id:
+            return os.path.join(base_dir, novel_id)
+        return base_dir
+
+    def write_path(self, base_dir: str, novel_id: Optional[str], filename: str) -> str:
+        """新文件写入路径（自动创建目录）"""
+        directory = self.novel_dir(base_dir, novel_id)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def read_path(self, base_dir: str, novel_id: Optional[str], filename: str) -> str:
+        """已有文件的读取路径：优先分目录，其次平铺目录"""
+        if novel_id:
+            sharded_path = os.path.join(base_dir, novel_id, filename)
+            if os.path.exists(sharded_path):
+                return sharded_path
+        return os.path.join(base_dir, filename)
+
+    def resolve_path(self, base_dir: str, novel_id: Optional[str], filename: str) -> str:
+        """覆盖写入已有文件时使用：文件已存在则返回其位置，否则返回新文件写入路径"""
+        path = self.read_path(base_dir, novel_id, filename)
+        if os.path.exists(path):
+            return path
+        return self.write_path(base_dir, novel_id, filename)
+
+    def list_dir(self, directory: str) -> tuple:
+        """列出目录中的(文件名列表, 子目录名列表)，目录mtime不变时使用缓存"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return [], []
+        with self._lock:
+            cached = self._listing_cache.get(directory)
+            if cached and cached[0] == mtime:
+                return cached[1], cached[2]
+        files, dirs = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                (dirs if entry.is_dir() else files).append(entry.name)
+        with self._lock:
+            self._listing_cache[directory] = (mtime, files, dirs)
+        return files, dirs
+
+    def list_novel_files(self, base_dir: str, novel_id: Optional[str]) -> List[str]:
+        """列出小说的所有文件路径（分目录 + 平铺目录中以 "{novel_id}_" 开头的文件）"""
+        found: Dict[str, str] = {}
+        flat_files, _ = self.list_dir(base_dir)
+        prefix = f"{novel_id}_" if novel_id else ""
+        for filename in flat_files:
+            if filename.startswith(prefix):
+                found[filename] = os.path.join(base_dir, filename)
+        if novel_id:
+            sharded_dir = os.path.join(base_dir, novel_id)
+            sharded_files, _ = self.list_dir(sharded_dir)
+            for filename in sharded_files:
+                found[filename] = os.path.join(sharded_dir, filename)
+        return sorted(found.values())
+
+    def list_novel_dirs(self, base_dir: str) -> List[str]:
+        """列出分目录布局下的小说ID"""
+        _, dirs = self.list_dir(base_dir)
+        return sorted(dirs)
+
+# === 状态管理器 ===
+class StateManager:
+    # 状态文件: [{novel_id}_]chapter_{N}_state.json，世界设定: [{novel_id}_]world_bible_{N}.json
+    STATE_FILE_RE = re.compile(r'^(?:(.*)_)?chapter_(\d+)_state\.json$')
+    WORLD_FILE_RE = re.compile(r'^(?:(.*)_)?world_bible_(\d+)\.json$')
+
+    def __init__(self, data_path: str = "./data", layout: Optional[StorageLayout] = None):
+        self.data_path = data_path
+        self.layout = layout or StorageLayout()
+        os.makedirs(self.data_path, exist_ok=True)
+        
+        # 目录索引: 目录 -> (mtime_ns, {novel_id("" 表示旧格式无ID): {"states": {编号: 路径}, "world": {编号: 路径}}})
+        self._dir_indexes: Dict[str, tuple] = {}
+        # 已解析文件缓存: 文件路径 -> (mtime_ns, size, 解析结果)
+        self._file_cache: Dict[str, tuple] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _dir_mtime(directory: str) -> Optional[int]:
+        try:
+            return os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan_dir(self, directory: str) -> Dict[str, Dict[str, Dict[int, str]]]:
+        """获取单个目录的文件索引，目录mtime变化时重新扫描"""
+        with self._lock:
+            mtime = self._dir_mtime(directory)
+            cached = self._dir_indexes.get(directory)
+            if cached and cached[0] == mtime:
+                PerfMetrics.cache_requests.inc(("state_dir_index", "hit"))
+                return cached[1]
+            
+            PerfMetrics.cache_requests.inc(("state_dir_index", "miss"))
+            started = time.perf_counter()
+            index: Dict[str, Dict[str, Dict[int, str]]] = {}
+            if mtime is not None:
+                for filename in os.listdir(directory):
+                    for kind, pattern in (("states", self.STATE_FILE_RE), ("world", self.WORLD_FILE_RE)):
+                        match = pattern.match(filename)
+                        if match:
+                            entry = index.setdefault(match.group(1) or "", {"states": {}, "world": {}})
+                            entry[kind][int(match.group(2))] = os.path.join(directory, filename)
+                            break
+            self._dir_indexes[directory] = (mtime, index)
+            PerfMetrics.storage_io.observe(time.perf_counter() - started, ("state", "scan_dir"))
+            return index
+
+    def _novel_entry(self, novel_id: Optional[str]) -> Dict[str, Dict[int, str]]:
+        """获取小说的文件索引，合并平铺目录与分目录（分目录优先）"""
+        key = novel_id or ""
+        merged = {"states": {}, "world": {}}
+        sources = [self.data_path]
+        if novel_id:
+            sources.append(os.path.join(self.data_path, novel_id))
+        for directory in sources:
+            entry = self._scan_dir(directory).get(key)
+            if entry:
+                merged["states"].update(entry["states"])
+                merged["world"].update(entry["world"])
+        return merged
+
+    def _record_saved_file(self, kind: str, novel_id: Optional[str], number: int, file_path: str, mtime_before: Optional[int]):
+        """保存文件后增量更新目录索引"""
+        directory = os.path.dirname(file_path)
+        with self._lock:
+            cached = self._dir_indexes.get(directory)
+            if cached is None:
+                return
+            entry = cached[1].setdefault(novel_id or "", {"states": {}, "world": {}})
+            entry[kind][number] = file_path
+            # 写入前目录未被外部修改时，直接记录新的目录mtime，避免重新扫描
+            if mtime_before == cached[0]:
+                self._dir_indexes[directory] = (self._dir_mtime(directory), cached[1])
+
+    def get_file_numbers(self, kind: str, novel_id: Optional[str] = None) -> List[int]:
+        """获取小说的状态章节编号(kind="states")或世界设定版本号(kind="world")，升序"""
+        return sorted(self._novel_entry(novel_id)[kind].keys())
+
+    def list_versioned_files(self, kind: str, novel_id: Optional[str] = None) -> List[tuple]:
+        """列出小说的(编号, 文件路径)，按编号升序"""
+        return sorted(self._novel_entry(novel_id)[kind].items())
+
+    def _find_latest_file(self, kind: str, novel_id: Optional[str] = None) -> Optional[str]:
+        """查找最新文件，支持小说ID过滤"""
+        with self._lock:
+            files = self._novel_entry(novel_id)[kind]
+            if not files:
+                return None
+            return files[max(files)]
+
+    def _load_cached(self, file_path: str, parser: Callable[[Any], Any]) -> Any:
+        """读取并解析JSON文件，文件mtime和大小不变时返回缓存结果"""
+        stat = os.stat(file_path)
+        with self._lock:
+            cached = self._file_cache.get(file_path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                PerfMetrics.cache_requests.inc(("state_file", "hit"))
+                return cached[2]
+        
+        PerfMetrics.cache_requests.inc(("state_file", "miss"))
+        started = time.perf_counter()
+        with open(file_path, 'r', encoding='utf-8') as f:
+            parsed = parser(json.load(f))
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("state", "read"))
+        with self._lock:
+            self._file_cache[file_path] = (stat.st_mtime_ns, stat.st_size, parsed)
+        return parsed
+
+    def _cache_saved_file(self, file_path: str, parsed: Any):
+        with self._lock:
+            stat = os.stat(file_path)
+            self._file_cache[file_path] = (stat.st_mtime_ns, stat.st_size, parsed)
+
+    def load_latest_state(self, novel_id: Optional[str] = None) -> Optional[ChapterState]:
+        """加载最新状态，支持小说ID过滤"""
+        with Tracer.span("state.load_latest_state", root=False, novel_id=novel_id):
+            latest_file = self._find_latest_file("states", novel_id)
+            if not latest_file:
+                return None
+
+            state = self._load_cached(latest_file, lambda data: ChapterState(**data))
+            return state.model_copy(deep=True)
+
+    def save_state(self, state: ChapterState, novel_id: Optional[str] = None):
+        """保存状态，支持小说ID"""
+        if novel_id:
+            filename = f"{novel_id}_chapter_{state.chapter_index:03d}_state.json"
+        else:
+            # 兼容旧格式
+            filename = f"chapter_{state.chapter_index:03d}_state.json"
+        file_path = self.layout.resolve_path(self.data_path, novel_id, filename)
+        
+        mtime_before = self._dir_mtime(os.path.dirname(file_path))
+        started = time.perf_counter()
+        with Tracer.span("state.save_state", root=False, novel_id=novel_id, chapter_index=state.chapter_index):
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(state.model_dump_json(indent=2))
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("state", "write"))
+        
+        self._record_saved_file("states", novel_id, state.chapter_index, file_path, mtime_before)
+        self._cache_saved_file(file_path, state.model_copy(deep=True))
+
+    def load_world_bible(self, novel_id: Optional[str] = None) -> Dict[str, Any]:
+        """加载世界设定，支持小说ID过滤"""
+        with Tracer.span("state.load_world_bible", root=False, novel_id=novel_id):
+            latest_file = self._find_latest_file("world", novel_id)
+            if not latest_file:
+                return {}
+
+            return copy.deepcopy(self._load_cached(latest_file, lambda data: data))
+
+    def save_world_bible(self, world_bible: Dict[str, Any], novel_id: Optional[str] = None, version: int = 0):
+        """保存世界设定，支持小说ID"""
+        if novel_id:
+            filename = f"{novel_id}_world_bible_{version:02d}.json"
+        else:
+            # 兼容旧格式
+            filename = f"world_bible_{version:02d}.json"
+        file_path = self.layout.resolve_path(self.data_path, novel_id, filename)
+        
+        mtime_before = self._dir_mtime(os.path.dirname(file_path))
+        started = time.perf_counter()
+        with Tracer.span("state.save_world_bible", root=False, novel_id=novel_id, version=version):
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(world_bible, f, indent=2, ensure_ascii=False)
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("world_bible", "write"))
+        
+        self._record_saved_file("world", novel_id, version, file_path, mtime_before)
+        self._cache_saved_file(file_path, copy.deepcopy(world_bible))
+    
+    def list_novel_states(self, novel_id: str) -> List[str]:
+        """列出指定小说的所有状态文件"""
+        return sorted(self._novel_entry(novel_id)["states"].values())
+    
+    def list_novels(self) -> List[str]:
+        """列出所有小说ID"""
+        novel_ids = {
+            novel_id for novel_id, entry in self._scan_dir(self.data_path).items()
+            if novel_id and entry["states"]
+        }
+        for novel_id in self.layout.list_novel_dirs(self.data_path):
+            if self._scan_dir(os.path.join(self.data_path, novel_id)).get(novel_id, {}).get("states"):
+                novel_ids.add(novel_id)
+        return sorted(novel_ids)
+
+# === 记忆分片存储管理器 ===
+# 进程退出时需要落盘的对象（弱引用，不延长对象生命周期；atexit钩子只注册一次）
+_exit_flush_targets: "weakref.WeakSet" = weakref.WeakSet()
+_exit_flush_lock = threading.Lock()
+_exit_flush_registered = False
+
+def _flush_on_exit_all():
+    for target in list(_exit_flush_targets):
+        try:
+            target.flush()
+        except Exception as e:
+            print(f"退出时落盘失败: {e}")
+
+def flush_on_exit(target):
+    """登记进程退出时调用target.flush()"""
+    global _exit_flush_registered
+    with _exit_flush_lock:
+        _exit_flush_targets.add(target)
+        if not _exit_flush_registered:
+            atexit.register(_flush_on_exit_all)
+            _exit_flush_registered = True
+
+class MemoryChunkManager:
+    """分片存储管理器 - 处理消息的分片存储和索引"""
+    
+    def __init__(self, chunk_size: int = 100):
+        self.chunk_size = chunk_size
+    
+    def get_chunk_index(self, message_number: int) -> int:
+        """获取消息所属的分片索引"""
+        return (message_number - 1) // self.chunk_size + 1
+    
+    def get_chunk_range(self, chunk_index: int) -> tuple:
+        """获取分片的消息范围 (start, end)"""
+        start = (chunk_index - 1) * self.chunk_size + 1
+        end = chunk_index * self.chunk_size
+        return start, end
+    
+    def get_chunk_filename(self, session_id: str, chunk_index: int, legacy: bool = False) -> str:
+        """生成分片文件名（默认为追加写入的JSONL格式，legacy=True时为旧版JSON格式）"""
+        if legacy:
+            return f"{session_id}_chunk_{chunk_index:03d}.json"
+        return f"{session_id}_chunk_{chunk_index:03d}.jsonl"
+    
+    def calculate_required_chunks(self, start_msg: int, end_msg: int) -> List[int]:
+        """计算需要读取的分片索引列表"""
+        start_chunk = self.get_chunk_index(start_msg)
+        end_chunk = self.get_chunk_index(end_msg)
+        return list(range(start_chunk, end_chunk + 1))
+
+class MemoryCompressor:
+    """记忆压缩器 - 独立的压缩模块"""
+    
+    # 单次压缩摘要的预期输出token数，批量压缩时计入tpm预算
+    EXPECTED_OUTPUT_TOKENS = int(os.getenv("MEMORY_COMPRESSION_OUTPUT_TOKENS", "800"))
+    # 压缩不需要多样性，使用temperature 0：LLM_CACHE开启时重新压缩未变化的分片可命中响应缓存
+    TEMPERATURE = 0.0
+    
+    def __init__(self):
+        pass
+    
+    def compress_messages(
+        self, 
+        messages: List[Dict[str, Any]], 
+        model_name: str = "deepseek_chat",
         compression_prompt: str = ""
     ) -> str:
         """压缩消息列表为摘要文本"""
         if not messages:
             return ""
         
+        # 调用LLM进行压缩
+        compress_messages = self._build_compression_messages(messages, compression_prompt)
+        
+        try:
+            with LLMCallLog.context(purpose="memory_compression"):
+                compressed_summary = LLMCaller.call(compress_messages, model_name, temperature=self.TEMPERATURE)
+            return compressed_summary
+        except Exception as e:
+            print(f"压缩失败: {e}")
+            return self._fallback_compression(messages)
+    
+    async def acompress_messages(
+        self,
+        messages: List[Dict[str, Any]],
+        model_name: str = "deepseek_chat",
+        compression_prompt: str = ""
+    ) -> str:
+        """异步压缩消息列表为摘要文本，用于批量压缩时并发调用"""
+        if not messages:
+            return ""
+        
+        compress_messages = self._build_compression_messages(messages, compression_prompt)
+        
+        try:
+            with LLMCallLog.context(purpose="memory_compression"):
+                return await LLMCaller.acall(compress_messages, model_name, temperature=self.TEMPERATURE)
+        except Exception as e:
+            print(f"压缩失败: {e}")
+            return self._fallback_compression(messages)
+    
+    def _build_compression_messages(
+        self,
+        messages: List[Dict[str, Any]],
+        compression_prompt: str = ""
+    ) -> List[Dict[str, str]]:
+        """构建压缩请求消息"""
         # 构建压缩提示词
         if not compression_prompt:
             compression_prompt = """请将以下对话历史压缩为简洁的摘要，保留关键信息和上下文：
@@ -312,17 +2872,9 @@ class MemoryCompressor:
         # 格式化历史记录
         history_text = self._format_messages_for_compression(messages)
         
-        # 调用LLM进行压缩
-        compress_messages = [
+        return [
             {"role": "user", "content": compression_prompt.format(history=history_text)}
         ]
-        
-        try:
-            compressed_summary = LLMCaller.call(compress_messages, model_name)
-            return compressed_summary
-        except Exception as e:
-            print(f"压缩失败: {e}")
-            return self._fallback_compression(messages)
     
     def _format_messages_for_compression(self, messages: List[Dict[str, Any]]) -> str:
         """格式化消息用于压缩"""
@@ -352,20 +2904,45 @@ class MemoryCompressor:
 class MemoryIndexManager:
     """记忆索引管理器 - 处理会话索引和元数据"""
     
-    def __init__(self, memory_path: str):
+    # 进程级索引缓存：索引文件路径 -> (mtime_ns, size, 索引数据)，按最近使用淘汰
+    # 缓存的索引数据是只读快照，写入缓存时复制，修改前也先复制
+    CACHE_MAX_SESSIONS = 256
+    _cache: "OrderedDict[str, tuple]" = OrderedDict()
+    _cache_lock = threading.Lock()
+    _cache_hits = 0
+    _cache_misses = 0
+    
+    # 平铺布局下的公共子目录，不能作为分目录会话名
+    RESERVED_DIRS = ("chunks", "summaries")
+    
+    def __init__(self, memory_path: str, flush_every: int = 20, layout: Optional[StorageLayout] = None):
         self.memory_path = memory_path
+        self.layout = layout or StorageLayout()
         self.chunks_path = os.path.join(memory_path, "chunks")
         self.summaries_path = os.path.join(memory_path, "summaries")
         os.makedirs(self.chunks_path, exist_ok=True)
         os.makedirs(self.summaries_path, exist_ok=True)
+        self._session_dirs: Dict[str, str] = {}
+        
+        # 延迟写入的索引：session_id -> 尚未落盘的索引数据
+        self.flush_every = flush_every
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        self._dirty_counts: Dict[str, int] = {}
+        self._lock = threading.RLock()
     
     def load_session_index(self, session_id: str) -> Dict[str, Any]:
-        """加载会话索引"""
-        index_file = os.path.join(self.memory_path, f"{session_id}_index.json")
-        if os.path.exists(index_file):
-            with open(index_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        else:
+        """加载会话索引的副本（优先取尚未落盘的最新索引，其次取mtime未变的缓存），修改副本不影响索引"""
+        return copy.deepcopy(self.peek_session_index(session_id))
+    
+    def peek_session_index(self, session_id: str) -> Dict[str, Any]:
+        """返回当前索引对象本身（不复制），调用方只能读取，不能修改"""
+        with self._lock:
+            if session_id in self._dirty:
+                return self._dirty[session_id]
+        index_file = self._index_file(session_id)
+        try:
+            stat = os.stat(index_file)
+        except FileNotFoundError:
             # 创建新索引
             return {
                 "session_id": session_id,
@@ -375,99 +2952,408 @@ class MemoryIndexManager:
                 "created_at": time.time(),
                 "last_updated": time.time()
             }
+        
+        cls = MemoryIndexManager
+        with cls._cache_lock:
+            cached = cls._cache.get(index_file)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                cls._cache.move_to_end(index_file)
+                cls._cache_hits += 1
+                PerfMetrics.cache_requests.inc(("memory_index", "hit"))
+                return cached[2]
+            cls._cache_misses += 1
+        PerfMetrics.cache_requests.inc(("memory_index", "miss"))
+        
+        started = time.perf_counter()
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index_data = json.load(f)
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("memory_index", "read"))
+        self._cache_put(index_file, stat, index_data)
+        return index_data
     
     def save_session_index(self, session_id: str, index_data: Dict[str, Any]):
-        """保存会话索引"""
-        index_data["last_updated"] = time.time()
-        index_file = os.path.join(self.memory_path, f"{session_id}_index.json")
-        with open(index_file, 'w', encoding='utf-8') as f:
-            json.dump(index_data, f, indent=2, ensure_ascii=False)
-    
-    def update_chunk_info(self, session_id: str, chunk_index: int, start: int, end: int, count: int):
-        """更新分片信息"""
-        index_data = self.load_session_index(session_id)
-        index_data["chunks"][str(chunk_index)] = {
-            "start": start,
-            "end": end, 
-            "count": count,
-            "updated_at": time.time()
-        }
-        index_data["total_messages"] = max(index_data["total_messages"], end)
-        self.save_session_index(session_id, index_data)
+        """保存会话索引（同时写入缓存）"""
+        with self._lock:
+            index_data["last_updated"] = time.time()
+            index_file = self._index_file(session_id)
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            started = time.perf_counter()
+            # 先写临时文件再替换，其他进程读取时不会读到写了一半的索引
+            tmp_file = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(index_data, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_file, index_file)
+            PerfMetrics.storage_io.observe(time.perf_counter() - started, ("memory_index", "write"))
+            self._cache_put(index_file, os.stat(index_file), copy.deepcopy(index_data))
+            self._dirty.pop(session_id, None)
+            self._dirty_counts.pop(session_id, None)
+    
+    def session_dir(self, session_id: str) -> str:
+        """会话数据所在目录：已有分目录或(分目录布局下)尚无平铺索引的会话使用 memory/<session_id>/"""
+        directory = self._session_dirs.get(session_id)
+        if directory is None:
+            sharded_dir = os.path.join(self.memory_path, session_id)
+            flat_index = os.path.join(self.memory_path, f"{session_id}_index.json")
+            if session_id not in self.RESERVED_DIRS and (
+                os.path.isdir(sharded_dir)
+                or (self.layout.is_sharded and not os.path.exists(flat_index))
+            ):
+                directory = sharded_dir
+            else:
+                directory = self.memory_path
+            self._session_dirs[session_id] = directory
+        return directory
+    
+    def chunks_dir(self, session_id: str) -> str:
+        """会话的分片目录"""
+        return os.path.join(self.session_dir(session_id), "chunks")
+    
+    def summaries_dir(self, session_id: str) -> str:
+        """会话的摘要目录"""
+        return os.path.join(self.session_dir(session_id), "summaries")
+    
+    def ensure_session_dirs(self, session_id: str):
+        """写入前确保会话目录存在"""
+        os.makedirs(self.chunks_dir(session_id), exist_ok=True)
+        os.makedirs(self.summaries_dir(session_id), exist_ok=True)
+    
+    def _index_file(self, session_id: str) -> str:
+        return os.path.abspath(os.path.join(self.session_dir(session_id), f"{session_id}_index.json"))
+    
+    @classmethod
+    def _cache_put(cls, index_file: str, stat: os.stat_result, index_data: Dict[str, Any]):
+        with cls._cache_lock:
+            cls._cache[index_file] = (stat.st_mtime_ns, stat.st_size, index_data)
+            cls._cache.move_to_end(index_file)
+            while len(cls._cache) > cls.CACHE_MAX_SESSIONS:
+                cls._cache.popitem(last=False)
+    
+    @classmethod
+    def get_cache_stats(cls) -> Dict[str, Any]:
+        """获取索引缓存命中统计"""
+        with cls._cache_lock:
+            total = cls._cache_hits + cls._cache_misses
+            return {
+                "hits": cls._cache_hits,
+                "misses": cls._cache_misses,
+                "hit_rate": round(cls._cache_hits / total, 4) if total else 0.0,
+                "cached_sessions": len(cls._cache),
+                "max_sessions": cls.CACHE_MAX_SESSIONS
+            }
+    
+    def flush(self, session_id: Optional[str] = None):
+        """将延迟写入的索引落盘，session_id为None时落盘全部会话"""
+        with self._lock:
+            session_ids = [session_id] if session_id else list(self._dirty.keys())
+            for sid in session_ids:
+                if sid in self._dirty:
+                    self.save_session_index(sid, self._dirty[sid])
+    
+    def _index_for_update(self, session_id: str) -> Dict[str, Any]:
+        """取得待修改的索引（调用方需持有self._lock）：未落盘的索引直接修改，缓存中的快照先复制"""
+        if session_id in self._dirty:
+            return self._dirty[session_id]
+        return copy.deepcopy(self.peek_session_index(session_id))
+    
+    def update_chunk_info(
+        self,
+        session_id: str,
+        chunk_index: int,
+        start: int,
+        end: int,
+        count: int,
+        defer: bool = False
+    ):
+        """更新分片信息
+        
+        Args:
+            defer: 是否延迟写入，为True时累计flush_every次更新后才落盘
+        """
+        with self._lock:
+            index_data = self._index_for_update(session_id)
+            index_data["chunks"][str(chunk_index)] = {
+                "start": start,
+                "end": end, 
+                "count": count,
+                "updated_at": time.time()
+            }
+            index_data["total_messages"] = max(index_data["total_messages"], end)
+            
+            if not defer:
+                self.save_session_index(session_id, index_data)
+                return
+            
+            self._dirty[session_id] = index_data
+            self._dirty_counts[session_id] = self._dirty_counts.get(session_id, 0) + 1
+            if self._dirty_counts[session_id] >= self.flush_every:
+                self.save_session_index(session_id, index_data)
+    
+    def list_dirty_sessions(self) -> List[str]:
+        """列出有未落盘索引的会话"""
+        with self._lock:
+            return list(self._dirty.keys())
     
     def update_summary_info(self, session_id: str, chunk_index: int, summary_file: str):
         """更新摘要信息"""
-        index_data = self.load_session_index(session_id)
-        index_data["summaries"][str(chunk_index)] = {
-            "file": summary_file,
-            "created_at": time.time()
-        }
-        self.save_session_index(session_id, index_data)
+        with self._lock:
+            index_data = self._index_for_update(session_id)
+            index_data["summaries"][str(chunk_index)] = {
+                "file": summary_file,
+                "created_at": time.time()
+            }
+            self.save_session_index(session_id, index_data)
+    
+    def update_summaries_info(self, session_id: str, summary_files: Dict[int, str]):
+        """批量更新摘要信息，只写一次索引"""
+        if not summary_files:
+            return
+        with self._lock:
+            index_data = self._index_for_update(session_id)
+            now = time.time()
+            for chunk_index, summary_file in summary_files.items():
+                index_data["summaries"][str(chunk_index)] = {
+                    "file": summary_file,
+                    "created_at": now
+                }
+            self.save_session_index(session_id, index_data)
     
     def get_chunk_info(self, session_id: str, chunk_index: int) -> Optional[Dict[str, Any]]:
         """获取分片信息"""
-        index_data = self.load_session_index(session_id)
-        return index_data["chunks"].get(str(chunk_index))
+        chunk_info = self.peek_session_index(session_id)["chunks"].get(str(chunk_index))
+        return dict(chunk_info) if chunk_info else None
     
     def list_available_chunks(self, session_id: str) -> List[int]:
         """列出可用的分片索引"""
-        index_data = self.load_session_index(session_id)
+        index_data = self.peek_session_index(session_id)
         return [int(k) for k in index_data["chunks"].keys()]
 
 class MemoryManager:
     """增强的记忆管理器 - 支持分片存储、索引和压缩"""
     
-    def __init__(self, memory_path: str = "./memory", chunk_size: int = 100):
+    FSYNC_POLICIES = ("always", "interval", "never")
+    
+    def __init__(
+        self,
+        memory_path: str = "./memory",
+        chunk_size: int = 100,
+        fsync_policy: str = "interval",
+        fsync_interval: float = 1.0,
+        index_flush_every: int = 20,
+        layout: Optional[StorageLayout] = None
+    ):
+        """
+        Args:
+            memory_path: 记忆存储目录
+            chunk_size: 分片大小（消息数量）
+            fsync_policy: 追加消息后的落盘策略 always(每条fsync) / interval(按间隔fsync) / never(交给系统)
+            fsync_interval: interval策略下两次fsync的最小间隔秒数
+            index_flush_every: 会话索引累计多少次更新后落盘一次
+            layout: 存储布局，默认按NOVEL_STORAGE_LAYOUT环境变量
+        """
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy: {fsync_policy}")
+        
         self.memory_path = memory_path
         self.chunk_size = chunk_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
         os.makedirs(self.memory_path, exist_ok=True)
 
         # 初始化子模块
         self.chunk_manager = MemoryChunkManager(chunk_size)
         self.compressor = MemoryCompressor()
-        self.index_manager = MemoryIndexManager(memory_path)
+        self.index_manager = MemoryIndexManager(memory_path, flush_every=index_flush_every, layout=layout)
+        
+        self._write_lock = threading.Lock()
+        self._last_fsync = 0.0
+        self._reconciled: set = set()
+        self._jsonl_chunks: set = set()
+        # 本实例最后一次追加后各分片文件的大小，大小不符说明有其他进程或实例写入过
+        self._chunk_sizes: Dict[str, int] = {}
+        # 本实例在各会话分配过的最大编号，索引落后于它说明被其他写入者用旧索引覆盖过
+        self._last_numbers: Dict[str, int] = {}
+        # 进程退出时落盘延迟写入的索引
+        flush_on_exit(self.index_manager)
     
     def save_message(self, session_id: str, message: Dict[str, Any]) -> int:
-        """保存单条消息，返回消息编号"""
-        # 加载会话索引
-        index_data = self.index_manager.load_session_index(session_id)
-        
-        # 计算新消息编号
-        message_number = index_data["total_messages"] + 1
-        chunk_index = self.chunk_manager.get_chunk_index(message_number)
-        
-        # 加载或创建分片
-        chunk_file = os.path.join(
-            self.index_manager.chunks_path,
-            self.chunk_manager.get_chunk_filename(session_id, chunk_index)
-        )
-        
-        if os.path.exists(chunk_file):
-            with open(chunk_file, 'r', encoding='utf-8') as f:
-                chunk_data = json.load(f)
-        else:
-            chunk_data = {"messages": []}
+        """保存单条消息，返回消息编号
+
+        分配编号与追加在会话锁文件的保护下进行，多个进程或实例写入同一会话时不会分到相同编号。
+        """
+        with Tracer.span("memory.save_message", root=False, session_id=session_id), self._write_lock, \
+                file_lock(self._session_lock_path(session_id)):
+            # 加载会话索引
+            index_data = self._load_index(session_id)
+            
+            # 计算新消息编号；目标分片被其他写入者改动过时先按分片文件重新核对索引
+            message_number = index_data["total_messages"] + 1
+            chunk_index = self.chunk_manager.get_chunk_index(message_number)
+            chunk_file = self._chunk_path(session_id, chunk_index)
+            if self._chunk_changed(chunk_file) or message_number <= self._last_numbers.get(session_id, 0):
+                self._reconcile_index(session_id)
+                message_number = self.index_manager.peek_session_index(session_id)["total_messages"] + 1
+                chunk_index = self.chunk_manager.get_chunk_index(message_number)
+            
+            # 旧版JSON分片先转换为JSONL再追加
+            chunk_file = self._ensure_jsonl_chunk(session_id, chunk_index)
+            
+            # 追加消息
+            message_with_meta = {
+                "number": message_number,
+                "timestamp": time.time(),
+                **message
+            }
+            self._append_line(chunk_file, message_with_meta)
+            self._chunk_sizes[chunk_file] = os.path.getsize(chunk_file)
+            self._last_numbers[session_id] = message_number
+            
+            # 更新索引（延迟落盘）
+            start, end = self.chunk_manager.get_chunk_range(chunk_index)
+            actual_end = min(end, message_number)
+            self.index_manager.update_chunk_info(
+                session_id, chunk_index, start, actual_end, message_number - start + 1, defer=True
+            )
         
-        # 添加消息
-        message_with_meta = {
-            "number": message_number,
-            "timestamp": time.time(),
-            **message
-        }
-        chunk_data["messages"].append(message_with_meta)
+        return message_number
+    
+    def flush(self, session_id: Optional[str] = None):
+        """将延迟写入的会话索引落盘"""
+        self.index_manager.flush(session_id)
+    
+    def _session_lock_path(self, session_id: str) -> str:
+        return os.path.join(self.index_manager.session_dir(session_id), f"{session_id}.lock")
+    
+    def _chunk_changed(self, chunk_file: str) -> bool:
+        """分片文件大小与本实例最后一次写入后的大小不同（本实例未写过时按空文件比较）"""
+        try:
+            size = os.path.getsize(chunk_file)
+        except FileNotFoundError:
+            size = 0
+        return size != self._chunk_sizes.get(chunk_file, 0)
+    
+    def _chunk_path(self, session_id: str, chunk_index: int, legacy: bool = False) -> str:
+        return os.path.join(
+            self.index_manager.chunks_dir(session_id),
+            self.chunk_manager.get_chunk_filename(session_id, chunk_index, legacy)
+        )
+    
+    def _append_line(self, chunk_file: str, record: Dict[str, Any]):
+        """向JSONL分片追加一行，按fsync策略落盘"""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        started = time.perf_counter()
+        with open(chunk_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+            if self.fsync_policy == "always" or (
+                self.fsync_policy == "interval"
+                and time.time() - self._last_fsync >= self.fsync_interval
+            ):
+                f.flush()
+                os.fsync(f.fileno())
+                self._last_fsync = time.time()
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("memory", "append"))
+    
+    def _ensure_jsonl_chunk(self, session_id: str, chunk_index: int) -> str:
+        """返回分片的JSONL路径，若只有旧版JSON分片则先转换"""
+        chunk_file = self._chunk_path(session_id, chunk_index)
+        key = (session_id, chunk_index)
+        if key not in self._jsonl_chunks:
+            self.index_manager.ensure_session_dirs(session_id)
+            if not os.path.exists(chunk_file):
+                self._convert_legacy_chunk(session_id, chunk_index)
+            self._jsonl_chunks.add(key)
+        return chunk_file
+    
+    def _convert_legacy_chunk(self, session_id: str, chunk_index: int) -> bool:
+        """将旧版 *_chunk_NNN.json 分片转换为JSONL格式"""
+        legacy_file = self._chunk_path(session_id, chunk_index, legacy=True)
+        if not os.path.exists(legacy_file):
+            return False
         
-        # 保存分片
-        with open(chunk_file, 'w', encoding='utf-8') as f:
-            json.dump(chunk_data, f, indent=2, ensure_ascii=False)
+        with open(legacy_file, 'r', encoding='utf-8') as f:
+            messages = json.load(f).get("messages", [])
         
-        # 更新索引
-        start, end = self.chunk_manager.get_chunk_range(chunk_index)
-        actual_end = min(end, message_number)
-        self.index_manager.update_chunk_info(
-            session_id, chunk_index, start, actual_end, len(chunk_data["messages"])
-        )
+        chunk_file = self._chunk_path(session_id, chunk_index)
+        tmp_file = chunk_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for msg in messages:
+                f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, chunk_file)
+        os.remove(legacy_file)
+        return True
+    
+    def migrate_legacy_chunks(self, session_id: Optional[str] = None) -> int:
+        """批量将旧版JSON分片转换为JSONL格式，返回转换的分片数"""
+        if session_id:
+            file_paths = glob.glob(os.path.join(self.index_manager.chunks_dir(session_id), f"{session_id}_chunk_*.json"))
+        else:
+            file_paths = glob.glob(os.path.join(self.index_manager.chunks_path, "*_chunk_*.json"))
+            file_paths += glob.glob(os.path.join(self.memory_path, "*", "chunks", "*_chunk_*.json"))
+        converted = 0
+        with self._write_lock:
+            for file_path in file_paths:
+                match = re.match(r'(.+)_chunk_(\d+)\.json$', os.path.basename(file_path))
+                if not match:
+                    continue
+                sid, chunk_index = match.group(1), int(match.group(2))
+                try:
+                    if os.path.exists(self._chunk_path(sid, chunk_index)):
+                        print(f"跳过分片 {sid}#{chunk_index}: JSONL分片已存在")
+                        continue
+                    if self._convert_legacy_chunk(sid, chunk_index):
+                        converted += 1
+                except Exception as e:
+                    print(f"转换分片失败 {file_path}: {e}")
+        return converted
+    
+    def _load_index(self, session_id: str) -> Dict[str, Any]:
+        """加载会话索引（只读，不复制），每个会话在本进程内首次访问时与分片文件核对"""
+        if session_id not in self._reconciled:
+            self._reconcile_index(session_id)
+            self._reconciled.add(session_id)
+        return self.index_manager.peek_session_index(session_id)
+    
+    def _reconcile_index(self, session_id: str):
+        """索引延迟落盘时进程可能异常退出，从最后一个已索引分片往后核对实际消息数"""
+        index_data = self.index_manager.peek_session_index(session_id)
+        chunk_keys = [int(k) for k in index_data["chunks"].keys()]
+        chunk_index = max(chunk_keys) if chunk_keys else 1
         
-        return message_number
+        while True:
+            chunk_file = self._chunk_path(session_id, chunk_index)
+            if not os.path.exists(chunk_file):
+                break
+            messages = self._read_jsonl(chunk_file)
+            if not messages:
+                break
+            start, end = self.chunk_manager.get_chunk_range(chunk_index)
+            last_number = max(msg.get("number", 0) for msg in messages)
+            recorded = index_data["chunks"].get(str(chunk_index), {}).get("end", 0)
+            if last_number > recorded:
+                self.index_manager.update_chunk_info(
+                    session_id, chunk_index, start, last_number, len(messages)
+                )
+            if last_number < end:
+                break
+            chunk_index += 1
+    
+    @staticmethod
+    def _read_jsonl(chunk_file: str) -> List[Dict[str, Any]]:
+        """读取JSONL分片，跳过写入中断导致的残缺行"""
+        messages = []
+        started = time.perf_counter()
+        with open(chunk_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"跳过损坏的消息行: {chunk_file}")
+        PerfMetrics.storage_io.observe(time.perf_counter() - started, ("memory", "read_chunk"))
+        return messages
     
     def load_messages_by_range(
         self,
@@ -493,7 +3379,7 @@ class MemoryManager:
             return self._load_compressed_summaries(session_id, start_msg, end_msg)
         
         # 获取会话总消息数
-        index_data = self.index_manager.load_session_index(session_id)
+        index_data = self._load_index(session_id)
         total_messages = index_data["total_messages"]
         
         if total_messages == 0:
@@ -511,9 +3397,10 @@ class MemoryManager:
         required_chunks = self.chunk_manager.calculate_required_chunks(start_msg, end_msg)
         
         all_messages = []
-        for chunk_index in required_chunks:
-            chunk_messages = self._load_chunk_messages(session_id, chunk_index, start_msg, end_msg)
-            all_messages.extend(chunk_messages)
+        with Tracer.span("memory.load_messages", root=False, session_id=session_id, chunks=len(required_chunks)):
+            for chunk_index in required_chunks:
+                chunk_messages = self._load_chunk_messages(session_id, chunk_index, start_msg, end_msg)
+                all_messages.extend(chunk_messages)
         
         # 可选实时压缩
         if use_compression and all_messages:
@@ -537,7 +3424,7 @@ class MemoryManager:
         end_msg: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """加载已压缩的记忆摘要"""
-        index_data = self.index_manager.load_session_index(session_id)
+        index_data = self._load_index(session_id)
         summaries = index_data.get("summaries", {})
         
         if not summaries:
@@ -558,7 +3445,7 @@ class MemoryManager:
             if str(chunk_index) in summaries:
                 summary_info = summaries[str(chunk_index)]
                 summary_file = summary_info["file"]
-                summary_path = os.path.join(self.index_manager.summaries_path, summary_file)
+                summary_path = os.path.join(self.index_manager.summaries_dir(session_id), summary_file)
                 
                 if os.path.exists(summary_path):
                     try:
@@ -596,7 +3483,7 @@ class MemoryManager:
             compression_model: 压缩模型
             read_compressed: 是否读取已压缩的记忆
         """
-        index_data = self.index_manager.load_session_index(session_id)
+        index_data = self._load_index(session_id)
         total_messages = index_data["total_messages"]
         
         if total_messages == 0:
@@ -624,22 +3511,12 @@ class MemoryManager:
             # 执行压缩
             compressed_summary = self.compressor.compress_messages(
                 chunk_messages, model_name, compression_prompt
-            )
-            
-            # 保存压缩结果
-            summary_file = f"{session_id}_summary_{chunk_index:03d}.json"
-            summary_path = os.path.join(self.index_manager.summaries_path, summary_file)
-            
-            summary_data = {
-                "chunk_index": chunk_index,
-                "original_count": len(chunk_messages),
-                "compressed_summary": compressed_summary,
-                "compression_model": model_name,
-                "created_at": time.time()
-            }
+            )
             
-            with open(summary_path, 'w', encoding='utf-8') as f:
-                json.dump(summary_data, f, indent=2, ensure_ascii=False)
+            # 保存压缩结果
+            summary_file = self._write_summary(
+                session_id, chunk_index, chunk_messages, compressed_summary, model_name
+            )
             
             # 更新索引
             self.index_manager.update_summary_info(session_id, chunk_index, summary_file)
@@ -655,15 +3532,107 @@ class MemoryManager:
         session_id: str,
         chunk_indices: List[int],
         model_name: str = "deepseek_chat",
-        compression_prompt: str = ""
+        compression_prompt: str = "",
+        max_workers: int = 4,
+        progress_callback: Optional[Callable[[int, int, int, bool], None]] = None
     ) -> Dict[int, bool]:
-        """批量压缩分片"""
-        results = {}
-        for chunk_index in chunk_indices:
-            results[chunk_index] = self.compress_chunk(
-                session_id, chunk_index, model_name, compression_prompt
-            )
-        return results
+        """批量压缩分片（并发执行）
+        
+        Args:
+            session_id: 会话ID
+            chunk_indices: 要压缩的分片索引列表
+            model_name: 压缩使用的模型
+            compression_prompt: 压缩提示词
+            max_workers: 最大并发压缩数
+            progress_callback: 进度回调 (已完成数, 总数, 分片索引, 是否成功)
+        """
+        return run_coroutine_sync(self.abatch_compress_chunks(
+            session_id, chunk_indices, model_name, compression_prompt,
+            max_workers, progress_callback
+        ))
+    
+    async def abatch_compress_chunks(
+        self,
+        session_id: str,
+        chunk_indices: List[int],
+        model_name: str = "deepseek_chat",
+        compression_prompt: str = "",
+        max_workers: int = 4,
+        progress_callback: Optional[Callable[[int, int, int, bool], None]] = None
+    ) -> Dict[int, bool]:
+        """批量压缩分片的异步版本，受模型rpm/tpm预算限制，结束时统一写一次索引"""
+        results: Dict[int, bool] = {}
+        summary_files: Dict[int, str] = {}
+        total = len(chunk_indices)
+        workers = asyncio.Semaphore(max(1, max_workers))
+        limiter = RateLimiter.for_model(model_name)
+        
+        async def compress_one(chunk_index: int):
+            async with workers:
+                try:
+                    chunk_messages = await asyncio.to_thread(
+                        self._load_chunk_messages, session_id, chunk_index
+                    )
+                    if not chunk_messages:
+                        results[chunk_index] = False
+                    else:
+                        request_messages = self.compressor._build_compression_messages(
+                            chunk_messages, compression_prompt
+                        )
+                        # tpm按输入加预期输出计算，只算输入会让实际用量超出预算
+                        await limiter.await_capacity(
+                            sum(estimate_tokens(m["content"]) for m in request_messages)
+                            + self.compressor.EXPECTED_OUTPUT_TOKENS
+                        )
+                        compressed_summary = await self.compressor.acompress_messages(
+                            chunk_messages, model_name, compression_prompt
+                        )
+                        summary_files[chunk_index] = await asyncio.to_thread(
+                            self._write_summary, session_id, chunk_index,
+                            chunk_messages, compressed_summary, model_name
+                        )
+                        results[chunk_index] = True
+                except Exception as e:
+                    print(f"压缩分片{chunk_index}失败: {e}")
+                    results[chunk_index] = False
+                
+                if progress_callback:
+                    progress_callback(len(results), total, chunk_index, results[chunk_index])
+                else:
+                    print(f"压缩进度: {len(results)}/{total} (分片{chunk_index}{'成功' if results[chunk_index] else '失败'})")
+        
+        await asyncio.gather(*(compress_one(chunk_index) for chunk_index in chunk_indices))
+        
+        # 统一更新索引
+        self.index_manager.update_summaries_info(session_id, summary_files)
+        
+        return {chunk_index: results[chunk_index] for chunk_index in chunk_indices}
+    
+    def _write_summary(
+        self,
+        session_id: str,
+        chunk_index: int,
+        chunk_messages: List[Dict[str, Any]],
+        compressed_summary: str,
+        model_name: str
+    ) -> str:
+        """保存分片压缩结果，返回摘要文件名"""
+        summary_file = f"{session_id}_summary_{chunk_index:03d}.json"
+        self.index_manager.ensure_session_dirs(session_id)
+        summary_path = os.path.join(self.index_manager.summaries_dir(session_id), summary_file)
+        
+        summary_data = {
+            "chunk_index": chunk_index,
+            "original_count": len(chunk_messages),
+            "compressed_summary": compressed_summary,
+            "compression_model": model_name,
+            "created_at": time.time()
+        }
+        
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(summary_data, f, indent=2, ensure_ascii=False)
+        
+        return summary_file
     
     def _load_chunk_messages(
         self,
@@ -672,20 +3641,19 @@ class MemoryManager:
         start_filter: Optional[int] = None,
         end_filter: Optional[int] = None
     ) -> List[Dict[str, Any]]:
-        """加载分片中的消息"""
-        chunk_file = os.path.join(
-            self.index_manager.chunks_path,
-            self.chunk_manager.get_chunk_filename(session_id, chunk_index)
-        )
-        
-        if not os.path.exists(chunk_file):
-            return []
+        """加载分片中的消息（兼容旧版JSON分片）"""
+        chunk_file = self._chunk_path(session_id, chunk_index)
+        legacy_file = self._chunk_path(session_id, chunk_index, legacy=True)
         
         try:
-            with open(chunk_file, 'r', encoding='utf-8') as f:
-                chunk_data = json.load(f)
-            
-            messages = chunk_data.get("messages", [])
+            if os.path.exists(chunk_file):
+                messages = self._read_jsonl(chunk_file)
+            elif os.path.exists(legacy_file):
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    chunk_data = json.load(f)
+                messages = chunk_data.get("messages", [])
+            else:
+                return []
             
             # 应用范围过滤
             if start_filter is not None or end_filter is not None:
@@ -707,7 +3675,7 @@ class MemoryManager:
     
     def get_session_stats(self, session_id: str) -> Dict[str, Any]:
         """获取会话统计信息"""
-        index_data = self.index_manager.load_session_index(session_id)
+        index_data = self._load_index(session_id)
         available_chunks = self.index_manager.list_available_chunks(session_id)
 
         return {
@@ -717,111 +3685,1211 @@ class MemoryManager:
             "compressed_chunks": len(index_data["summaries"]),
             "chunk_size": self.chunk_size,
             "created_at": index_data["created_at"],
-            "last_updated": index_data["last_updated"]
+            "last_updated": index_data["last_updated"],
+            "index_cache": self.index_manager.get_cache_stats()
         }
     
     def list_sessions(self) -> List[str]:
         """列出所有会话"""
         index_files = glob.glob(os.path.join(self.memory_path, "*_index.json"))
+        index_files += glob.glob(os.path.join(self.memory_path, "*", "*_index.json"))
         sessions = []
         for file_path in index_files:
             filename = os.path.basename(file_path)
             session_id = filename.replace("_index.json", "")
-            sessions.append(session_id)
+            if session_id not in sessions:
+                sessions.append(session_id)
+        # 包含索引尚未落盘的新会话
+        for session_id in self.index_manager.list_dirty_sessions():
+            if session_id not in sessions:
+                sessions.append(session_id)
         return sessions
 
 # === 记忆管理器 ===
 # 重命名EnhancedMemoryManager为MemoryManager，统一记忆管理接口
 
 # === 小说生成器 ===
+class ChapterSummaryStore:
+    """章节摘要存储 - 每章一个摘要文件，按章节内容哈希判断是否过期
+
+    章节保存后在后台线程生成摘要；组装提示词时缺失或过期的摘要并发补齐。
+    """
+
+    SUMMARY_PROMPT = """请概括以下小说章节，200字以内，保留主要情节、人物状态变化、获得或失去的物品以及埋下的伏笔，只输出摘要：
+
+{content}"""
+    # 摘要不需要多样性，使用temperature 0：LLM_CACHE开启时同一章节内容可命中响应缓存
+    TEMPERATURE = 0.0
+
+    def __init__(
+        self,
+        chapter_path: Callable[[int, Optional[str]], str],
+        summaries_path: str = "./chapter_summaries",
+        layout: Optional[StorageLayout] = None,
+        max_workers: int = 2
+    ):
+        """
+        Args:
+            chapter_path: 根据(章节编号, 小说ID)返回章节文件路径
+            summaries_path: 摘要存储目录
+            layout: 存储布局，默认按NOVEL_STORAGE_LAYOUT环境变量
+            max_workers: 后台生成摘要的线程数
+        """
+        self.chapter_path = chapter_path
+        self.summaries_path = summaries_path
+        self.layout = layout or StorageLayout()
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # 排队或执行中的章节: (小说ID, 章节编号) -> {"hash": 提交时的内容哈希, "running": bool, "rerun": 模型名或None}
+        self._inflight: Dict[tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.strip().encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def summary_filename(chapter_index: int, novel_id: Optional[str] = None) -> str:
+        if novel_id:
+            return f"{novel_id}_chapter_{chapter_index:03d}_summary.json"
+        return f"chapter_{chapter_index:03d}_summary.json"
+
+    def _read_chapter(self, chapter_index: int, novel_id: Optional[str]) -> Optional[str]:
+        file_path = self.chapter_path(chapter_index, novel_id)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+
+    def load_summary(self, chapter_index: int, novel_id: Optional[str], content: Optional[str] = None) -> Optional[str]:
+        """读取章节摘要，摘要不存在或与章节内容不一致时返回None"""
+        if content is None:
+            content = self._read_chapter(chapter_index, novel_id)
+            if content is None:
+                return None
+        file_path = self.layout.read_path(self.summaries_path, novel_id, self.summary_filename(chapter_index, novel_id))
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if data.get("content_hash") != self.content_hash(content):
+            return None
+        return data.get("summary")
+
+    def _save_summary(self, chapter_index: int, novel_id: Optional[str], content: str, summary: str, model_name: str):
+        os.makedirs(self.summaries_path, exist_ok=True)
+        file_path = self.layout.resolve_path(self.summaries_path, novel_id, self.summary_filename(chapter_index, novel_id))
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "novel_id": novel_id,
+                "chapter_index": chapter_index,
+                "content_hash": self.content_hash(content),
+                "summary": summary.strip(),
+                "model_name": model_name,
+                "created_at": time.time()
+            }, f, ensure_ascii=False, indent=2)
+
+    def _build_messages(self, content: str) -> List[Dict[str, str]]:
+        return [{"role": "user", "content": self.SUMMARY_PROMPT.format(content=content)}]
+
+    def ensure_summary(self, chapter_index: int, novel_id: Optional[str], model_name: str = "deepseek_chat") -> Optional[str]:
+        """返回最新的章节摘要，缺失或过期时调用LLM生成"""
+        content = self._read_chapter(chapter_index, novel_id)
+        if not content:
+            return None
+        summary = self.load_summary(chapter_index, novel_id, content)
+        if summary is not None:
+            return summary
+        with LLMCallLog.context(purpose="chapter_summary", novel_id=novel_id, chapter_index=chapter_index):
+            summary = LLMCaller.call(self._build_messages(content), model_name, temperature=self.TEMPERATURE)
+        self._save_summary(chapter_index, novel_id, content, summary, model_name)
+        return summary.strip()
+
+    def schedule(
+        self,
+        chapter_index: int,
+        novel_id: Optional[str],
+        model_name: str = "deepseek_chat",
+        content: Optional[str] = None
+    ):
+        """在后台生成章节摘要
+
+        已有与内容一致的摘要、或同一内容已在排队/生成中时不提交；生成中的章节内容又发生变化时，
+        当前生成结束后再补一次（届时按最新内容判断是否需要）。
+        """
+        if content is None:
+            content = self._read_chapter(chapter_index, novel_id)
+        if not content:
+            return
+        digest = self.content_hash(content)
+        if self.load_summary(chapter_index, novel_id, content) is not None:
+            return
+        
+        key = (novel_id, chapter_index)
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None:
+                if not entry["running"]:
+                    # 尚未开始执行，执行时会读取最新内容
+                    entry["hash"] = digest
+                elif entry["hash"] != digest:
+                    entry["rerun"] = model_name
+                return
+            self._inflight[key] = {"hash": digest, "running": False, "rerun": None}
+            self._submit_locked(key, model_name)
+
+    def _submit_locked(self, key: tuple, model_name: str):
+        self._executor = executor_for_process(self._executor, self.max_workers, "chapter-summary")
+        self._executor.submit(self._run_scheduled, key, model_name)
+
+    def wait_all(self):
+        """等待已提交的后台摘要全部完成"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _run_scheduled(self, key: tuple, model_name: str):
+        novel_id, chapter_index = key
+        with self._lock:
+            self._inflight[key]["running"] = True
+        try:
+            self.ensure_summary(chapter_index, novel_id, model_name)
+        except Exception as e:
+            print(f"生成第{chapter_index}章摘要失败: {e}")
+        finally:
+            with self._lock:
+                entry = self._inflight[key]
+                if entry["rerun"]:
+                    model_name = entry["rerun"]
+                    entry.update(running=False, rerun=None)
+                    self._submit_locked(key, model_name)
+                else:
+                    del self._inflight[key]
+
+    def load_summaries(
+        self,
+        chapter_indexes: List[int],
+        novel_id: Optional[str],
+        model_name: str = "deepseek_chat",
+        max_concurrency: int = 4
+    ) -> Dict[int, str]:
+        """读取多章摘要，缺失或过期的并发生成；生成失败的章节不包含在结果中"""
+        summaries = {}
+        missing = {}
+        for chapter_index in chapter_indexes:
+            content = self._read_chapter(chapter_index, novel_id)
+            if not content:
+                continue
+            summary = self.load_summary(chapter_index, novel_id, content)
+            if summary is None:
+                missing[chapter_index] = content
+            else:
+                summaries[chapter_index] = summary
+        
+        if missing:
+            print(f"补齐 {len(missing)} 章摘要...")
+            summaries.update(run_coroutine_sync(self._agenerate(missing, novel_id, model_name, max_concurrency)))
+        return summaries
+
+    async def _agenerate(
+        self,
+        contents: Dict[int, str],
+        novel_id: Optional[str],
+        model_name: str,
+        max_concurrency: int
+    ) -> Dict[int, str]:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def generate(chapter_index, content):
+            async with semaphore:
+                try:
+                    with LLMCallLog.context(purpose="chapter_summary", novel_id=novel_id, chapter_index=chapter_index):
+                        summary = await LLMCaller.acall(self._build_messages(content), model_name, temperature=self.TEMPERATURE)
+                except Exception as e:
+                    print(f"生成第{chapter_index}章摘要失败: {e}")
+                    return chapter_index, None
+            self._save_summary(chapter_index, novel_id, content, summary, model_name)
+            return chapter_index, summary.strip()
+        
+        results = await asyncio.gather(*(generate(i, c) for i, c in contents.items()))
+        return {chapter_index: summary for chapter_index, summary in results if summary}
+
+class ChapterRetrievalIndex:
+    """章节检索索引 - 基于中文二元组/英文单词的BM25倒排索引
+
+    章节按段落切分为约400字的片段建立倒排表，保存章节时增量更新；被替换章节的旧片段
+    只做删除标记，删除片段多于有效片段时整体压缩。索引快照按更新次数延迟写入磁盘，
+    加载时按章节文件的大小与修改时间校验，只重建变化的章节。
+    """
+
+    TOKEN_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]+|[A-Za-z0-9]+')
+    PASSAGE_CHARS = 400
+    K1 = 1.2
+    B = 0.75
+    # 查询时只使用IDF最高的若干个词，并忽略出现在一半以上片段中的常见词
+    MAX_QUERY_TERMS = 48
+    MAX_DF_RATIO = 0.5
+
+    def __init__(
+        self,
+        list_chapters: Callable[[str], List[int]],
+        chapter_path: Callable[[int, Optional[str]], str],
+        index_path: str = "./retrieval_index",
+        layout: Optional[StorageLayout] = None,
+        flush_every: int = 200
+    ):
+        """
+        Args:
+            list_chapters: 根据小说ID返回已保存的章节编号
+            chapter_path: 根据(章节编号, 小说ID)返回章节文件路径
+            index_path: 索引快照存储目录
+            layout: 存储布局，默认按NOVEL_STORAGE_LAYOUT环境变量
+            flush_every: 小说索引累计多少次章节更新后写一次快照（进程退出时也会写入；
+                快照落后时加载只需重建变化的章节，因此间隔可以较大）
+        """
+        self.list_chapters = list_chapters
+        self.chapter_path = chapter_path
+        self.index_path = index_path
+        self.layout = layout or StorageLayout()
+        self.flush_every = flush_every
+        self._novels: Dict[str, Dict[str, Any]] = {}
+        self._dirty_counts: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        flush_on_exit(self)
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """中日韩文字切分为相邻二元组（单字成段时保留单字），字母数字按单词小写"""
+        tokens = []
+        for run in cls.TOKEN_RE.findall(text):
+            if run[0].isascii():
+                tokens.append(run.lower())
+            elif len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        return tokens
+
+    @classmethod
+    def split_passages(cls, content: str) -> List[tuple]:
+        """按段落合并为约PASSAGE_CHARS字的片段，返回(起始, 结束)偏移"""
+        spans = []
+        start = None
+        for match in re.finditer(r'[^\n]+', content):
+            if not match.group().strip():
+                continue
+            if start is None:
+                start = match.start()
+            if match.end() - start >= cls.PASSAGE_CHARS:
+                spans.append((start, match.end()))
+                start = None
+        if start is not None:
+            spans.append((start, len(content.rstrip())))
+        
+        # 超长段落再按固定长度切分
+        passages = []
+        for start, end in spans:
+            while end - start > cls.PASSAGE_CHARS * 2:
+                passages.append((start, start + cls.PASSAGE_CHARS))
+                start += cls.PASSAGE_CHARS
+            passages.append((start, end))
+        return passages
+
+    def _snapshot_file(self, novel_id: str, for_write: bool = False) -> str:
+        filename = f"{novel_id}_retrieval.json"
+        if for_write:
+            os.makedirs(self.index_path, exist_ok=True)
+            return self.layout.resolve_path(self.index_path, novel_id, filename)
+        return self.layout.read_path(self.index_path, novel_id, filename)
+
+    @staticmethod
+    def _empty_index() -> Dict[str, Any]:
+        # passages[pid] = [章节编号, 起始偏移, 结束偏移, 词数]，已删除为None
+        # postings[term] = [pid, tf, pid, tf, ...]
+        return {"chapters": {}, "passages": [], "postings": {}, "live": 0, "total_length": 0}
+
+    def _chapter_signature(self, chapter_index: int, novel_id: str) -> Optional[List[int]]:
+        try:
+            stat = os.stat(self.chapter_path(chapter_index, novel_id))
+        except FileNotFoundError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def _load_locked(self, novel_id: str) -> Dict[str, Any]:
+        """加载小说索引：读取快照并校验章节，只重建新增或变化的章节"""
+        index = self._novels.get(novel_id)
+        if index is not None:
+            return index
+        
+        index = self._empty_index()
+        snapshot_file = self._snapshot_file(novel_id)
+        if os.path.exists(snapshot_file):
+            try:
+                with open(snapshot_file, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"检索索引快照损坏，重新构建: {e}")
+        self._novels[novel_id] = index
+        
+        on_disk = set(self.list_chapters(novel_id))
+        changed = 0
+        for chapter_key in list(index["chapters"]):
+            if int(chapter_key) not in on_disk:
+                self._remove_chapter_locked(index, chapter_key)
+                changed += 1
+        for chapter_index in sorted(on_disk):
+            if self._refresh_chapter_locked(index, novel_id, chapter_index):
+                changed += 1
+        if changed:
+            self._mark_dirty_locked(novel_id, changed)
+        return index
+
+    def _remove_chapter_locked(self, index: Dict[str, Any], chapter_key: str):
+        entry = index["chapters"].pop(chapter_key, None)
+        if not entry:
+            return
+        for pid in entry["passages"]:
+            passage = index["passages"][pid]
+            if passage is not None:
+                index["passages"][pid] = None
+                index["live"] -= 1
+                index["total_length"] -= passage[3]
+
+    def _refresh_chapter_locked(self, index: Dict[str, Any], novel_id: str, chapter_index: int) -> bool:
+        """章节文件有变化时重建该章片段，返回是否更新"""
+        chapter_key = str(chapter_index)
+        signature = self._chapter_signature(chapter_index, novel_id)
+        entry = index["chapters"].get(chapter_key)
+        if signature is None:
+            if entry:
+                self._remove_chapter_locked(index, chapter_key)
+                return True
+            return False
+        if entry and entry["sig"] == signature:
+            return False
+        
+        with open(self.chapter_path(chapter_index, novel_id), 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        self._remove_chapter_locked(index, chapter_key)
+        passage_ids = []
+        for start, end in self.split_passages(content):
+            tokens = self.tokenize(content[start:end])
+            if not tokens:
+                continue
+            pid = len(index["passages"])
+            index["passages"].append([chapter_index, start, end, len(tokens)])
+            for term, tf in Counter(tokens).items():
+                index["postings"].setdefault(term, []).extend((pid, tf))
+            passage_ids.append(pid)
+            index["live"] += 1
+            index["total_length"] += len(tokens)
+        index["chapters"][chapter_key] = {"sig": signature, "passages": passage_ids}
+        
+        dead = len(index["passages"]) - index["live"]
+        if dead > index["live"] and dead > 1000:
+            self._compact_locked(index)
+        return True
+
+    def _compact_locked(self, index: Dict[str, Any]):
+        """清除已删除的片段并重新编号"""
+        remap = {}
+        passages = []
+        for pid, passage in enumerate(index["passages"]):
+            if passage is not None:
+                remap[pid] = len(passages)
+                passages.append(passage)
+        postings = {}
+        for term, plist in index["postings"].items():
+            compacted = []
+            for i in range(0, len(plist), 2):
+                new_pid = remap.get(plist[i])
+                if new_pid is not None:
+                    compacted.extend((new_pid, plist[i + 1]))
+            if compacted:
+                postings[term] = compacted
+        for entry in index["chapters"].values():
+            entry["passages"] = [remap[pid] for pid in entry["passages"]]
+        index["passages"] = passages
+        index["postings"] = postings
+
+    def _mark_dirty_locked(self, novel_id: str, count: int = 1):
+        self._dirty_counts[novel_id] = self._dirty_counts.get(novel_id, 0) + count
+        if self._dirty_counts[novel_id] >= self.flush_every:
+            self.flush(novel_id)
+
+    def update_chapter(self, chapter_index: int, novel_id: Optional[str]):
+        """章节保存后增量更新索引；索引尚未加载时无需处理，加载时会校验到变化"""
+        if not novel_id:
+            return
+        with self._lock:
+            index = self._novels.get(novel_id)
+            if index is not None and self._refresh_chapter_locked(index, novel_id, chapter_index):
+                self._mark_dirty_locked(novel_id)
+
+    def flush(self, novel_id: Optional[str] = None):
+        """将有更新的小说索引写入快照"""
+        with self._lock:
+            novel_ids = [novel_id] if novel_id else list(self._dirty_counts)
+            for dirty_id in novel_ids:
+                if not self._dirty_counts.pop(dirty_id, 0) or dirty_id not in self._novels:
+                    continue
+                snapshot_file = self._snapshot_file(dirty_id, for_write=True)
+                tmp_file = snapshot_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self._novels[dirty_id], f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_file, snapshot_file)
+
+    def search(
+        self,
+        novel_id: str,
+        query: str,
+        max_chars: int = 3000,
+        before_chapter: Optional[int] = None,
+        exclude_chapters: Optional[set] = None,
+        top_k: int = 20
+    ) -> List[Dict[str, Any]]:
+        """检索与查询最相关的片段
+
+        Args:
+            novel_id: 小说ID
+            query: 查询文本（如章节细纲）
+            max_chars: 返回片段的总字数上限
+            before_chapter: 只检索该章之前的章节
+            exclude_chapters: 排除的章节（如已整章注入的前文）
+            top_k: 最多返回的片段数
+
+        Returns:
+            按章节顺序排列的片段列表，包含chapter_index、text、score
+        """
+        exclude_chapters = exclude_chapters or set()
+        with self._lock:
+            index = self._load_locked(novel_id)
+            total = index["live"]
+            if total == 0:
+                return []
+            avg_length = index["total_length"] / total
+            passages = index["passages"]
+            
+            # 选出区分度最高的查询词
+            weighted_terms = []
+            for term in set(self.tokenize(query)):
+                plist = index["postings"].get(term)
+                if not plist:
+                    continue
+                df = len(plist) // 2
+                if df > total * self.MAX_DF_RATIO:
+                    continue
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                weighted_terms.append((idf, plist))
+            weighted_terms = heapq.nlargest(self.MAX_QUERY_TERMS, weighted_terms, key=lambda item: item[0])
+            
+            scores: Dict[int, float] = {}
+            k1, b = self.K1, self.B
+            for idf, plist in weighted_terms:
+                for i in range(0, len(plist), 2):
+                    pid = plist[i]
+                    passage = passages[pid]
+                    if passage is None:
+                        continue
+                    chapter_index = passage[0]
+                    if (before_chapter is not None and chapter_index >= before_chapter) or chapter_index in exclude_chapters:
+                        continue
+                    tf = plist[i + 1]
+                    scores[pid] = scores.get(pid, 0.0) + idf * tf * (k1 + 1) / (
+                        tf + k1 * (1 - b + b * passage[3] / avg_length)
+                    )
+            top = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            hits = [(passages[pid], score) for pid, score in top]
+        
+        # 在锁外读取片段文本，按得分依次选取直到达到字数上限
+        results = []
+        remaining = max_chars
+        contents: Dict[int, str] = {}
+        for (chapter_index, start, end, _), score in hits:
+            if remaining <= 0:
+                break
+            if chapter_index not in contents:
+                try:
+                    with open(self.chapter_path(chapter_index, novel_id), 'r', encoding='utf-8') as f:
+                        contents[chapter_index] = f.read()
+                except OSError:
+                    contents[chapter_index] = ""
+            text = contents[chapter_index][start:end].strip()
+            if not text:
+                continue
+            if len(text) > remaining:
+                # 剩余额度太少时不再截取零碎片段
+                if remaining < 100:
+                    break
+                text = text[:remaining]
+            remaining -= len(text)
+            results.append({"chapter_index": chapter_index, "start": start, "text": text, "score": round(score, 4)})
+        
+        results.sort(key=lambda item: (item["chapter_index"], item["start"]))
+        return results
+
+class StateUpdatePipeline:
+    """后台状态更新流水线
+
+    章节生成完成后把状态更新提交到独立线程池，章节结果立即返回。同一部小说的更新严格按
+    提交顺序串行执行（每次基于上一次更新后的最新状态），不同小说之间并行。
+    需要使用该小说状态的下一次生成通过wait_for_novel等待其更新完成。
+    """
+
+    def __init__(self, run_update: Callable[[Dict[str, Any]], str], max_workers: int = 4, history_size: int = 500):
+        """
+        Args:
+            run_update: 执行一次状态更新，接收任务记录，返回结果状态 "succeeded" / "unchanged"
+            max_workers: 并行处理不同小说的线程数
+            history_size: 保留的已结束任务记录数
+        """
+        self.run_update = run_update
+        self.max_workers = max_workers
+        self.history_size = history_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._queues: Dict[str, List[Dict[str, Any]]] = {}
+        self._active: set = set()
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _novel_key(novel_id: Optional[str]) -> str:
+        return novel_id or ""
+
+    def submit(self, **params) -> Dict[str, Any]:
+        """提交状态更新任务，params原样传给run_update（需包含novel_id）"""
+        task = {
+            "task_id": uuid.uuid4().hex,
+            "novel_id": params.get("novel_id"),
+            "chapter_index": params.get("chapter_index"),
+            "status": "queued",
+            "error": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "trace_id": Tracer.current_trace_id(),
+            "params": params,
+            # 在提交方的上下文中执行，使后台更新的追踪与调用记录归入本次生成
+            "context": contextvars.copy_context()
+        }
+        key = self._novel_key(task["novel_id"])
+        with self._cond:
+            self._tasks[task["task_id"]] = task
+            self._queues.setdefault(key, []).append(task)
+            if key not in self._active:
+                self._start_next_locked(key)
+            self._trim_history_locked()
+        return self._public(task)
+
+    def _start_next_locked(self, key: str):
+        queue = self._queues.get(key)
+        if not queue:
+            self._queues.pop(key, None)
+            self._active.discard(key)
+            return
+        task = queue.pop(0)
+        self._active.add(key)
+        self._executor = executor_for_process(self._executor, self.max_workers, "state-update")
+        self._executor.submit(self._run, key, task)
+
+    def _run(self, key: str, task: Dict[str, Any]):
+        with self._cond:
+            task["status"] = "running"
+            task["started_at"] = time.time()
+        try:
+            status, error = task["context"].run(self.run_update, task["params"]), None
+        except Exception as e:
+            print(f"后台状态更新失败: {e}")
+            status, error = "failed", str(e)
+        with self._cond:
+            task["status"] = status
+            task["error"] = error
+            task["finished_at"] = time.time()
+            # 释放章节正文，只保留任务元数据
+            task["params"] = {}
+            task["context"] = None
+            self._start_next_locked(key)
+            self._cond.notify_all()
+
+    def _trim_history_locked(self):
+        while len(self._tasks) > self.history_size:
+            oldest_id, oldest = next(iter(self._tasks.items()))
+            if oldest["finished_at"] is None:
+                break
+            self._tasks.pop(oldest_id)
+
+    def is_pending(self, novel_id: Optional[str]) -> bool:
+        key = self._novel_key(novel_id)
+        with self._cond:
+            return key in self._active or bool(self._queues.get(key))
+
+    def wait_for_novel(self, novel_id: Optional[str], timeout: Optional[float] = None) -> bool:
+        """等待小说所有已提交的状态更新完成，超时返回False"""
+        key = self._novel_key(novel_id)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while key in self._active or self._queues.get(key):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def wait_all(self, timeout: Optional[float] = None) -> bool:
+        """等待所有状态更新完成，超时返回False"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._active:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    @staticmethod
+    def _public(task: Dict[str, Any]) -> Dict[str, Any]:
+        result = {k: v for k, v in task.items() if k not in ("params", "context")}
+        if task["finished_at"] and task["started_at"]:
+            result["duration"] = round(task["finished_at"] - task["started_at"], 3)
+        return result
+
+    def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            task = self._tasks.get(task_id)
+            return self._public(task) if task else None
+
+    def get_status(self, novel_id: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """最近的状态更新任务及排队/执行数量"""
+        with self._cond:
+            tasks = [
+                self._public(task) for task in reversed(self._tasks.values())
+                if novel_id is None or task["novel_id"] == novel_id
+            ][:limit]
+            return {
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "running": len(self._active),
+                "tasks": tasks
+            }
+
 class NovelGenerator:
-    def __init__(self, chunk_size: int = 100):
-        self.state_manager = StateManager()
-        self.memory_manager = MemoryManager(chunk_size=chunk_size)
+    CHAPTER_FILE_RE = re.compile(r'_chapter_(\d+)\.txt$')
+    PROMPT_LAYOUTS = ("default", "stable_prefix")
+    # stable_prefix布局中世界设定之后的部分顺序
+    STABLE_PREFIX_ORDER = ("chapter_summaries", "state", "previous_chapters", "retrieved_passages", "outline")
+
+    def __init__(
+        self,
+        chunk_size: int = 100,
+        storage_layout: Optional[str] = None,
+        auto_summarize: Optional[bool] = None,
+        background_state_update: Optional[bool] = None
+    ):
+        """
+        Args:
+            chunk_size: 记忆分片大小（消息数量）
+            storage_layout: 存储布局 flat / sharded，默认按NOVEL_STORAGE_LAYOUT环境变量
+            auto_summarize: 保存章节后是否在后台生成章节摘要，默认按CHAPTER_SUMMARY_AUTO环境变量（默认关闭，
+                分层前文模式会在组装提示词时按需补齐摘要）
+            background_state_update: 生成后的状态更新是否在后台执行，默认按STATE_UPDATE_BACKGROUND环境变量（默认开启）
+        """
+        self.layout = StorageLayout(storage_layout)
+        self.state_manager = StateManager(layout=self.layout)
+        self.memory_manager = MemoryManager(chunk_size=chunk_size, layout=self.layout)
+        self.chapter_summaries = ChapterSummaryStore(self.chapter_file_path, layout=self.layout)
+        self.retrieval_index = ChapterRetrievalIndex(
+            self.list_chapter_numbers, self.chapter_file_path, layout=self.layout
+        )
+        if auto_summarize is None:
+            auto_summarize = os.getenv("CHAPTER_SUMMARY_AUTO", "0") == "1"
+        self.auto_summarize = auto_summarize
+        # 章节摘要使用的模型，未设置时使用生成该章节的模型
+        self.summary_model_name = os.getenv("CHAPTER_SUMMARY_MODEL") or None
+        if background_state_update is None:
+            background_state_update = os.getenv("STATE_UPDATE_BACKGROUND", "1") == "1"
+        self.background_state_update = background_state_update
+        self.state_updates = StateUpdatePipeline(
+            self._run_state_update,
+            max_workers=int(os.getenv("STATE_UPDATE_WORKERS", "4"))
+        )
+        self.prompt_layout = os.getenv("NOVEL_PROMPT_LAYOUT", "default")
+        # 多候选生成共用的线程池，超出的候选排队等待
+        self.candidate_workers = int(os.getenv("CANDIDATE_WORKERS", "8"))
+        self._candidate_executor: Optional[ThreadPoolExecutor] = None
+        self._candidate_lock = threading.Lock()
+        # 状态更新输出较短，可启用对冲请求降低长尾延迟（STATE_UPDATE_HEDGE=1开启，最多使调用次数翻倍）
+        self.hedge_state_updates = os.getenv("STATE_UPDATE_HEDGE", "0") == "1"
+        # 当前线程最近一次章节生成的提示词token报告
+        self._local = threading.local()
+
+    @property
+    def last_prompt_report(self) -> Optional[Dict[str, Any]]:
+        """当前线程最近一次组装章节提示词时各部分的token数与裁剪情况"""
+        return getattr(self._local, "prompt_report", None)
+
+    def generate_chapter(
+        self,
+        chapter_outline: str,
+        model_name: str = "deepseek_chat",
+        system_prompt: str = "",
+        session_id: str = "default",
+        use_state: bool = True,
+        use_world_bible: bool = True,
+        update_state: bool = False,
+        update_model_name: Optional[str] = None,
+        novel_id: Optional[str] = None,
+        use_previous_chapters: bool = False,
+        previous_chapters_count: int = 1,
+        use_cache: Optional[bool] = None,
+        previous_chapters_mode: str = "verbatim",
+        summary_chapters_count: int = 20,
+        use_retrieval: bool = False,
+        retrieval_max_chars: int = 3000,
+        chapter_index: Optional[int] = None,
+        prompt_layout: Optional[str] = None
+    ) -> str:
+        with PerfMetrics.generation(), Tracer.span(
+            "generate_chapter", novel_id=novel_id, chapter_index=chapter_index, model=model_name
+        ):
+            with Tracer.span("build_prompt"):
+                messages = self._build_chapter_messages(
+                    chapter_outline, system_prompt, use_state, use_world_bible,
+                    novel_id, use_previous_chapters, previous_chapters_count, model_name,
+                    previous_chapters_mode, summary_chapters_count, use_retrieval, retrieval_max_chars,
+                    chapter_index, prompt_layout
+                )
+            
+            # 调用LLM
+            with Tracer.span("llm_call", model=model_name), \
+                    LLMCallLog.context(purpose="chapter", novel_id=novel_id, chapter_index=chapter_index):
+                response = LLMCaller.call(messages, model_name, cache=use_cache)
+            self._local.prompt_report["usage"] = LLMCaller.last_usage()
+            
+            with Tracer.span("finish_chapter"):
+                self._finish_chapter(
+                    response, chapter_outline, model_name, use_state,
+                    update_state, update_model_name, novel_id, chapter_index
+                )
+        
+        return response
+
+    def generate_chapter_stream(
+        self,
+        chapter_outline: str,
+        model_name: str = "deepseek_chat",
+        system_prompt: str = "",
+        session_id: str = "default",
+        use_state: bool = True,
+        use_world_bible: bool = True,
+        update_state: bool = False,
+        update_model_name: Optional[str] = None,
+        novel_id: Optional[str] = None,
+        use_previous_chapters: bool = False,
+        previous_chapters_count: int = 1,
+        use_cache: Optional[bool] = None,
+        previous_chapters_mode: str = "verbatim",
+        summary_chapters_count: int = 20,
+        use_retrieval: bool = False,
+        retrieval_max_chars: int = 3000,
+        chapter_index: Optional[int] = None,
+        prompt_layout: Optional[str] = None
+    ) -> Iterator[str]:
+        """流式生成章节，逐段产出文本增量
+
+        参数与generate_chapter一致。生成完成后同样保存章节并按需更新状态；
+        若中途被调用方关闭，不保存不完整的章节。
+        """
+        with PerfMetrics.generation(), Tracer.span(
+            "generate_chapter", novel_id=novel_id, chapter_index=chapter_index, model=model_name, stream=True
+        ):
+            with Tracer.span("build_prompt"):
+                messages = self._build_chapter_messages(
+                    chapter_outline, system_prompt, use_state, use_world_bible,
+                    novel_id, use_previous_chapters, previous_chapters_count, model_name,
+                    previous_chapters_mode, summary_chapters_count, use_retrieval, retrieval_max_chars,
+                    chapter_index, prompt_layout
+                )
+            
+            parts = []
+            with Tracer.span("llm_call", model=model_name), \
+                    LLMCallLog.context(purpose="chapter", novel_id=novel_id, chapter_index=chapter_index):
+                for delta in LLMCaller.stream(messages, model_name, cache=use_cache):
+                    parts.append(delta)
+                    yield delta
+            self._local.prompt_report["usage"] = LLMCaller.last_usage()
+            
+            with Tracer.span("finish_chapter"):
+                self._finish_chapter(
+                    "".join(parts), chapter_outline, model_name, use_state,
+                    update_state, update_model_name, novel_id, chapter_index
+                )
+
+    def generate_candidates_stream(
+        self,
+        chapter_outline: str,
+        candidates: List[Dict[str, Any]],
+        system_prompt: str = "",
+        use_state: bool = True,
+        use_world_bible: bool = True,
+        novel_id: Optional[str] = None,
+        use_previous_chapters: bool = False,
+        previous_chapters_count: int = 1,
+        previous_chapters_mode: str = "verbatim",
+        summary_chapters_count: int = 20,
+        use_retrieval: bool = False,
+        retrieval_max_chars: int = 3000,
+        prompt_layout: Optional[str] = None,
+        chapter_index: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """并发生成多个候选版本，逐段产出各候选的文本增量
+
+        Args:
+            candidates: 候选配置列表，每项包含model_name，可选temperature
+            chapter_index: 候选所属章节，未指定时从细纲中提取；都无法确定时在调用LLM前抛出ValueError
+            其余参数与generate_chapter一致
+
+        产出事件:
+            {"candidate": i, "delta": "..."} - 第i个候选的文本增量
+            {"candidate": i, "done": True, "content": "...", "error": None} - 第i个候选结束
+            {"done": True, "chapter_index": n, "candidates": [...]} - 全部结束，候选已通过_save_versions保存
+
+        候选版本不会直接保存为章节，需调用select_candidate选定。
+        """
+        if not candidates:
+            raise ValueError("至少需要一个候选配置")
+        if chapter_index is None:
+            chapter_index = self._extract_chapter_index(chapter_outline)
+        if chapter_index is None:
+            raise ValueError("无法确定章节编号，请指定chapter_index")
+        candidates = [
+            {"model_name": candidate.get("model_name") or "deepseek_chat", "temperature": candidate.get("temperature")}
+            for candidate in candidates
+        ]
+        
+        # 提示词只组装一次，按候选中预算最小的模型裁剪
+        budget_model = min((candidate["model_name"] for candidate in candidates), key=LLMConfigManager.get_prompt_budget)
+        messages = self._build_chapter_messages(
+            chapter_outline, system_prompt, use_state, use_world_bible,
+            novel_id, use_previous_chapters, previous_chapters_count, budget_model,
+            previous_chapters_mode, summary_chapters_count, use_retrieval, retrieval_max_chars,
+            chapter_index, prompt_layout
+        )
+        
+        events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        stop = threading.Event()
+        
+        def run(candidate_index, candidate):
+            parts = []
+            error = None
+            if stop.is_set():
+                # 排队期间调用方已关闭
+                return
+            try:
+                # 候选之间需要不同的输出，不使用响应缓存
+                with LLMCallLog.context(purpose="candidate", novel_id=novel_id, chapter_index=chapter_index,
+                                        candidate=candidate_index):
+                    for delta in LLMCaller.stream(messages, candidate["model_name"], candidate["temperature"], cache=False):
+                        if stop.is_set():
+                            break
+                        parts.append(delta)
+                        events.put({"candidate": candidate_index, "delta": delta})
+            except Exception as e:
+                print(f"候选{candidate_index + 1}生成失败: {e}")
+                error = str(e)
+            events.put({"candidate": candidate_index, "done": True, "content": "".join(parts), "error": error})
+        
+        with self._candidate_lock:
+            self._candidate_executor = executor_for_process(
+                self._candidate_executor, self.candidate_workers, "chapter-candidate"
+            )
+            executor = self._candidate_executor
+        for candidate_index, candidate in enumerate(candidates):
+            # 在线程池中保留调用上下文（追踪span）
+            executor.submit(contextvars.copy_context().run, run, candidate_index, candidate)
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(candidates)
+        remaining = len(candidates)
+        try:
+            while remaining:
+                event = events.get()
+                if event.get("done"):
+                    results[event["candidate"]] = event
+                    remaining -= 1
+                yield event
+        finally:
+            # 调用方提前关闭时通知仍在生成的候选停止
+            stop.set()
+        
+        summary = [
+            {**candidate, "error": result["error"], "word_count": len(result["content"])}
+            for candidate, result in zip(candidates, results)
+        ]
+        self._save_versions([result["content"] for result in results], chapter_index, novel_id, summary)
+        yield {"done": True, "chapter_index": chapter_index, "candidates": summary}
+
+    def generate_candidates(self, chapter_outline: str, candidates: List[Dict[str, Any]], **kwargs) -> List[Dict[str, Any]]:
+        """并发生成多个候选版本并保存，返回各候选的内容与配置，参数同generate_candidates_stream"""
+        contents = {}
+        for event in self.generate_candidates_stream(chapter_outline, candidates, **kwargs):
+            if event.get("candidate") is not None and event.get("done"):
+                contents[event["candidate"]] = event["content"]
+            elif event.get("done"):
+                return [{**candidate, "content": contents[i]} for i, candidate in enumerate(event["candidates"])]
+        return []
+
+    def select_candidate(
+        self,
+        chapter_index: int,
+        candidate_index: int,
+        novel_id: Optional[str] = None,
+        use_state: bool = True,
+        update_state: bool = False,
+        update_model_name: Optional[str] = None
+    ) -> str:
+        """从已保存的候选版本中选定一个保存为章节，并按需更新状态"""
+        versions_data = self.load_versions(chapter_index, novel_id)
+        if not versions_data:
+            raise ValueError(f"第{chapter_index}章没有候选版本")
+        versions = versions_data["versions"]
+        if not 0 <= candidate_index < len(versions):
+            raise ValueError(f"候选编号超出范围: {candidate_index}")
+        candidate = (versions_data.get("candidates") or [{}] * len(versions))[candidate_index]
+        if candidate.get("error"):
+            raise ValueError(f"候选{candidate_index + 1}生成失败，不能选用")
+        
+        content = versions[candidate_index]
+        model_name = candidate.get("model_name") or "deepseek_chat"
+        self._finish_chapter(
+            content, "", model_name, use_state,
+            update_state, update_model_name, novel_id, chapter_index=chapter_index
+        )
+        
+        # 记录选定的候选
+        versions_data["selected"] = candidate_index
+        versions_data["selected_at"] = time.time()
+        file_path = self.layout.resolve_path("./versions", novel_id, self.versions_filename(chapter_index, novel_id))
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(versions_data, f, indent=2, ensure_ascii=False)
+        return content
 
-    def generate_chapter(
+    def _build_chapter_messages(
         self,
         chapter_outline: str,
+        system_prompt: str,
+        use_state: bool,
+        use_world_bible: bool,
+        novel_id: Optional[str],
+        use_previous_chapters: bool,
+        previous_chapters_count: int,
         model_name: str = "deepseek_chat",
-        system_prompt: str = "",
-        session_id: str = "default",
-        use_state: bool = True,
-        use_world_bible: bool = True,
-        update_state: bool = False,
-        update_model_name: Optional[str] = None,
-        novel_id: Optional[str] = None,
-        use_previous_chapters: bool = False,
-        previous_chapters_count: int = 1
-    ) -> str:
+        previous_chapters_mode: str = "verbatim",
+        summary_chapters_count: int = 20,
+        use_retrieval: bool = False,
+        retrieval_max_chars: int = 3000,
+        chapter_index: Optional[int] = None,
+        prompt_layout: Optional[str] = None
+    ) -> List[Dict[str, str]]:
+        """组装章节生成的消息列表
+
+        previous_chapters_mode为"hierarchical"时，最近previous_chapters_count章使用原文，
+        再往前的summary_chapters_count章使用章节摘要。
+        use_retrieval为True时，从之前所有章节中检索与细纲最相关的片段（不超过retrieval_max_chars字）。
+        各部分按模型的提示词预算裁剪：超出时依次裁剪前文章节（保留最近的内容）、
+        检索片段、更早章节摘要、世界设定、当前状态，系统提示与章节细纲保持完整。
+        prompt_layout为"stable_prefix"时，系统提示与世界设定按固定顺序、逐字节一致地放在最前
+        并标记缓存断点，其余部分按变化频率由低到高排列、细纲在最后，便于服务商复用提示词前缀缓存；
+        为None时使用NOVEL_PROMPT_LAYOUT环境变量（默认"default"）。
+        """
+        prompt_layout = prompt_layout or self.prompt_layout
+        if prompt_layout not in self.PROMPT_LAYOUTS:
+            raise ValueError(f"不支持的提示词布局: {prompt_layout}")
         messages = []
+        budgeter = PromptBudgeter(LLMConfigManager.get_prompt_budget(model_name))
         
         # 添加系统提示
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
+            budgeter.add("system", system_prompt)
         
         # 构建用户输入 - 使用更自然的提示词表达
-        user_content = f"请根据下面的章节细纲进行小说内容创作：\n\n{chapter_outline}"
+        budgeter.add("outline", f"请根据下面的章节细纲进行小说内容创作：\n\n{chapter_outline}")
         
         # 加载前面章节内容
-        if use_previous_chapters:
+        current_chapter_index = chapter_index
+        if current_chapter_index is None:
             current_chapter_index = self._extract_chapter_index(chapter_outline)
-            if current_chapter_index is not None and current_chapter_index > 1:
-                # 确保count在合理范围内
-                count = max(1, min(previous_chapters_count, current_chapter_index - 1))
-                previous_content = self.load_previous_chapters(
-                    current_chapter_index, count, novel_id
+        count = 0
+        if use_previous_chapters and current_chapter_index is not None and current_chapter_index > 1:
+            # 确保count在合理范围内
+            count = max(1, min(previous_chapters_count, current_chapter_index - 1))
+            
+            # 分层模式：更早的章节使用摘要
+            summary_end = current_chapter_index - count
+            if previous_chapters_mode == "hierarchical" and summary_end > 1 and summary_chapters_count > 0:
+                summary_start = max(1, summary_end - summary_chapters_count)
+                with Tracer.span("load_chapter_summaries", root=False, chapters=summary_end - summary_start):
+                    summaries = self.chapter_summaries.load_summaries(
+                        list(range(summary_start, summary_end)), novel_id, model_name
+                    )
+                if summaries:
+                    summary_text = "\n".join(
+                        f"【第{chapter_idx}章摘要】{summaries[chapter_idx]}" for chapter_idx in sorted(summaries)
+                    )
+                    budgeter.add(
+                        "chapter_summaries", summary_text,
+                        priority=2, trim="keep_tail", header="更早章节摘要：\n"
+                    )
+        
+        # 检索与细纲相关的更早片段（人物、地点、物品等），跳过整章注入的前文
+        if use_retrieval and novel_id:
+            verbatim_chapters = set(range(current_chapter_index - count, current_chapter_index)) if count else set()
+            with Tracer.span("retrieval_search", root=False):
+                passages = self.retrieval_index.search(
+                    novel_id, chapter_outline,
+                    max_chars=retrieval_max_chars,
+                    before_chapter=current_chapter_index,
+                    exclude_chapters=verbatim_chapters
+                )
+            if passages:
+                retrieved_text = "\n".join(
+                    f"【第{passage['chapter_index']}章片段】{passage['text']}" for passage in passages
+                )
+                budgeter.add(
+                    "retrieved_passages", retrieved_text,
+                    priority=1, trim="keep_head", header="相关前文片段：\n"
+                )
+        
+        if count:
+            previous_content = self.load_previous_chapters(
+                current_chapter_index, count, novel_id
+            )
+            if previous_content:
+                budgeter.add(
+                    "previous_chapters", previous_content,
+                    priority=0, trim="keep_tail", header="前面章节内容参考：\n"
                 )
-                if previous_content:
-                    user_content += f"\n\n前面章节内容参考：\n{previous_content}"
         
+        # 状态与世界设定使用紧凑JSON序列化
         if use_state:
+            # 等待该小说尚未完成的后台状态更新
+            if self.state_updates.is_pending(novel_id):
+                print("等待上一章状态更新完成...")
+                with Tracer.span("wait_state_update", root=False):
+                    self.state_updates.wait_for_novel(novel_id)
             state = self.state_manager.load_latest_state(novel_id)
             if state:
-                user_content += f"\n\n当前状态：{state.model_dump_json(indent=2)}"
+                budgeter.add(
+                    "state", state.model_dump_json(),
+                    priority=4, trim="json", header="当前状态："
+                )
         
         if use_world_bible:
             world_bible = self.state_manager.load_world_bible(novel_id)
             if world_bible:
-                user_content += f"\n\n世界设定：{json.dumps(world_bible, ensure_ascii=False, indent=2)}"
-        
-        user_message = {"role": "user", "content": user_content}
-        messages.append(user_message)
+                world_text = json.dumps(
+                    world_bible, ensure_ascii=False, separators=(",", ":"),
+                    sort_keys=prompt_layout == "stable_prefix"
+                )
+                budgeter.add(
+                    "world_bible", world_text,
+                    priority=3, trim="json", header="世界设定："
+                )
         
-        # 调用LLM
-        response = LLMCaller.call(messages, model_name)
+        fitted = budgeter.fit()
+        report = fitted["report"]
+        self._local.prompt_report = report
+        trimmed = [name for name, section in report["sections"].items() if section["trimmed"]]
+        if trimmed:
+            print(f"提示词超出预算({report['budget']} tokens)，已裁剪: {', '.join(trimmed)}")
         
-        # 保存章节内容 - 尝试从细纲中提取章节索引
-        chapter_index = self._extract_chapter_index(chapter_outline)
+        if prompt_layout == "stable_prefix":
+            # 每部分变化频率：系统提示(模版) < 世界设定(小说) < 摘要/状态/前文(每章) < 检索/细纲(每次)
+            texts = fitted["by_name"]
+            if "world_bible" in texts:
+                messages.append({"role": "user", "content": texts["world_bible"], "cache_breakpoint": True})
+            if messages and messages[0]["role"] == "system":
+                messages[0]["cache_breakpoint"] = True
+            user_texts = [
+                texts[name] for name in self.STABLE_PREFIX_ORDER if name in texts
+            ]
+        else:
+            user_texts = fitted["texts"][1:] if system_prompt else fitted["texts"]
+        user_message = {"role": "user", "content": "\n\n".join(user_texts)}
+        messages.append(user_message)
+        return messages
+
+    def _finish_chapter(
+        self,
+        response: str,
+        chapter_outline: str,
+        model_name: str,
+        use_state: bool,
+        update_state: bool,
+        update_model_name: Optional[str],
+        novel_id: Optional[str],
+        chapter_index: Optional[int] = None
+    ):
+        """章节生成后的收尾：保存章节并按需更新状态"""
+        # 保存章节内容 - 未指定章节索引时尝试从细纲中提取
+        if chapter_index is None:
+            chapter_index = self._extract_chapter_index(chapter_outline)
         if chapter_index is not None:
-            self._save_chapter(response, chapter_index, novel_id)
+            self._save_chapter(response, chapter_index, novel_id, summary_model_name=self.summary_model_name or model_name)
         
         # 状态更新 - 如果启用状态更新且使用了状态
+        self._local.state_update_task = None
         if update_state and use_state:
-            current_state = self.state_manager.load_latest_state(novel_id)
-            if current_state:
-                print(f"正在更新状态...")
+            params = {
+                "novel_id": novel_id,
+                "chapter_index": chapter_index,
+                "chapter_content": response,
+                "model_name": update_model_name or model_name
+            }
+            if self.background_state_update:
+                # 后台更新，下一次需要状态的生成会等待其完成
+                self._local.state_update_task = self.state_updates.submit(**params)
+            else:
                 try:
-                    # 读取状态更新规则
-                    update_rules_file = os.path.join("./prompts", "update_state_rules.txt")
-                    update_system_prompt = ""
-                    if os.path.exists(update_rules_file):
-                        with open(update_rules_file, 'r', encoding='utf-8') as f:
-                            update_system_prompt = f.read().strip()
-                    
-                    # 调用状态更新
-                    update_model = update_model_name or model_name
-                    new_state = self.update_state(
-                        chapter_content=response,
-                        current_state=current_state,
-                        model_name=update_model,
-                        novel_id=novel_id,
-                        system_prompt=update_system_prompt
-                    )
-                    print(f"状态更新完成，新状态已保存")
+                    self._run_state_update(params)
                 except Exception as e:
                     print(f"状态更新失败: {e}")
+
+    @property
+    def last_state_update(self) -> Optional[Dict[str, Any]]:
+        """当前线程最近一次生成提交的后台状态更新任务"""
+        return getattr(self._local, "state_update_task", None)
+
+    def _run_state_update(self, params: Dict[str, Any]) -> str:
+        """执行一次生成后的状态更新，返回 succeeded / unchanged / skipped"""
+        novel_id = params["novel_id"]
+        with Tracer.span("run_state_update", novel_id=novel_id, chapter_index=params.get("chapter_index")):
+            current_state = self.state_manager.load_latest_state(novel_id)
+            if not current_state:
+                return "skipped"
         
-        return response
+            print(f"正在更新状态...")
+            # 读取状态更新规则
+            update_rules_file = os.path.join("./prompts", "update_state_rules.txt")
+            update_system_prompt = ""
+            if os.path.exists(update_rules_file):
+                with open(update_rules_file, 'r', encoding='utf-8') as f:
+                    update_system_prompt = f.read().strip()
+        
+            # 调用状态更新
+            with LLMCallLog.context(chapter_index=params.get("chapter_index")):
+                new_state = self.update_state(
+                    chapter_content=params["chapter_content"],
+                    current_state=current_state,
+                    model_name=params["model_name"],
+                    novel_id=novel_id,
+                    system_prompt=update_system_prompt
+                )
+            if new_state is current_state:
+                return "unchanged"
+            print(f"状态更新完成，新状态已保存")
+            return "succeeded"
 
     def update_state(
         self,
@@ -838,7 +4906,8 @@ class NovelGenerator:
 4.  **添加新条目**: 如果有新物品或新人物关系，就在对应的数组中添加新的对象。
 5.  **更新剧情总结**: 修改 `current_plot_summary` 字段，简要概括本章发生的核心事件。
 6.  **严格遵守格式**: 你的输出必须严格遵循下面提供的JSON格式，不包含任何解释性文字或代码块标记。
-"""
+""",
+        use_cache: Optional[bool] = None
     ) -> ChapterState:
         messages = []
 
@@ -857,19 +4926,23 @@ class NovelGenerator:
 """
         messages.append({"role": "user", "content": user_content})
         
-        response = LLMCaller.call(messages, model_name)
-        
-        try:
-            # 提取JSON
-            import re
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                state_data = json.loads(json_match.group())
-                new_state = ChapterState(**state_data)
-                self.state_manager.save_state(new_state, novel_id)
-                return new_state
-        except Exception as e:
-            print(f"状态更新失败: {e}")
+        with Tracer.span("update_state", novel_id=novel_id, model=model_name) as span:
+            with LLMCallLog.context(purpose="state_update", novel_id=novel_id):
+                response = LLMCaller.call(messages, model_name, cache=use_cache, hedge=self.hedge_state_updates)
+            
+            try:
+                # 提取JSON
+                import re
+                json_match = re.search(r'\{.*\}', response, re.DOTALL)
+                if json_match:
+                    state_data = json.loads(json_match.group())
+                    new_state = ChapterState(**state_data)
+                    self.state_manager.save_state(new_state, novel_id)
+                    return new_state
+            except Exception as e:
+                print(f"状态更新失败: {e}")
+                if span:
+                    span.error = f"{type(e).__name__}: {e}"
         
         return current_state
 
@@ -885,39 +4958,41 @@ class NovelGenerator:
         compression_model: str = "deepseek_chat",
         save_conversation: bool = True
     ) -> str:
-        messages = []
-        
-        # 添加系统提示
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        
-        # 加载历史记录
-        if use_memory and recent_count > 0:
-            history_messages = self.memory_manager.load_recent_messages(
-                session_id=session_id,
-                count=recent_count,
-                use_compression=use_compression,
-                compression_model=compression_model
-            )
-            messages.extend(history_messages)
-        
-        # 添加当前用户输入
-        user_message = {"role": "user", "content": user_input}
-        messages.append(user_message)
-        
-        # 保存用户消息
-        if save_conversation:
-            self.memory_manager.save_message(session_id, user_message)
-        
-        # 调用LLM
-        response = LLMCaller.call(messages, model_name)
-        
-        # 保存AI回复
-        if save_conversation:
-            ai_message = {"role": "assistant", "content": response}
-            self.memory_manager.save_message(session_id, ai_message)
-        
-        return response
+        with Tracer.span("chat", session_id=session_id, model=model_name):
+            messages = []
+            
+            # 添加系统提示
+            if system_prompt:
+                messages.append({"role": "system", "content": system_prompt})
+            
+            # 加载历史记录
+            if use_memory and recent_count > 0:
+                history_messages = self.memory_manager.load_recent_messages(
+                    session_id=session_id,
+                    count=recent_count,
+                    use_compression=use_compression,
+                    compression_model=compression_model
+                )
+                messages.extend(history_messages)
+            
+            # 添加当前用户输入
+            user_message = {"role": "user", "content": user_input}
+            messages.append(user_message)
+            
+            # 保存用户消息
+            if save_conversation:
+                self.memory_manager.save_message(session_id, user_message)
+            
+            # 调用LLM
+            with LLMCallLog.context(purpose="chat", session_id=session_id):
+                response = LLMCaller.call(messages, model_name)
+            
+            # 保存AI回复
+            if save_conversation:
+                ai_message = {"role": "assistant", "content": response}
+                self.memory_manager.save_message(session_id, ai_message)
+            
+            return response
 
 
     
@@ -958,14 +5033,18 @@ class NovelGenerator:
         session_id: str,
         chunk_indices: List[int],
         model_name: str = "deepseek_chat",
-        compression_prompt: str = ""
+        compression_prompt: str = "",
+        max_workers: int = 4,
+        progress_callback: Optional[Callable[[int, int, int, bool], None]] = None
     ) -> Dict[int, bool]:
         """批量压缩记忆分片"""
         return self.memory_manager.batch_compress_chunks(
             session_id=session_id,
             chunk_indices=chunk_indices,
             model_name=model_name,
-            compression_prompt=compression_prompt
+            compression_prompt=compression_prompt,
+            max_workers=max_workers,
+            progress_callback=progress_callback
         )
     
     def get_memory_stats(self, session_id: str) -> Dict[str, Any]:
@@ -991,26 +5070,26 @@ class NovelGenerator:
         if current_chapter_index <= 1 or count <= 0:
             return ""
         
-        os.makedirs("./xiaoshuo", exist_ok=True)
-        previous_contents = []
-        
-        # 从当前章节往前读取指定数量的章节
-        start_index = max(1, current_chapter_index - count)
-        for chapter_idx in range(start_index, current_chapter_index):
-            try:
-                if novel_id:
-                    file_path = f"./xiaoshuo/{novel_id}_chapter_{chapter_idx:03d}.txt"
-                else:
-                    file_path = f"./xiaoshuo/chapter_{chapter_idx:03d}.txt"
-                
-                if os.path.exists(file_path):
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read().strip()
-                        if content:
-                            previous_contents.append(f"【第{chapter_idx}章内容】\n{content}")
-            except Exception as e:
-                print(f"读取第{chapter_idx}章失败: {e}")
-                continue
+        with Tracer.span("load_previous_chapters", root=False, novel_id=novel_id, count=count) as span:
+            os.makedirs("./xiaoshuo", exist_ok=True)
+            previous_contents = []
+            
+            # 从当前章节往前读取指定数量的章节
+            start_index = max(1, current_chapter_index - count)
+            for chapter_idx in range(start_index, current_chapter_index):
+                try:
+                    file_path = self.chapter_file_path(chapter_idx, novel_id)
+                    
+                    if os.path.exists(file_path):
+                        with open(file_path, 'r', encoding='utf-8') as f:
+                            content = f.read().strip()
+                            if content:
+                                previous_contents.append(f"【第{chapter_idx}章内容】\n{content}")
+                except Exception as e:
+                    print(f"读取第{chapter_idx}章失败: {e}")
+                    continue
+            if span:
+                span.set_attribute("chapters_loaded", len(previous_contents))
         
         if previous_contents:
             return "\n\n".join(previous_contents)
@@ -1041,32 +5120,865 @@ class NovelGenerator:
 
 
 
-    def _save_chapter(self, content: str, chapter_index: int, novel_id: Optional[str] = None):
-        os.makedirs("./xiaoshuo", exist_ok=True)
+    @staticmethod
+    def outline_file_path(chapter_index: int, novel_id: str) -> str:
+        """章节细纲文件路径: xiaoshuo/zhangjiexigang/<novel_id>/<n>.txt"""
+        return os.path.join("xiaoshuo", "zhangjiexigang", str(novel_id), f"{chapter_index}.txt")
+
+    def load_outline(self, chapter_index: int, novel_id: str) -> Optional[str]:
+        """读取章节细纲，文件不存在或为空时返回None"""
+        outline_file = self.outline_file_path(chapter_index, novel_id)
+        if not os.path.exists(outline_file):
+            return None
+        with open(outline_file, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+
+    @staticmethod
+    def chapter_filename(chapter_index: int, novel_id: Optional[str] = None) -> str:
+        """章节文件名"""
         if novel_id:
-            file_path = f"./xiaoshuo/{novel_id}_chapter_{chapter_index:03d}.txt"
-        else:
-            # 兼容旧格式
-            file_path = f"./xiaoshuo/chapter_{chapter_index:03d}.txt"
+            return f"{novel_id}_chapter_{chapter_index:03d}.txt"
+        # 兼容旧格式
+        return f"chapter_{chapter_index:03d}.txt"
+
+    def chapter_file_path(self, chapter_index: int, novel_id: Optional[str] = None, for_write: bool = False) -> str:
+        """章节文件路径，兼容平铺和分目录两种布局"""
+        filename = self.chapter_filename(chapter_index, novel_id)
+        if for_write:
+            return self.layout.resolve_path("./xiaoshuo", novel_id, filename)
+        return self.layout.read_path("./xiaoshuo", novel_id, filename)
+
+    def list_chapter_numbers(self, novel_id: str) -> List[int]:
+        """列出小说已保存的章节编号，升序"""
+        chapter_numbers = set()
+        for file_path in self.layout.list_novel_files("./xiaoshuo", novel_id):
+            if not os.path.basename(file_path).startswith(f"{novel_id}_chapter_"):
+                continue
+            match = self.CHAPTER_FILE_RE.search(file_path)
+            if match:
+                chapter_numbers.add(int(match.group(1)))
+        return sorted(chapter_numbers)
+
+    def _save_chapter(
+        self,
+        content: str,
+        chapter_index: int,
+        novel_id: Optional[str] = None,
+        summary_model_name: str = "deepseek_chat"
+    ):
+        os.makedirs("./xiaoshuo", exist_ok=True)
+        file_path = self.chapter_file_path(chapter_index, novel_id, for_write=True)
         
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(content)
+        
+        self.retrieval_index.update_chapter(chapter_index, novel_id)
+        
+        # 后台生成章节摘要，供分层前文模式使用
+        if self.auto_summarize:
+            self.chapter_summaries.schedule(chapter_index, novel_id, summary_model_name, content=content)
 
-    def _save_versions(self, versions: List[str], chapter_index: int, novel_id: Optional[str] = None):
-        os.makedirs("./versions", exist_ok=True)
+    @staticmethod
+    def versions_filename(chapter_index: int, novel_id: Optional[str] = None) -> str:
+        """候选版本文件名"""
         if novel_id:
-            file_path = f"./versions/{novel_id}_chapter_{chapter_index}_versions.json"
-        else:
-            # 兼容旧格式
-            file_path = f"./versions/chapter_{chapter_index}_versions.json"
+            return f"{novel_id}_chapter_{chapter_index}_versions.json"
+        # 兼容旧格式
+        return f"chapter_{chapter_index}_versions.json"
+
+    def _save_versions(
+        self,
+        versions: List[str],
+        chapter_index: int,
+        novel_id: Optional[str] = None,
+        candidates: Optional[List[Dict[str, Any]]] = None
+    ) -> str:
+        os.makedirs("./versions", exist_ok=True)
+        filename = self.versions_filename(chapter_index, novel_id)
+        file_path = self.layout.resolve_path("./versions", novel_id, filename)
         
+        data = {
+            "novel_id": novel_id,
+            "chapter_index": chapter_index,
+            "versions": versions,
+            "created_at": time.time()
+        }
+        if candidates is not None:
+            data["candidates"] = candidates
         with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump({
-                "novel_id": novel_id,
-                "chapter_index": chapter_index,
-                "versions": versions,
-                "created_at": time.time()
-            }, f, indent=2, ensure_ascii=False)
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        return file_path
+
+    def load_versions(self, chapter_index: int, novel_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """读取章节的候选版本，不存在时返回None"""
+        file_path = self.layout.read_path("./versions", novel_id, self.versions_filename(chapter_index, novel_id))
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+class NovelBatchDriver:
+    """整本小说批量生成 - 按 xiaoshuo/zhangjiexigang/<novel_id>/<n>.txt 的细纲顺序生成章节
+
+    每章生成后等待其状态更新完成再记录检查点，下一章基于最新状态生成；章节摘要与检索索引
+    在后台并行更新。检查点保存在 batch_runs/<novel_id>_batch.json，中断后以同一小说ID重新
+    运行即跳过已完成的章节继续。
+    """
+
+    def __init__(
+        self,
+        generator: "NovelGenerator",
+        novel_id: str,
+        start_chapter: int,
+        end_chapter: int,
+        generate_kwargs: Optional[Dict[str, Any]] = None,
+        checkpoint_path: str = "./batch_runs"
+    ):
+        """
+        Args:
+            generator: 小说生成器
+            novel_id: 小说ID
+            start_chapter: 起始章节（含）
+            end_chapter: 结束章节（含）
+            generate_kwargs: 传给generate_chapter的其余参数（model_name、system_prompt、update_state等）
+            checkpoint_path: 检查点存储目录
+        """
+        if start_chapter < 1 or end_chapter < start_chapter:
+            raise ValueError(f"章节范围无效: {start_chapter}-{end_chapter}")
+        self.generator = generator
+        self.novel_id = novel_id
+        self.start_chapter = start_chapter
+        self.end_chapter = end_chapter
+        self.generate_kwargs = dict(generate_kwargs or {})
+        self.checkpoint_path = checkpoint_path
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.checkpoint = self._load_checkpoint()
+
+    @property
+    def checkpoint_file(self) -> str:
+        return os.path.join(self.checkpoint_path, f"{self.novel_id}_batch.json")
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        checkpoint = None
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        if checkpoint is None:
+            checkpoint = {
+                "novel_id": self.novel_id,
+                "completed": [],
+                "created_at": time.time(),
+                "totals": {"chapters": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0}
+            }
+        checkpoint.update({
+            "start_chapter": self.start_chapter,
+            "end_chapter": self.end_chapter,
+            "status": "pending",
+            "current_chapter": None,
+            "error": None,
+            "run": {"chapters": 0, "prompt_tokens": 0, "completion_tokens": 0, "started_at": None}
+        })
+        return checkpoint
+
+    def _save_checkpoint_locked(self):
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        self.checkpoint["updated_at"] = time.time()
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.checkpoint, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def pending_chapters(self) -> List[int]:
+        """范围内尚未完成的章节"""
+        completed = set(self.checkpoint["completed"])
+        return [n for n in range(self.start_chapter, self.end_chapter + 1) if n not in completed]
+
+    def stop(self):
+        """当前章节完成后停止"""
+        self._stop.set()
+
+    def _update(self, **fields):
+        with self._lock:
+            self.checkpoint.update(fields)
+            self._save_checkpoint_locked()
+
+    def run(self, progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """按顺序生成范围内未完成的章节，返回最终状态"""
+        run_stats = self.checkpoint["run"]
+        run_stats["started_at"] = time.time()
+        self._update(status="running", error=None)
+        
+        for chapter_index in self.pending_chapters():
+            if self._stop.is_set():
+                self._update(status="stopped", current_chapter=None)
+                return self.get_status()
+            
+            outline = self.generator.load_outline(chapter_index, self.novel_id)
+            if not outline:
+                self._update(status="failed", current_chapter=chapter_index,
+                             error=f"细纲文件不存在或为空: {self.generator.outline_file_path(chapter_index, self.novel_id)}")
+                return self.get_status()
+            
+            self._update(current_chapter=chapter_index)
+            chapter_started = time.time()
+            try:
+                content = self.generator.generate_chapter(
+                    chapter_outline=outline,
+                    novel_id=self.novel_id,
+                    chapter_index=chapter_index,
+                    **self.generate_kwargs
+                )
+                # 下一章依赖本章更新后的状态，等待状态更新完成后再记录检查点
+                self.generator.state_updates.wait_for_novel(self.novel_id)
+            except Exception as e:
+                print(f"第{chapter_index}章生成失败: {e}")
+                self._update(status="failed", error=str(e))
+                return self.get_status()
+            
+            prompt_report = self.generator.last_prompt_report or {}
+            prompt_tokens = prompt_report.get("total_tokens", 0)
+            completion_tokens = estimate_tokens(content)
+            elapsed = time.time() - chapter_started
+            with self._lock:
+                self.checkpoint["completed"] = sorted(set(self.checkpoint["completed"]) | {chapter_index})
+                for stats in (run_stats, self.checkpoint["totals"]):
+                    stats["chapters"] += 1
+                    stats["prompt_tokens"] += prompt_tokens
+                    stats["completion_tokens"] += completion_tokens
+                self.checkpoint["totals"]["seconds"] += elapsed
+                self._save_checkpoint_locked()
+            
+            status = self.get_status()
+            throughput = status["throughput"]
+            print(f"✅ 第{chapter_index}章完成 ({len(content)}字, {elapsed:.1f}秒) | "
+                  f"{throughput['chapters_per_hour']} 章/小时, {throughput['tokens_per_minute']} tokens/分钟")
+            if progress_callback:
+                progress_callback(status)
+        
+        self._update(status="completed", current_chapter=None)
+        return self.get_status()
+
+    def get_status(self) -> Dict[str, Any]:
+        """检查点与本次运行的吞吐量（章/小时、tokens/分钟，token数为估算值）"""
+        with self._lock:
+            status = copy.deepcopy(self.checkpoint)
+        run_stats = status["run"]
+        elapsed = time.time() - run_stats["started_at"] if run_stats["started_at"] else 0.0
+        tokens = run_stats["prompt_tokens"] + run_stats["completion_tokens"]
+        status["pending"] = len(self.pending_chapters())
+        status["throughput"] = {
+            "elapsed_seconds": round(elapsed, 1),
+            "chapters_per_hour": round(run_stats["chapters"] * 3600 / elapsed, 2) if elapsed else 0.0,
+            "tokens_per_minute": round(tokens * 60 / elapsed, 1) if elapsed else 0.0
+        }
+        return status
+
+class NovelScheduler:
+    """多小说并发生成调度器
+
+    同一部小说的章节按提交顺序串行生成（每章在状态更新完成后才放行下一章），不同小说之间
+    并行。有空闲线程时按轮转顺序在有待生成章节的小说之间公平选取，每部小说同时最多一个
+    进行中的章节；章节分配给模型池中负载最低、且所属服务商分组未超过 max_in_flight 与
+    rpm/tpm 限额的模型，总吞吐量随服务商容量扩展。
+    """
+
+    STATUSES = ("queued", "running", "succeeded", "failed", "skipped", "cancelled")
+
+    def __init__(
+        self,
+        generator: "NovelGenerator",
+        models: Optional[List[str]] = None,
+        max_workers: int = 8,
+        history_size: int = 2000,
+        chapter_tokens: int = 8000
+    ):
+        """
+        Args:
+            generator: 小说生成器
+            models: 模型池，为None时读取环境变量SCHEDULER_MODELS（逗号分隔），默认["deepseek_chat"]
+            max_workers: 同时生成的章节总数上限
+            history_size: 保留的已结束任务记录数
+            chapter_tokens: 单章token消耗的初始估计（用于tpm限额，之后按实际章节滑动平均）
+        """
+        if models is None:
+            models = [m.strip() for m in os.getenv("SCHEDULER_MODELS", "deepseek_chat").split(",") if m.strip()]
+        if not models:
+            raise ValueError("模型池不能为空")
+        self.generator = generator
+        self.models = list(models)
+        self.max_workers = max_workers
+        self.history_size = history_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._queues: Dict[str, List[Dict[str, Any]]] = {}
+        # 轮转顺序：有待生成章节且没有进行中章节的小说
+        self._ready: List[str] = []
+        self._active: set = set()
+        self._model_in_flight: Counter = Counter()
+        self._provider_in_flight: Counter = Counter()
+        self._model_stats: Dict[str, Dict[str, Any]] = {}
+        self._chapter_tokens = float(chapter_tokens)
+        self._paused = False
+        self._retry_timer: Optional[threading.Timer] = None
+        self._cond = threading.Condition()
+
+    def submit(
+        self,
+        novel_id: str,
+        chapter_index: int,
+        chapter_outline: Optional[str] = None,
+        **generate_kwargs
+    ) -> Dict[str, Any]:
+        """提交一章的生成任务
+
+        chapter_outline为None时在执行时读取细纲文件；generate_kwargs传给generate_chapter，
+        其中指定model_name时固定使用该模型，否则由调度器在模型池中选择。
+        """
+        model_name = generate_kwargs.pop("model_name", None)
+        task = {
+            "task_id": uuid.uuid4().hex,
+            "novel_id": novel_id,
+            "chapter_index": chapter_index,
+            "model_name": model_name,
+            "pinned": model_name is not None,
+            "status": "queued",
+            "error": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "params": {"chapter_outline": chapter_outline, **generate_kwargs}
+        }
+        with self._cond:
+            self._tasks[task["task_id"]] = task
+            if not self._queues.get(novel_id) and novel_id not in self._active:
+                self._ready.append(novel_id)
+            self._queues.setdefault(novel_id, []).append(task)
+            self._dispatch_locked()
+            self._trim_history_locked()
+            return self._public(task)
+
+    def submit_range(
+        self,
+        novel_id: str,
+        start_chapter: int,
+        end_chapter: int,
+        skip_existing: bool = True,
+        **generate_kwargs
+    ) -> List[Dict[str, Any]]:
+        """按细纲文件提交一段章节，skip_existing时跳过已保存的章节（重启后重新提交即可继续）"""
+        if start_chapter < 1 or end_chapter < start_chapter:
+            raise ValueError(f"章节范围无效: {start_chapter}-{end_chapter}")
+        existing = set(self.generator.list_chapter_numbers(novel_id)) if skip_existing else set()
+        return [
+            self.submit(novel_id, chapter_index, **dict(generate_kwargs))
+            for chapter_index in range(start_chapter, end_chapter + 1)
+            if chapter_index not in existing
+        ]
+
+    def _pick_model_locked(self, task: Dict[str, Any]) -> tuple:
+        """选择负载最低且有额度的模型，返回(模型, 0)；都不可用时返回(None, 建议重试秒数)"""
+        candidates = [task["model_name"]] if task["pinned"] else self.models
+        ranked = []
+        for model_name in candidates:
+            if not task["pinned"] and ModelRouter.is_open(model_name):
+                continue
+            provider = LLMConfigManager.get_provider(model_name)
+            limit = LLMConfigManager.get_provider_limits(provider)["max_in_flight"]
+            if self._provider_in_flight[provider] >= limit:
+                continue
+            ranked.append((self._provider_in_flight[provider] / limit, self._model_in_flight[model_name], model_name, provider))
+        retry_after = 0.0
+        for _, _, model_name, provider in sorted(ranked):
+            wait = RateLimiter.for_provider(provider).try_acquire(int(self._chapter_tokens))
+            if wait <= 0:
+                return model_name, 0.0
+            retry_after = wait if not retry_after else min(retry_after, wait)
+        return None, retry_after
+
+    def _dispatch_locked(self):
+        """按轮转顺序为空闲线程分配章节"""
+        if self._paused:
+            return
+        retry_after = 0.0
+        index = 0
+        while index < len(self._ready) and len(self._active) < self.max_workers:
+            novel_id = self._ready[index]
+            task = self._queues[novel_id][0]
+            model_name, wait = self._pick_model_locked(task)
+            if model_name is None:
+                if wait:
+                    retry_after = wait if not retry_after else min(retry_after, wait)
+                index += 1
+                continue
+            self._ready.pop(index)
+            self._queues[novel_id].pop(0)
+            self._active.add(novel_id)
+            provider = LLMConfigManager.get_provider(model_name)
+            self._model_in_flight[model_name] += 1
+            self._provider_in_flight[provider] += 1
+            task.update(status="running", model_name=model_name, started_at=time.time())
+            self._executor = executor_for_process(self._executor, self.max_workers, "novel-scheduler")
+            self._executor.submit(self._run, task)
+        
+        # 只因限速无法分配时，等额度恢复后重试
+        if retry_after and self._retry_timer is None:
+            self._retry_timer = threading.Timer(retry_after, self._retry_dispatch)
+            self._retry_timer.daemon = True
+            self._retry_timer.start()
+
+    def _retry_dispatch(self):
+        with self._cond:
+            self._retry_timer = None
+            self._dispatch_locked()
+
+    def _run(self, task: Dict[str, Any]):
+        novel_id = task["novel_id"]
+        model_name = task["model_name"]
+        provider = LLMConfigManager.get_provider(model_name)
+        params = task["params"]
+        error = None
+        tokens = None
+        try:
+            outline = params.pop("chapter_outline") or self.generator.load_outline(task["chapter_index"], novel_id)
+            if not outline:
+                raise ValueError(f"细纲文件不存在或为空: {self.generator.outline_file_path(task['chapter_index'], novel_id)}")
+            content = self.generator.generate_chapter(
+                chapter_outline=outline,
+                model_name=model_name,
+                novel_id=novel_id,
+                chapter_index=task["chapter_index"],
+                **params
+            )
+            prompt_report = self.generator.last_prompt_report or {}
+            tokens = prompt_report.get("total_tokens", 0) + estimate_tokens(content)
+        except Exception as e:
+            print(f"调度生成失败 {novel_id} 第{task['chapter_index']}章: {e}")
+            error = str(e)
+        
+        with self._cond:
+            self._model_in_flight[model_name] -= 1
+            self._provider_in_flight[provider] -= 1
+            stats = self._model_stats.setdefault(model_name, {"succeeded": 0, "failed": 0, "seconds": 0.0})
+            stats["failed" if error else "succeeded"] += 1
+            stats["seconds"] += time.time() - task["started_at"]
+            if tokens:
+                self._chapter_tokens = self._chapter_tokens * 0.8 + tokens * 0.2
+            # 模型额度已释放，先把空闲容量分给其他小说
+            self._dispatch_locked()
+        
+        # 下一章依赖本章更新后的状态，状态更新完成前不放行同一小说
+        if not error:
+            self.generator.state_updates.wait_for_novel(novel_id)
+        
+        with self._cond:
+            task.update(status="failed" if error else "succeeded", error=error, finished_at=time.time(), params={})
+            self._active.discard(novel_id)
+            queued = self._queues.get(novel_id) or []
+            if error:
+                # 后续章节依赖本章，全部跳过
+                for skipped in queued:
+                    skipped.update(status="skipped", error=f"第{task['chapter_index']}章生成失败", finished_at=time.time(), params={})
+                queued.clear()
+            if queued:
+                self._ready.append(novel_id)
+            else:
+                self._queues.pop(novel_id, None)
+            self._dispatch_locked()
+            self._cond.notify_all()
+
+    def cancel_novel(self, novel_id: str) -> int:
+        """取消小说排队中的章节（进行中的章节继续完成），返回取消数量"""
+        with self._cond:
+            queued = self._queues.pop(novel_id, [])
+            for task in queued:
+                task.update(status="cancelled", finished_at=time.time(), params={})
+            if novel_id in self._ready:
+                self._ready.remove(novel_id)
+            self._cond.notify_all()
+            return len(queued)
+
+    def pause(self):
+        """停止分配新章节，进行中的章节继续完成"""
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._dispatch_locked()
+
+    def wait_idle(self, timeout: Optional[float] = None, include_queued: bool = False) -> bool:
+        """等待进行中的章节（include_queued时包括排队章节）全部结束，超时返回False"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._active or (include_queued and self._queues):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _trim_history_locked(self):
+        while len(self._tasks) > self.history_size:
+            oldest_id, oldest = next(iter(self._tasks.items()))
+            if oldest["finished_at"] is None:
+                break
+            self._tasks.pop(oldest_id)
+
+    @staticmethod
+    def _public(task: Dict[str, Any]) -> Dict[str, Any]:
+        result = {k: v for k, v in task.items() if k != "params"}
+        if task["finished_at"] and task["started_at"]:
+            result["duration"] = round(task["finished_at"] - task["started_at"], 3)
+        return result
+
+    def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            task = self._tasks.get(task_id)
+            return self._public(task) if task else None
+
+    def get_status(self, novel_id: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+        """各小说排队/进行中章节数、模型与服务商负载，以及最近的任务"""
+        with self._cond:
+            novels = {
+                nid: {"queued": len(self._queues.get(nid, [])), "in_flight": nid in self._active}
+                for nid in set(self._queues) | self._active
+                if novel_id is None or nid == novel_id
+            }
+            providers = {}
+            for model_name in set(self.models) | set(self._model_in_flight):
+                provider = LLMConfigManager.get_provider(model_name)
+                providers[provider] = {
+                    "in_flight": self._provider_in_flight[provider],
+                    "max_in_flight": LLMConfigManager.get_provider_limits(provider)["max_in_flight"]
+                }
+            models = {
+                model_name: {
+                    "succeeded": self._model_stats.get(model_name, {}).get("succeeded", 0),
+                    "failed": self._model_stats.get(model_name, {}).get("failed", 0),
+                    "seconds": round(self._model_stats.get(model_name, {}).get("seconds", 0.0), 1),
+                    "in_flight": self._model_in_flight[model_name]
+                }
+                for model_name in set(self.models) | set(self._model_in_flight)
+            }
+            tasks = [
+                self._public(task) for task in reversed(self._tasks.values())
+                if novel_id is None or task["novel_id"] == novel_id
+            ][:limit]
+            return {
+                "paused": self._paused,
+                "max_workers": self.max_workers,
+                "running": len(self._active),
+                "queued": sum(len(q) for q in self._queues.values()),
+                "chapter_tokens_estimate": int(self._chapter_tokens),
+                "novels": novels,
+                "models": models,
+                "providers": providers,
+                "tasks": tasks
+            }
+
+class JobQueue:
+    """持久化的后台任务队列
+
+    每个任务保存为jobs目录下的一个JSON文件，状态变化时原子写入；
+    启动时（含工作进程被重新拉起）所属进程已退出的未完成（queued/running）任务按创建顺序重新入队。
+    """
+    
+    STATUSES = ("queued", "running", "succeeded", "failed")
+    FINISHED_STATUSES = ("succeeded", "failed")
+    # 清理已结束任务的最小间隔(秒)
+    PRUNE_INTERVAL = 600
+    
+    def __init__(
+        self,
+        handler: Callable[[Dict[str, Any]], Any],
+        jobs_path: str = "./jobs",
+        max_workers: int = 2,
+        retention_seconds: float = 7 * 86400,
+        metrics_window: int = 200,
+        max_finished_in_memory: int = 500
+    ):
+        """
+        Args:
+            handler: 任务执行函数，接收任务参数，返回值作为任务结果保存
+            jobs_path: 任务记录存储目录
+            max_workers: 并发执行任务的线程数
+            retention_seconds: 已结束任务记录的保留时间，超时的记录在启动时及运行中定期清理
+            metrics_window: 统计等待/执行耗时所用的最近任务数
+            max_finished_in_memory: 内存中保留的已结束任务数，更早的任务查询时从磁盘读取
+        """
+        self.handler = handler
+        self.jobs_path = jobs_path
+        self.max_workers = max(1, max_workers)
+        self.retention_seconds = retention_seconds
+        self.max_finished_in_memory = max_finished_in_memory
+        os.makedirs(self.jobs_path, exist_ok=True)
+        
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._pending: List[str] = []
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._paused = False
+        self._running = 0
+        self._wait_times: List[float] = []
+        self._run_times: List[float] = []
+        self._metrics_window = metrics_window
+        self._counts = {"submitted": 0, "succeeded": 0, "failed": 0, "recovered": 0}
+        self._last_prune = 0.0
+        # 已移出内存但未过保留期的任务: (finished_at, job_id)
+        self._evicted: List[tuple] = []
+        self._owner_pid = os.getpid()
+    
+    def _job_file(self, job_id: str) -> str:
+        return os.path.join(self.jobs_path, f"{job_id}.json")
+    
+    def _persist(self, job: Dict[str, Any]):
+        """原子写入任务记录，避免崩溃时留下半个文件"""
+        job_file = self._job_file(job["job_id"])
+        tmp_file = job_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, job_file)
+    
+    def start(self, recover: bool = True):
+        """恢复未完成的任务并启动工作线程（幂等）
+
+        线程不会随fork复制：在fork出的子进程（如gunicorn工作进程）中调用时丢弃父进程的线程与锁状态后重新启动。
+        
+        Args:
+            recover: 是否恢复磁盘上所属进程已退出的未完成任务
+        """
+        if self._owner_pid != os.getpid():
+            self._cond = threading.Condition()
+            self._workers = []
+            self._jobs = {}
+            self._pending = []
+            self._evicted = []
+            self._running = 0
+            self._owner_pid = os.getpid()
+        with self._cond:
+            if self._workers:
+                return
+            if recover:
+                self._recover()
+            for i in range(self.max_workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+    
+    @staticmethod
+    def _owner_alive(pid: Optional[int]) -> bool:
+        """任务所属进程是否仍在运行；本进程启动前记录的同一pid视为已退出（pid被复用）"""
+        if not pid or pid == os.getpid() or os.name == "nt":
+            # Windows的os.kill(pid, 0)会发送CTRL_C_EVENT，且只支持单进程部署
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    
+    def _recover(self):
+        """接管所属进程已退出的未完成任务；锁文件保证同时启动的进程不会重复接管"""
+        now = time.time()
+        recovered = []
+        with file_lock(os.path.join(self.jobs_path, ".recover.lock")):
+            for filename in os.listdir(self.jobs_path):
+                if not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.jobs_path, filename), 'r', encoding='utf-8') as f:
+                        job = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"跳过损坏的任务记录 {filename}: {e}")
+                    continue
+                
+                if job.get("status") in ("queued", "running"):
+                    if self._owner_alive(job.get("owner_pid")):
+                        # 仍由其他进程执行，查询时从磁盘读取
+                        continue
+                    if job["status"] == "running":
+                        # 执行中被中断的任务从头重新执行
+                        job["status"] = "queued"
+                        job["started_at"] = None
+                        self._counts["recovered"] += 1
+                    job["owner_pid"] = os.getpid()
+                    recovered.append(job)
+                elif now - (job.get("finished_at") or now) > self.retention_seconds:
+                    os.remove(os.path.join(self.jobs_path, filename))
+                    continue
+                self._jobs[job["job_id"]] = job
+            
+            recovered.sort(key=lambda job: job["created_at"])
+            for job in recovered:
+                self._persist(job)
+                self._pending.append(job["job_id"])
+        if recovered:
+            print(f"恢复 {len(recovered)} 个未完成的任务")
+        self._prune_locked(force=True)
+    
+    def _prune_locked(self, force: bool = False):
+        """删除超过保留期的已结束任务记录，内存中只保留最近的已结束任务（调用方需持有self._cond）"""
+        now = time.time()
+        if not force and now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        finished = [job for job in self._jobs.values() if job["status"] in self.FINISHED_STATUSES]
+        finished.sort(key=lambda job: job.get("finished_at") or now, reverse=True)
+        for position, job in enumerate(finished):
+            if now - (job.get("finished_at") or now) > self.retention_seconds:
+                self._remove_job_file(job["job_id"])
+                del self._jobs[job["job_id"]]
+            elif position >= self.max_finished_in_memory:
+                self._evicted.append((job.get("finished_at") or now, job["job_id"]))
+                del self._jobs[job["job_id"]]
+        
+        evicted = []
+        for finished_at, job_id in self._evicted:
+            if now - finished_at > self.retention_seconds:
+                self._remove_job_file(job_id)
+            else:
+                evicted.append((finished_at, job_id))
+        self._evicted = evicted
+    
+    def _remove_job_file(self, job_id: str):
+        try:
+            os.remove(self._job_file(job_id))
+        except FileNotFoundError:
+            pass
+    
+    def submit(self, kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """提交任务，返回任务记录（含job_id与排队位置）"""
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "params": params,
+            "result": None,
+            "error": None,
+            "attempts": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "owner_pid": os.getpid()
+        }
+        with self._cond:
+            self._persist(job)
+            self._jobs[job["job_id"]] = job
+            self._pending.append(job["job_id"])
+            self._counts["submitted"] += 1
+            position = len(self._pending)
+            self._prune_locked()
+            self._cond.notify()
+        return {**self._public(job), "queue_position": position}
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """获取任务状态与结果"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job:
+                result = self._public(job)
+                if job["status"] == "queued":
+                    result["queue_position"] = self._pending.index(job_id) + 1
+                return result
+        
+        # 已移出内存或由其他进程执行的任务从磁盘读取
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            with open(self._job_file(job_id), 'r', encoding='utf-8') as f:
+                return self._public(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            return None
+    
+    def list_jobs(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近的任务（不含结果正文）"""
+        with self._cond:
+            jobs = sorted(self._jobs.values(), key=lambda job: job["created_at"], reverse=True)[:limit]
+            return [{k: v for k, v in self._public(job).items() if k != "result"} for job in jobs]
+    
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in job.items() if k not in ("params", "owner_pid")}
+    
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while self._paused or not self._pending:
+                    self._cond.wait()
+                job = self._jobs[self._pending.pop(0)]
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                job["attempts"] += 1
+                self._running += 1
+                self._record(self._wait_times, job["started_at"] - job["created_at"])
+                self._persist(job)
+            
+            try:
+                result = self.handler(job["params"])
+                status, error = "succeeded", None
+            except Exception as e:
+                print(f"任务 {job['job_id']} 执行失败: {e}")
+                result, status, error = None, "failed", str(e)
+            
+            with self._cond:
+                job["status"] = status
+                job["result"] = result
+                job["error"] = error
+                job["finished_at"] = time.time()
+                self._running -= 1
+                self._counts[status] += 1
+                self._record(self._run_times, job["finished_at"] - job["started_at"])
+                self._persist(job)
+                self._prune_locked()
+                self._cond.notify_all()
+    
+    def _record(self, samples: List[float], value: float):
+        samples.append(value)
+        if len(samples) > self._metrics_window:
+            del samples[0]
+    
+    def pause(self):
+        """停止领取新任务，排队中的任务保留在磁盘上，重启后继续"""
+        with self._cond:
+            self._paused = True
+    
+    def wait_idle(self, timeout: float) -> bool:
+        """等待执行中的任务完成，超时返回False"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._running > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """队列深度、执行数与最近任务的等待/执行耗时"""
+        def summarize(samples):
+            if not samples:
+                return {"avg": 0.0, "max": 0.0}
+            return {"avg": round(sum(samples) / len(samples), 3), "max": round(max(samples), 3)}
+        
+        with self._cond:
+            oldest_wait = 0.0
+            if self._pending:
+                oldest_wait = time.time() - self._jobs[self._pending[0]]["created_at"]
+            return {
+                "queue_depth": len(self._pending),
+                "running": self._running,
+                "workers": self.max_workers,
+                "paused": self._paused,
+                "oldest_wait_seconds": round(oldest_wait, 3),
+                "wait_seconds": summarize(self._wait_times),
+                "run_seconds": summarize(self._run_times),
+                **self._counts
+            }
+
 
 # === 示例使用 ===
 if __name__ == "__main__":
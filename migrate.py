@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+小说生成系统 - 数据迁移工具
+用法:
+    python migrate.py memory-jsonl [--memory-path ./memory] [--session SESSION_ID]
+    python migrate.py shard-layout [--dry-run]
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from main import MemoryManager, MemoryIndexManager, StateManager
+
+# 平铺目录中可按小说/会话拆分的文件: (子目录, 文件名模式)，模式的第一个分组为小说ID或会话ID
+SHARD_RULES = {
+    "data": [("", StateManager.STATE_FILE_RE), ("", StateManager.WORLD_FILE_RE)],
+    "xiaoshuo": [
+        ("", re.compile(r'^(.+)_chapter_\d+\.txt$')),
+        ("", re.compile(r'^(.+)_novel_\d+_\d+\.txt$'))
+    ],
+    "versions": [("", re.compile(r'^(.+)_chapter_\d+_versions\.json$'))],
+    "chapter_summaries": [("", re.compile(r'^(.+)_chapter_\d+_summary\.json$'))],
+    "retrieval_index": [("", re.compile(r'^(.+)_retrieval\.json$'))],
+    "memory": [
+        ("", re.compile(r'^(.+)_index\.json$')),
+        ("chunks", re.compile(r'^(.+)_chunk_\d+\.jsonl?$')),
+        ("summaries", re.compile(r'^(.+)_summary_\d+\.json$'))
+    ]
+}
+
+def migrate_memory_jsonl(args):
+    """将旧版JSON记忆分片转换为追加写入的JSONL格式"""
+    print(f"📦 转换记忆分片: {args.memory_path}")
+    memory_manager = MemoryManager(memory_path=args.memory_path)
+    converted = memory_manager.migrate_legacy_chunks(args.session)
+    print(f"✅ 已转换 {converted} 个分片")
+    return 0
+
+def migrate_shard_layout(args):
+    """将平铺目录中的文件迁移到按小说分目录的布局"""
+    moved = 0
+    skipped = 0
+    for base_dir, rules in SHARD_RULES.items():
+        base_path = os.path.join(args.root, base_dir)
+        for sub_dir, pattern in rules:
+            source_dir = os.path.join(base_path, sub_dir)
+            if not os.path.isdir(source_dir):
+                continue
+            print(f"📁 {source_dir}")
+            for filename in sorted(os.listdir(source_dir)):
+                source = os.path.join(source_dir, filename)
+                match = pattern.match(filename)
+                if not match or not match.group(1) or not os.path.isfile(source):
+                    continue
+                owner_id = match.group(1)
+                if base_dir == "memory" and owner_id in MemoryIndexManager.RESERVED_DIRS:
+                    continue
+                
+                target_dir = os.path.join(base_path, owner_id, sub_dir)
+                target = os.path.join(target_dir, filename)
+                if os.path.exists(target):
+                    print(f"   ⚠️  目标已存在，跳过: {target}")
+                    skipped += 1
+                    continue
+                if args.dry_run:
+                    print(f"   {filename} -> {target}")
+                else:
+                    os.makedirs(target_dir, exist_ok=True)
+                    os.replace(source, target)
+                moved += 1
+    
+    action = "将迁移" if args.dry_run else "已迁移"
+    print(f"✅ {action} {moved} 个文件，跳过 {skipped} 个")
+    if not args.dry_run:
+        print("💡 请在 .env 中设置 NOVEL_STORAGE_LAYOUT=\"sharded\" 使新文件按小说分目录写入")
+    return 0
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="小说生成系统数据迁移工具")
+    subparsers = parser.add_subparsers(dest="command")
+
+    memory_parser = subparsers.add_parser("memory-jsonl", help="将记忆分片转换为JSONL格式")
+    memory_parser.add_argument("--memory-path", default="./memory", help="记忆存储目录")
+    memory_parser.add_argument("--session", default=None, help="只转换指定会话")
+    memory_parser.set_defaults(func=migrate_memory_jsonl)
+
+    shard_parser = subparsers.add_parser("shard-layout", help="将data/、xiaoshuo/、versions/、chapter_summaries/、retrieval_index/、memory/迁移为按小说分目录的布局")
+    shard_parser.add_argument("--root", default=".", help="项目根目录")
+    shard_parser.add_argument("--dry-run", action="store_true", help="只显示将要迁移的文件")
+    shard_parser.set_defaults(func=migrate_shard_layout)
+
+    args = parser.parse_args()
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,11 @@
 
 import os
 import sys
-import subprocess
 import json
+import argparse
+import signal
+import threading
+import _thread
 
 def check_dependencies():
     """检查依赖包"""
@@ -141,8 +144,125 @@ def check_environment():
     print("✅ 环境配置文件存在")
     return True
 
+def parse_args():
+    """解析启动参数"""
+    parser = argparse.ArgumentParser(description="小说生成系统 - Web服务")
+    parser.add_argument("--server", choices=["auto", "waitress", "gunicorn", "dev"],
+                        default=os.getenv("WEB_SERVER", "auto"),
+                        help="服务模式: auto(优先waitress) / waitress / gunicorn(仅Linux/macOS) / dev(Flask开发服务器)")
+    parser.add_argument("--host", default=os.getenv("WEB_HOST", "0.0.0.0"), help="监听地址")
+    parser.add_argument("--port", type=int, default=int(os.getenv("WEB_PORT", "5001")), help="监听端口")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "1")),
+                        help="工作进程数（仅gunicorn，目前只支持1，并发请增加--threads）")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "16")),
+                        help="每个进程的工作线程数")
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WEB_TIMEOUT", "600")),
+                        help="请求超时秒数，需覆盖较长的LLM生成")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("WEB_GRACEFUL_TIMEOUT", "600")),
+                        help="停机时等待进行中生成完成的最长秒数")
+    args = parser.parse_args()
+    if args.workers != 1:
+        # 批量生成与调度的进行中标记、记忆索引缓存、调用统计都在进程内，多进程下无法互相感知
+        parser.error("--workers 目前只支持1：批量生成、章节调度与调用统计的状态保存在进程内，请用 --threads 提高并发")
+    return args
+
+def resolve_server(server):
+    """auto模式下优先使用waitress，未安装时退回开发服务器"""
+    if server != "auto":
+        return server
+    try:
+        import waitress
+        return "waitress"
+    except ImportError:
+        print("⚠️  未安装waitress，使用Flask开发服务器（pip install waitress 以启用生产模式）")
+        return "dev"
+
+def run_waitress(app, args):
+    """waitress多线程服务，收到停止信号后等待进行中的生成完成再退出"""
+    import web_server
+    from waitress.server import create_server
+    
+    server = create_server(
+        app,
+        host=args.host,
+        port=args.port,
+        threads=args.threads,
+        channel_timeout=args.timeout
+    )
+    
+    def drain_and_stop():
+        web_server.start_draining()
+        if not web_server.wait_for_generations(args.graceful_timeout):
+            print("⚠️  等待超时，仍有生成任务未完成")
+        _thread.interrupt_main()
+    
+    def handle_signal(signum, frame):
+        if web_server._generation_state["draining"]:
+            # 再次收到信号或等待结束：立即停止
+            raise KeyboardInterrupt
+        print("\n⏳ 正在停止服务，等待进行中的生成完成（再按一次Ctrl+C强制退出）...")
+        threading.Thread(target=drain_and_stop, daemon=True).start()
+    
+    signal.signal(signal.SIGINT, handle_signal)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, handle_signal)
+    
+    server.run()
+
+def run_gunicorn(app, args):
+    """gunicorn单进程多线程服务（gthread），SIGTERM时按graceful_timeout等待进行中的请求
+
+    固定一个工作进程：批量生成的进行中标记、按小说串行的章节调度、记忆索引缓存与调用统计都在进程内，
+    多个工作进程之间无法共享；gunicorn负责在工作进程异常退出后重新拉起。
+    """
+    from gunicorn.app.base import BaseApplication
+    import web_server
+    
+    def post_worker_init(worker):
+        # 后台任务线程在工作进程中启动（fork不会复制线程），重新拉起的工作进程同样恢复未完成任务
+        web_server.start_background()
+        
+        # 工作进程收到SIGTERM（主进程平滑停机）时先停止接收新的生成，再交给gunicorn的退出流程；
+        # 信号处理函数中不直接加锁，放到线程里执行
+        handle_exit = worker.handle_exit
+        
+        def handle_term(signum, frame):
+            threading.Thread(target=web_server.start_draining, daemon=True).start()
+            handle_exit(signum, frame)
+        
+        signal.signal(signal.SIGTERM, handle_term)
+    
+    def worker_exit(server, worker):
+        web_server.start_draining()
+        web_server.shutdown_cleanup(args.graceful_timeout)
+    
+    class NovelApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": 1,
+                "threads": args.threads,
+                "worker_class": "gthread",
+                "timeout": args.timeout,
+                "graceful_timeout": args.graceful_timeout,
+                "keepalive": 75,
+                "post_worker_init": post_worker_init,
+                "worker_int": lambda worker: web_server.start_draining(),
+                "worker_abort": lambda worker: web_server.start_draining(),
+                "worker_exit": worker_exit
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return app
+    
+    NovelApplication().run()
+
 def main():
     """主函数"""
+    args = parse_args()
+    
     print("🎭 小说生成系统 - Web服务启动")
     print("=" * 50)
     
@@ -165,7 +285,9 @@ def main():
     if not env_ok:
         print("⚠️  环境配置可能不完整，但仍将启动服务器")
     
-    print("🌐 访问地址: http://localhost:5001")
+    server = resolve_server(args.server)
+    print(f"🌐 访问地址: http://localhost:{args.port}")
+    print(f"⚙️  服务模式: {server} (线程: {args.threads}, 超时: {args.timeout}秒)")
     print("📖 功能说明:")
     print("   - 模版管理: 创建、编辑、预览提示词模版")
     print("   - 小说生成: 基于模版和参数生成小说章节")
@@ -174,18 +296,30 @@ def main():
     
     try:
         # 导入并启动web服务器
-        from web_server import app
-        app.run(
-            host='0.0.0.0',
-            port=5001,
-            debug=False,  # 生产模式
-            threaded=True
-        )
+        import web_server
+        app = web_server.app
+        if server == "waitress":
+            web_server.start_background()
+            run_waitress(app, args)
+        elif server == "gunicorn":
+            run_gunicorn(app, args)
+        else:
+            web_server.start_background()
+            app.run(
+                host=args.host,
+                port=args.port,
+                debug=False,  # 生产模式
+                threaded=True
+            )
     except KeyboardInterrupt:
-        print("\n👋 服务器已停止")
+        pass
     except Exception as e:
         print(f"\n❌ 启动失败: {e}")
         sys.exit(1)
+    finally:
+        if "web_server" in sys.modules:
+            sys.modules["web_server"].shutdown_cleanup(args.graceful_timeout)
+    print("\n👋 服务器已停止")
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
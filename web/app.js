@@ -555,11 +555,25 @@ class BatchGenerator {
             update_state: document.getElementById('batchUpdateState').checked,
             session_id: novelId,
             novel_id: novelId,
+            chapter_index: chapterIndex,
             use_previous_chapters: document.getElementById('batchUsePreviousChapters').checked,
             previous_chapters_count: parseInt(document.getElementById('batchPreviousChaptersCount').value) || 1
         };
 
-        // 3. 调用生成API
+        // 检索与细纲相关的前文片段
+        if (document.getElementById('batchUseRetrieval').checked) {
+            generateData.use_retrieval = true;
+        }
+
+        // 更早章节使用摘要（分层前文模式）
+        const summaryChaptersCount = parseInt(document.getElementById('batchSummaryChaptersCount').value) || 0;
+        if (summaryChaptersCount > 0) {
+            generateData.previous_chapters_mode = 'hierarchical';
+            generateData.summary_chapters_count = summaryChaptersCount;
+        }
+
+        // 3. 调用生成API（流式返回，逐段渲染）
+        generateData.stream = true;
         const response = await fetch(`${API_BASE}/generate`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
@@ -571,41 +585,64 @@ class BatchGenerator {
             throw new Error(error.error || '生成失败');
         }
 
-        const result = await response.json();
-
-        // 4. 自动保存到正确的文件路径
-        await this.autoSaveChapter(result.content, novelId, chapterIndex);
+        const preview = document.getElementById('batchPreview');
+        preview.textContent = '';
+        const result = await this.readGenerateStream(response, (delta) => {
+            preview.textContent += delta;
+            preview.scrollTop = preview.scrollHeight;
+        });
 
+        // 4. 章节已由服务端按chapter_index保存，无需再调用保存接口
         this.addLog(`第 ${chapterIndex} 章生成成功 (${result.word_count} 字)，已自动保存`, 'success');
         this.showLoadingState(`第 ${chapterIndex} 章生成完成，继续生成下一章...`, 'info');
     }
 
-    async autoSaveChapter(content, novelId, chapterIndex) {
-        try {
-            // 调用后端保存API，使用正确的文件命名格式
-            const saveData = {
-                content: content,
-                novel_id: novelId,
-                chapter_index: chapterIndex,
-                auto_save: true  // 标识这是自动保存
-            };
-
-            const response = await fetch(`${API_BASE}/save-chapter`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(saveData)
-            });
-
-            if (!response.ok) {
-                throw new Error('自动保存失败');
+    async readGenerateStream(response, onDelta) {
+        // 解析Server-Sent-Events：data为文本增量，done/error为结束事件
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        let content = '';
+        let result = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                let dataText = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventName = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataText += line.slice(5).trim();
+                    }
+                });
+                if (!dataText) continue;
+
+                const payload = JSON.parse(dataText);
+                if (eventName === 'error') {
+                    throw new Error(payload.error || '生成失败');
+                } else if (eventName === 'done') {
+                    result = payload;
+                } else if (payload.delta) {
+                    content += payload.delta;
+                    onDelta(payload.delta);
+                }
             }
+        }
 
-            const result = await response.json();
-            this.addLog(`章节已保存为: ${result.filename}`, 'info');
-
-        } catch (error) {
-            this.addLog(`自动保存失败: ${error.message}`, 'warning');
+        if (!result) {
+            throw new Error('生成连接意外中断');
         }
+        result.content = content;
+        return result;
     }
 
     async loadChapterOutline(novelId, chapterIndex) {
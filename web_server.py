@@ -9,9 +9,10 @@ import os
 import json
 import time
 import sys
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
-from main import NovelGenerator, LLMCaller
+from main import NovelGenerator, NovelBatchDriver, NovelScheduler, LLMCaller, LLMConfigManager, ModelRouter, LLMClientRegistry, LLMResponseCache, LLMUsageStats, LLMCallLog, JobQueue, PerfMetrics, Tracer
 
 app = Flask(__name__)
 CORS(app)
@@ -32,6 +33,147 @@ os.makedirs(XIAOSHUO_DIR, exist_ok=True)
 # 全局实例
 generator = NovelGenerator()
 
+# 单次请求最多的候选版本数
+MAX_CANDIDATES = 8
+
+# 进行中的生成任务计数，用于停机时等待生成完成
+_generation_lock = threading.Condition()
+_generation_state = {"in_flight": 0, "draining": False}
+
+def begin_generation(force=False):
+    """登记一个生成任务，服务正在停机时返回False（force为True时总是登记）"""
+    with _generation_lock:
+        if _generation_state["draining"] and not force:
+            return False
+        _generation_state["in_flight"] += 1
+        return True
+
+def end_generation():
+    """生成任务结束"""
+    with _generation_lock:
+        _generation_state["in_flight"] = max(0, _generation_state["in_flight"] - 1)
+        _generation_lock.notify_all()
+
+def start_draining():
+    """停止接收新的生成任务，队列中的任务留待重启后执行，批量生成在当前章节完成后停止"""
+    with _generation_lock:
+        _generation_state["draining"] = True
+    job_queue.pause()
+    scheduler.pause()
+    with _batch_lock:
+        for driver in batch_drivers.values():
+            driver.stop()
+
+def wait_for_generations(timeout):
+    """等待进行中的生成任务完成，超时返回False"""
+    deadline = time.time() + timeout
+    with _generation_lock:
+        while _generation_state["in_flight"] > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            _generation_lock.wait(remaining)
+        return True
+
+def run_generate_job(params):
+    """后台任务：执行一次章节生成"""
+    begin_generation(force=True)
+    try:
+        with Tracer.span("job.generate", traceparent=params.get("traceparent")) as span:
+            content = generator.generate_chapter(**params["generate_kwargs"])
+    finally:
+        end_generation()
+    return {
+        "content": content,
+        "trace_id": span.trace_id if span else None,
+        "template_used": params["template_used"],
+        "novel_id": params["generate_kwargs"]["novel_id"],
+        "word_count": len(content),
+        "prompt_tokens": generator.last_prompt_report,
+        "state_update": generator.last_state_update,
+        "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+# 正在运行的整本批量生成，按小说ID索引
+batch_drivers = {}
+# 运行批量生成的线程，按小说ID索引；驱动在线程进入run()前状态为pending，是否占用以线程存活为准
+_batch_threads = {}
+_batch_lock = threading.Lock()
+
+def run_batch_driver(driver):
+    """后台线程：运行整本批量生成"""
+    begin_generation(force=True)
+    try:
+        driver.run()
+    except Exception as e:
+        print(f"批量生成失败: {e}")
+    finally:
+        end_generation()
+
+# 后台线程不在导入时启动：gunicorn主进程导入本模块后fork工作进程，线程不会随fork复制
+job_queue = JobQueue(run_generate_job, max_workers=int(os.getenv("JOB_WORKERS", "2")))
+_background_lock = threading.Lock()
+
+def start_background(recover_jobs=True):
+    """在当前进程启动后台任务队列（幂等），由启动脚本在服务进程中调用，提交任务时也会自动启动
+
+    Args:
+        recover_jobs: 是否恢复磁盘上未完成的任务，多进程部署时只由一个工作进程恢复
+    """
+    with _background_lock:
+        job_queue.start(recover=recover_jobs)
+
+# 多小说并发调度，模型池由SCHEDULER_MODELS环境变量配置
+scheduler = NovelScheduler(generator, max_workers=int(os.getenv("SCHEDULER_WORKERS", "8")))
+
+# /metrics 导出时读取的队列与进行中任务数
+PerfMetrics.registry.gauge_callback(
+    "novel_http_generations_in_flight", "Web接口正在执行的生成请求数", lambda: _generation_state["in_flight"])
+PerfMetrics.registry.gauge_callback(
+    "novel_queue_depth", "各后台队列的排队数",
+    lambda: {
+        ("jobs",): job_queue.get_metrics()["queue_depth"],
+        ("scheduler",): scheduler.get_status(limit=0)["queued"],
+        ("state_updates",): generator.state_updates.get_status(limit=0)["queued"]
+    },
+    ("queue",))
+PerfMetrics.registry.gauge_callback(
+    "novel_queue_running", "各后台队列正在执行的任务数",
+    lambda: {
+        ("jobs",): job_queue.get_metrics()["running"],
+        ("scheduler",): scheduler.get_status(limit=0)["running"],
+        ("state_updates",): generator.state_updates.get_status(limit=0)["running"]
+    },
+    ("queue",))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """按路由规则（而非实际路径）统计请求数与耗时，避免小说ID等参数产生大量标签"""
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        PerfMetrics.http_requests.inc((route, request.method, str(response.status_code)))
+        PerfMetrics.http_duration.observe(time.perf_counter() - started, (route,))
+    return response
+
+def shutdown_cleanup(timeout=0):
+    """停机前等待执行中的后台任务与状态更新，落盘延迟写入的数据并关闭LLM客户端"""
+    job_queue.pause()
+    if timeout and not job_queue.wait_idle(timeout):
+        print("⚠️  仍有后台任务未完成，重启后将重新执行")
+    scheduler.pause()
+    if timeout and not scheduler.wait_idle(timeout):
+        print("⚠️  仍有调度中的章节未完成")
+    if timeout and not generator.state_updates.wait_all(timeout):
+        print("⚠️  仍有状态更新未完成")
+    generator.memory_manager.flush()
+    generator.retrieval_index.flush()
+    LLMClientRegistry.close_all()
+
 def load_template_index():
     """加载模版索引文件"""
     index_file = os.path.join(TEMPLATES_DIR, "template_index.json")
@@ -40,6 +182,31 @@ def load_template_index():
             return json.load(f)
     return {"version": "1.0", "templates": {}}
 
+def load_system_prompt(template):
+    """读取模版的写作角色和写作规则，组合为系统提示"""
+    writer_role_file = os.path.join(TEMPLATES_DIR, template['files']['writer_role'])
+    writing_rules_file = os.path.join(TEMPLATES_DIR, template['files']['writing_rules'])
+    
+    writer_role = ""
+    writing_rules = ""
+    
+    if os.path.exists(writer_role_file):
+        with open(writer_role_file, 'r', encoding='utf-8') as f:
+            writer_role = f.read()
+    
+    if os.path.exists(writing_rules_file):
+        with open(writing_rules_file, 'r', encoding='utf-8') as f:
+            writing_rules = f.read()
+    
+    return f"{writer_role}\n\n{writing_rules}".strip()
+
+def sse_event(data, event=None):
+    """格式化一条Server-Sent-Events消息"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
 def save_template_index(index_data):
     """保存模版索引文件"""
     index_file = os.path.join(TEMPLATES_DIR, "template_index.json")
@@ -61,8 +228,15 @@ def static_files(filename):
 @app.route('/api/health')
 def health_check():
     """健康检查"""
+    if _generation_state["draining"]:
+        return jsonify({"status": "draining", "message": "服务正在停机"}), 503
     return jsonify({"status": "ok", "message": "API服务正常"})
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus格式的运行指标"""
+    return Response(PerfMetrics.registry.expose(), content_type=PerfMetrics.registry.CONTENT_TYPE)
+
 @app.route('/api/templates', methods=['GET'])
 def get_templates():
     """获取模版列表"""
@@ -154,8 +328,17 @@ def generate_novel():
         update_state = data.get("update_state", False)
         session_id = data.get("session_id", "default")
         novel_id = data.get("novel_id")
+        chapter_index = data.get("chapter_index")
         use_previous_chapters = data.get("use_previous_chapters", False)
         previous_chapters_count = data.get("previous_chapters_count", 1)
+        previous_chapters_mode = data.get("previous_chapters_mode", "verbatim")
+        summary_chapters_count = data.get("summary_chapters_count", 20)
+        use_retrieval = data.get("use_retrieval", False)
+        retrieval_max_chars = data.get("retrieval_max_chars", 3000)
+        prompt_layout = data.get("prompt_layout")
+        stream = data.get("stream", False)
+        run_async = data.get("async", False)
+        use_cache = data.get("use_cache")
         
         if not template_id:
             return jsonify({"error": "缺少模版ID"}), 400
@@ -170,26 +353,10 @@ def generate_novel():
         
         template = index_data['templates'][template_id]
         
-        # 读取模版文件内容
-        writer_role_file = os.path.join(TEMPLATES_DIR, template['files']['writer_role'])
-        writing_rules_file = os.path.join(TEMPLATES_DIR, template['files']['writing_rules'])
-        
-        writer_role = ""
-        writing_rules = ""
-        
-        if os.path.exists(writer_role_file):
-            with open(writer_role_file, 'r', encoding='utf-8') as f:
-                writer_role = f.read()
-        
-        if os.path.exists(writing_rules_file):
-            with open(writing_rules_file, 'r', encoding='utf-8') as f:
-                writing_rules = f.read()
-        
         # 构建系统提示
-        system_prompt = f"{writer_role}\n\n{writing_rules}".strip()
+        system_prompt = load_system_prompt(template)
         
-        # 生成内容
-        content = generator.generate_chapter(
+        generate_kwargs = dict(
             chapter_outline=chapter_outline,  # 使用章节细纲
             model_name=model_name,
             system_prompt=system_prompt,
@@ -199,23 +366,460 @@ def generate_novel():
             update_state=update_state,
             update_model_name=update_model_name,
             novel_id=novel_id,
+            chapter_index=int(chapter_index) if chapter_index else None,
             use_previous_chapters=use_previous_chapters,
-            previous_chapters_count=previous_chapters_count
+            previous_chapters_count=previous_chapters_count,
+            use_cache=use_cache,
+            previous_chapters_mode=previous_chapters_mode,
+            summary_chapters_count=summary_chapters_count,
+            use_retrieval=use_retrieval,
+            retrieval_max_chars=retrieval_max_chars,
+            prompt_layout=prompt_layout
         )
         
-        return jsonify({
+        if _generation_state["draining"]:
+            return jsonify({"error": "服务正在停机，请稍后重试"}), 503
+        
+        # 异步模式：加入任务队列，立即返回job_id
+        if run_async:
+            start_background()
+            job = job_queue.submit("generate", {
+                "generate_kwargs": generate_kwargs,
+                "template_used": template.get('name', template_id),
+                "traceparent": request.headers.get("traceparent")
+            })
+            return jsonify(job), 202
+        
+        if not begin_generation():
+            return jsonify({"error": "服务正在停机，请稍后重试"}), 503
+        
+        # 上游传入traceparent时归入同一条追踪；trace_id随响应返回，用于在traces/中查找各环节耗时
+        traceparent = request.headers.get("traceparent")
+        
+        # 流式模式：以Server-Sent-Events逐段返回文本
+        if stream:
+            trace_id = Tracer.trace_id_for(traceparent)
+            
+            def event_stream():
+                word_count = 0
+                try:
+                    with Tracer.span("POST /api/generate", traceparent=traceparent, trace_id=trace_id, stream=True):
+                        for delta in generator.generate_chapter_stream(**generate_kwargs):
+                            word_count += len(delta)
+                            yield sse_event({"delta": delta})
+                    yield sse_event({
+                        "template_used": template.get('name', template_id),
+                        "novel_id": novel_id,
+                        "word_count": word_count,
+                        "prompt_tokens": generator.last_prompt_report,
+                        "state_update": generator.last_state_update,
+                        "trace_id": trace_id,
+                        "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+                    }, event="done")
+                except Exception as e:
+                    print(f"流式生成错误: {e}")
+                    yield sse_event({"error": str(e), "trace_id": trace_id}, event="error")
+            
+            headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            if trace_id:
+                headers["X-Trace-Id"] = trace_id
+            response = Response(
+                stream_with_context(event_stream()),
+                mimetype="text/event-stream",
+                headers=headers
+            )
+            response.call_on_close(end_generation)
+            return response
+        
+        # 生成内容
+        try:
+            with Tracer.span("POST /api/generate", traceparent=traceparent) as span:
+                content = generator.generate_chapter(**generate_kwargs)
+        finally:
+            end_generation()
+        
+        trace_id = span.trace_id if span else None
+        response = jsonify({
             "content": content,
+            "trace_id": trace_id,
             "template_used": template.get('name', template_id),
             "novel_id": novel_id,
             "word_count": len(content),
+            "prompt_tokens": generator.last_prompt_report,
+            "state_update": generator.last_state_update,
             "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
         })
+        if trace_id:
+            response.headers["X-Trace-Id"] = trace_id
+        return response
         
     except Exception as e:
         print(f"生成错误: {e}")
+        if LLMCaller.is_retryable(e):
+            # 重试后仍超时或被限流，提示客户端稍后重试
+            return jsonify({"error": str(e), "retryable": True}), 503
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/generate-candidates', methods=['POST'])
+def generate_candidates():
+    """并发生成多个候选版本，供选择后保存为章节"""
+    try:
+        data = request.json
+        
+        template_id = data.get("template_id")
+        chapter_outline = data.get("chapter_outline")
+        model_name = data.get("model_name", "deepseek_chat")
+        candidate_count = max(1, min(int(data.get("candidate_count", 2)), MAX_CANDIDATES))
+        candidates = data.get("candidates") or [{"model_name": model_name}] * candidate_count
+        novel_id = data.get("novel_id")
+        chapter_index = data.get("chapter_index")
+        stream = data.get("stream", False)
+        
+        if not template_id:
+            return jsonify({"error": "缺少模版ID"}), 400
+        
+        if not chapter_outline:
+            return jsonify({"error": "缺少章节细纲"}), 400
+        
+        if len(candidates) > MAX_CANDIDATES:
+            return jsonify({"error": f"候选数量不能超过{MAX_CANDIDATES}"}), 400
+        
+        # 候选需按章节保存才能选用，无法确定章节时不发起生成
+        chapter_index = int(chapter_index) if chapter_index else generator._extract_chapter_index(chapter_outline)
+        if chapter_index is None:
+            return jsonify({"error": "无法从细纲中识别章节编号，请指定chapter_index"}), 400
+        
+        index_data = load_template_index()
+        if template_id not in index_data['templates']:
+            return jsonify({"error": f"模版不存在: {template_id}"}), 404
+        
+        template = index_data['templates'][template_id]
+        
+        generate_kwargs = dict(
+            system_prompt=load_system_prompt(template),
+            use_state=data.get("use_state", True),
+            use_world_bible=data.get("use_world_bible", True),
+            novel_id=novel_id,
+            use_previous_chapters=data.get("use_previous_chapters", False),
+            previous_chapters_count=data.get("previous_chapters_count", 1),
+            previous_chapters_mode=data.get("previous_chapters_mode", "verbatim"),
+            summary_chapters_count=data.get("summary_chapters_count", 20),
+            use_retrieval=data.get("use_retrieval", False),
+            retrieval_max_chars=data.get("retrieval_max_chars", 3000),
+            prompt_layout=data.get("prompt_layout"),
+            chapter_index=chapter_index
+        )
+        
+        if not begin_generation():
+            return jsonify({"error": "服务正在停机，请稍后重试"}), 503
+        
+        events = generator.generate_candidates_stream(chapter_outline, candidates, **generate_kwargs)
+        
+        # 流式模式：各候选的增量交错返回
+        if stream:
+            def event_stream():
+                try:
+                    for event in events:
+                        if event.get("candidate") is None:
+                            yield sse_event({**event, "novel_id": novel_id}, event="done")
+                        elif event.get("done"):
+                            yield sse_event(event, event="candidate_done")
+                        else:
+                            yield sse_event(event)
+                except Exception as e:
+                    print(f"候选生成错误: {e}")
+                    yield sse_event({"error": str(e)}, event="error")
+            
+            response = Response(
+                stream_with_context(event_stream()),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+            response.call_on_close(end_generation)
+            return response
+        
+        try:
+            contents = {}
+            for event in events:
+                if event.get("candidate") is not None and event.get("done"):
+                    contents[event["candidate"]] = event["content"]
+                elif event.get("done"):
+                    result = event
+        finally:
+            end_generation()
+        
+        return jsonify({
+            "novel_id": novel_id,
+            "chapter_index": result["chapter_index"],
+            "candidates": [
+                {**candidate, "content": contents[i]} for i, candidate in enumerate(result["candidates"])
+            ],
+            "prompt_tokens": generator.last_prompt_report,
+            "template_used": template.get('name', template_id),
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+        
+    except Exception as e:
+        print(f"候选生成错误: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/select-candidate', methods=['POST'])
+def select_candidate():
+    """选定一个候选版本保存为章节"""
+    try:
+        data = request.json
+        novel_id = data.get("novel_id")
+        chapter_index = data.get("chapter_index")
+        candidate_index = data.get("candidate_index")
+        
+        if chapter_index is None or candidate_index is None:
+            return jsonify({"error": "缺少章节编号或候选编号"}), 400
+        
+        content = generator.select_candidate(
+            int(chapter_index),
+            int(candidate_index),
+            novel_id=novel_id,
+            use_state=data.get("use_state", True),
+            update_state=data.get("update_state", False),
+            update_model_name=data.get("update_model_name")
+        )
+        
+        return jsonify({
+            "success": True,
+            "novel_id": novel_id,
+            "chapter_index": chapter_index,
+            "candidate_index": candidate_index,
+            "word_count": len(content),
+            "state_update": generator.last_state_update
+        })
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"选定候选失败: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/novels/<novel_id>/versions/<int:chapter_index>', methods=['GET'])
+def get_chapter_versions(novel_id, chapter_index):
+    """获取章节的候选版本"""
+    versions_data = generator.load_versions(chapter_index, novel_id)
+    if not versions_data:
+        return jsonify({"error": f"第{chapter_index}章没有候选版本"}), 404
+    return jsonify(versions_data)
+
+@app.route('/api/batch', methods=['POST'])
+def start_batch():
+    """启动整本批量生成，已有检查点时跳过已完成的章节"""
+    try:
+        data = request.json
+        novel_id = data.get("novel_id")
+        template_id = data.get("template_id")
+        start_chapter = int(data.get("start_chapter", 1))
+        end_chapter = data.get("end_chapter")
+        
+        if not novel_id or not end_chapter:
+            return jsonify({"error": "缺少小说ID或结束章节"}), 400
+        
+        if _generation_state["draining"]:
+            return jsonify({"error": "服务正在停机，请稍后重试"}), 503
+        
+        system_prompt = ""
+        if template_id:
+            index_data = load_template_index()
+            if template_id not in index_data['templates']:
+                return jsonify({"error": f"模版不存在: {template_id}"}), 404
+            system_prompt = load_system_prompt(index_data['templates'][template_id])
+        
+        generate_kwargs = {
+            "model_name": data.get("model_name", "deepseek_chat"),
+            "system_prompt": system_prompt,
+            "use_state": data.get("use_state", True),
+            "use_world_bible": data.get("use_world_bible", True),
+            "update_state": data.get("update_state", False),
+            "update_model_name": data.get("update_model_name"),
+            "use_previous_chapters": data.get("use_previous_chapters", False),
+            "previous_chapters_count": data.get("previous_chapters_count", 1),
+            "previous_chapters_mode": data.get("previous_chapters_mode", "verbatim"),
+            "summary_chapters_count": data.get("summary_chapters_count", 20),
+            "use_retrieval": data.get("use_retrieval", False),
+            "retrieval_max_chars": data.get("retrieval_max_chars", 3000),
+            "prompt_layout": data.get("prompt_layout")
+        }
+        
+        with _batch_lock:
+            thread = _batch_threads.get(novel_id)
+            if thread is not None and thread.is_alive():
+                return jsonify({"error": f"小说 {novel_id} 正在批量生成"}), 409
+            driver = NovelBatchDriver(generator, novel_id, start_chapter, int(end_chapter), generate_kwargs)
+            batch_drivers[novel_id] = driver
+            thread = threading.Thread(target=run_batch_driver, args=(driver,), name=f"batch-{novel_id}", daemon=True)
+            _batch_threads[novel_id] = thread
+            thread.start()
+        
+        return jsonify(driver.get_status()), 202
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"启动批量生成失败: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/batch/<novel_id>', methods=['GET'])
+def get_batch_status(novel_id):
+    """批量生成进度与吞吐量"""
+    with _batch_lock:
+        driver = batch_drivers.get(novel_id)
+    if driver:
+        return jsonify(driver.get_status())
+    # 服务重启后只剩检查点文件
+    checkpoint_file = os.path.join("./batch_runs", f"{novel_id}_batch.json")
+    if not os.path.exists(checkpoint_file):
+        return jsonify({"error": f"小说 {novel_id} 没有批量生成任务"}), 404
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        return jsonify(json.load(f))
+
+@app.route('/api/batch/<novel_id>/stop', methods=['POST'])
+def stop_batch(novel_id):
+    """当前章节完成后停止批量生成，之后可重新启动从检查点继续"""
+    with _batch_lock:
+        driver = batch_drivers.get(novel_id)
+    if not driver:
+        return jsonify({"error": f"小说 {novel_id} 没有批量生成任务"}), 404
+    driver.stop()
+    return jsonify({"success": True, "novel_id": novel_id})
+
+@app.route('/api/scheduler', methods=['POST'])
+def submit_scheduler():
+    """向多小说调度器提交一部小说的一段章节，未指定model_name时由调度器在模型池中分配"""
+    try:
+        data = request.json
+        novel_id = data.get("novel_id")
+        template_id = data.get("template_id")
+        start_chapter = int(data.get("start_chapter", 1))
+        end_chapter = data.get("end_chapter", start_chapter)
+        
+        if not novel_id:
+            return jsonify({"error": "缺少小说ID"}), 400
+        
+        if _generation_state["draining"]:
+            return jsonify({"error": "服务正在停机，请稍后重试"}), 503
+        
+        system_prompt = ""
+        if template_id:
+            index_data = load_template_index()
+            if template_id not in index_data['templates']:
+                return jsonify({"error": f"模版不存在: {template_id}"}), 404
+            system_prompt = load_system_prompt(index_data['templates'][template_id])
+        
+        generate_kwargs = {
+            "system_prompt": system_prompt,
+            "use_state": data.get("use_state", True),
+            "use_world_bible": data.get("use_world_bible", True),
+            "update_state": data.get("update_state", False),
+            "update_model_name": data.get("update_model_name"),
+            "use_previous_chapters": data.get("use_previous_chapters", False),
+            "previous_chapters_count": data.get("previous_chapters_count", 1),
+            "previous_chapters_mode": data.get("previous_chapters_mode", "verbatim"),
+            "summary_chapters_count": data.get("summary_chapters_count", 20),
+            "use_retrieval": data.get("use_retrieval", False),
+            "retrieval_max_chars": data.get("retrieval_max_chars", 3000),
+            "prompt_layout": data.get("prompt_layout")
+        }
+        if data.get("model_name"):
+            generate_kwargs["model_name"] = data["model_name"]
+        
+        tasks = scheduler.submit_range(
+            novel_id, start_chapter, int(end_chapter),
+            skip_existing=data.get("skip_existing", True),
+            **generate_kwargs
+        )
+        return jsonify({"novel_id": novel_id, "submitted": len(tasks), "tasks": tasks}), 202
+        
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"提交调度任务失败: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_status():
+    """调度器状态：各小说排队/进行中章节、模型与服务商负载、最近任务"""
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify(scheduler.get_status(request.args.get("novel_id"), limit))
+
+@app.route('/api/scheduler/tasks/<task_id>', methods=['GET'])
+def get_scheduler_task(task_id):
+    task = scheduler.get_task(task_id)
+    if not task:
+        return jsonify({"error": f"任务不存在: {task_id}"}), 404
+    return jsonify(task)
+
+@app.route('/api/scheduler/<novel_id>/cancel', methods=['POST'])
+def cancel_scheduler_novel(novel_id):
+    """取消小说排队中的章节，进行中的章节继续完成"""
+    return jsonify({"novel_id": novel_id, "cancelled": scheduler.cancel_novel(novel_id)})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询生成任务的状态与结果"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": f"任务不存在: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """最近的生成任务与队列指标"""
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify({
+        "metrics": job_queue.get_metrics(),
+        "jobs": job_queue.list_jobs(limit)
+    })
+
+@app.route('/api/state-updates', methods=['GET'])
+def get_state_updates():
+    """后台状态更新的排队情况与最近任务，可按novel_id过滤"""
+    novel_id = request.args.get("novel_id")
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify(generator.state_updates.get_status(novel_id, limit))
 
+@app.route('/api/state-updates/<task_id>', methods=['GET'])
+def get_state_update(task_id):
+    """查询单个状态更新任务"""
+    task = generator.state_updates.get_task(task_id)
+    if not task:
+        return jsonify({"error": f"任务不存在: {task_id}"}), 404
+    return jsonify(task)
+
+@app.route('/api/llm-cache', methods=['GET'])
+def get_llm_cache_stats():
+    """LLM响应缓存的命中统计，以及各模型服务商侧提示词缓存命中的输入token"""
+    stats = LLMResponseCache.default().get_stats()
+    stats["provider_prompt_cache"] = LLMUsageStats.get_stats()
+    return jsonify(stats)
+
+@app.route('/api/llm-cache', methods=['DELETE'])
+def clear_llm_cache():
+    """清空LLM响应缓存"""
+    LLMResponseCache.default().clear()
+    return jsonify({"success": True})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_llm_metrics():
+    """LLM调用用量汇总：按小说、模型、用途的调用次数、token、费用（美元）与平均延迟/首字延迟"""
+    novel_id = request.args.get("novel_id")
+    if novel_id:
+        return jsonify({"novel_id": novel_id, **LLMCallLog.default().get_summary(novel_id)})
+    return jsonify(LLMCallLog.default().get_summary())
+
+@app.route('/api/llm-health', methods=['GET'])
+def get_llm_health():
+    """各模型按调用用途的滚动延迟、错误率与熔断状态，以及该用途当前的调用链顺序"""
+    purpose = request.args.get("purpose", "chapter")
+    models = ModelRouter.get_stats()
+    routes = {name: ModelRouter.route(name, purpose) for name in LLMConfigManager.FALLBACK_CHAINS}
+    return jsonify({"models": models, "purpose": purpose, "routes": routes})
 
 @app.route('/api/novels', methods=['GET'])
 def get_novels():
@@ -294,7 +898,7 @@ def save_result():
         else:
             filename = f"novel_{timestamp}.txt"
         
-        file_path = os.path.join(XIAOSHUO_DIR, filename)
+        file_path = generator.layout.write_path(XIAOSHUO_DIR, novel_id, filename)
         
         # 保存文件
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -315,9 +919,6 @@ def save_result():
 def get_novel_info(novel_id):
     """获取指定小说的完整信息"""
     try:
-        import glob
-        import re
-        
         # 1. 获取状态信息
         state = generator.state_manager.load_latest_state(novel_id)
         state_info = {
@@ -329,16 +930,7 @@ def get_novel_info(novel_id):
         }
         
         # 2. 检查章节文件
-        chapter_files = glob.glob(os.path.join(XIAOSHUO_DIR, f"{novel_id}_chapter_*.txt"))
-        chapter_numbers = []
-        for file_path in chapter_files:
-            filename = os.path.basename(file_path)
-            # 提取章节编号: novel_id_chapter_XXX.txt
-            match = re.search(r'_chapter_(\d+)\.txt$', filename)
-            if match:
-                chapter_numbers.append(int(match.group(1)))
-        
-        chapter_numbers.sort()
+        chapter_numbers = generator.list_chapter_numbers(novel_id)
         chapter_info = {
             "total_chapters": len(chapter_numbers),
             "chapter_list": chapter_numbers,
@@ -368,12 +960,18 @@ def get_novel_info(novel_id):
         }
         
         # 5. 检查版本文件
-        version_files = glob.glob(os.path.join("./versions", f"{novel_id}_chapter_*_versions.json"))
+        version_files = [
+            file_path for file_path in generator.layout.list_novel_files("./versions", novel_id)
+            if file_path.endswith("_versions.json")
+        ]
         version_info = {
             "has_versions": len(version_files) > 0,
             "version_chapters": len(version_files)
         }
         
+        # 6. LLM调用用量与费用
+        usage_info = LLMCallLog.default().get_summary(novel_id)
+        
         return jsonify({
             "novel_id": novel_id,
             "state": state_info,
@@ -381,6 +979,7 @@ def get_novel_info(novel_id):
             "memory": memory_info,
             "world": world_info,
             "versions": version_info,
+            "llm_usage": usage_info,
             "summary": {
                 "state_chapter": state_info["latest_chapter"],
                 "file_chapter": chapter_info["latest_chapter_file"],
@@ -403,8 +1002,7 @@ def read_outline():
             return jsonify({"error": "缺少必需参数"}), 400
         
         # 构建细纲文件路径
-        outline_dir = os.path.join("xiaoshuo", "zhangjiexigang", str(novel_id))
-        outline_file = os.path.join(outline_dir, f"{chapter_index}.txt")
+        outline_file = generator.outline_file_path(chapter_index, novel_id)
         
         # 检查文件是否存在
         if not os.path.exists(outline_file):
@@ -443,6 +1041,7 @@ def save_chapter():
         novel_id = data.get('novel_id', '')
         chapter_index = data.get('chapter_index', 1)
         auto_save = data.get('auto_save', False)
+        model_name = data.get('model_name') or generator.summary_model_name
         
         if not content:
             return jsonify({"error": "章节内容不能为空"}), 400
@@ -451,17 +1050,19 @@ def save_chapter():
         os.makedirs("./xiaoshuo", exist_ok=True)
         
         # 生成文件名
-        if novel_id:
-            filename = f"{novel_id}_chapter_{chapter_index:03d}.txt"
-        else:
-            filename = f"chapter_{chapter_index:03d}.txt"
-        
-        file_path = f"./xiaoshuo/{filename}"
+        filename = generator.chapter_filename(chapter_index, novel_id or None)
+        file_path = generator.chapter_file_path(chapter_index, novel_id or None, for_write=True)
         
         # 保存文件
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(content)
         
+        generator.retrieval_index.update_chapter(chapter_index, novel_id or None)
+        
+        # 章节内容变化后在后台重新生成摘要（未指定模型时留给分层前文模式按需生成）
+        if generator.auto_summarize and model_name:
+            generator.chapter_summaries.schedule(chapter_index, novel_id or None, model_name, content=content)
+        
         return jsonify({
             "success": True,
             "filename": filename,
@@ -483,6 +1084,7 @@ def update_state():
         chapter_index = data.get('chapter_index')
         model_name = data.get('model_name')
         force_update = data.get('force_update', False)
+        use_cache = data.get('use_cache')
         
         if not novel_id:
             return jsonify({"error": "缺少小说ID"}), 400
@@ -491,8 +1093,8 @@ def update_state():
             return jsonify({"error": "缺少章节编号"}), 400
         
         # 读取章节内容
-        chapter_filename = f"{novel_id}_chapter_{chapter_index:03d}.txt"
-        chapter_path = os.path.join("./xiaoshuo", chapter_filename)
+        chapter_filename = generator.chapter_filename(chapter_index, novel_id)
+        chapter_path = generator.chapter_file_path(chapter_index, novel_id)
         
         if not os.path.exists(chapter_path):
             return jsonify({"error": f"章节文件不存在: {chapter_filename}"}), 404
@@ -500,7 +1102,8 @@ def update_state():
         with open(chapter_path, 'r', encoding='utf-8') as f:
             chapter_content = f.read()
         
-        # 加载当前状态
+        # 加载当前状态（先等待该小说进行中的后台状态更新）
+        generator.state_updates.wait_for_novel(novel_id)
         current_state = generator.state_manager.load_latest_state(novel_id)
         if not current_state:
             return jsonify({"error": "找不到当前角色状态"}), 404
@@ -510,7 +1113,8 @@ def update_state():
             chapter_content=chapter_content,
             current_state=current_state,
             model_name=model_name or generator.model_name,
-            novel_id=novel_id
+            novel_id=novel_id,
+            use_cache=use_cache
         )
         
         return jsonify({
@@ -524,6 +1128,8 @@ def update_state():
         
     except Exception as e:
         print(f"手动更新状态失败: {e}")
+        if LLMCaller.is_retryable(e):
+            return jsonify({"error": f"状态更新失败: {str(e)}", "retryable": True}), 503
         return jsonify({"error": f"状态更新失败: {str(e)}"}), 500
 
 # ===== 设定管理API =====
@@ -531,42 +1137,15 @@ def update_state():
 def get_settings_list(novel_id):
     """获取指定小说的设定文件列表"""
     try:
-        import os
-        import re
-        
-        data_path = "./data"
-        if not os.path.exists(data_path):
-            return jsonify({
-                "character_versions": [],
-                "world_versions": []
-            })
-        
-        character_versions = []
-        world_versions = []
-        
-        # 扫描data目录中的文件
-        for filename in os.listdir(data_path):
-            # 匹配人物设定文件: {novel_id}_chapter_{version}_state.json
-            character_match = re.match(rf'{re.escape(novel_id)}_chapter_(\d+)_state\.json', filename)
-            if character_match:
-                version = int(character_match.group(1))
-                character_versions.append({
-                    "version": version,
-                    "filename": filename
-                })
-            
-            # 匹配世界设定文件: {novel_id}_world_bible_{version}.json
-            world_match = re.match(rf'{re.escape(novel_id)}_world_bible_(\d+)\.json', filename)
-            if world_match:
-                version = int(world_match.group(1))
-                world_versions.append({
-                    "version": version,
-                    "filename": filename
-                })
-        
-        # 按版本号排序
-        character_versions.sort(key=lambda x: x['version'])
-        world_versions.sort(key=lambda x: x['version'])
+        state_manager = generator.state_manager
+        character_versions = [
+            {"version": version, "filename": os.path.basename(file_path)}
+            for version, file_path in state_manager.list_versioned_files("states", novel_id)
+        ]
+        world_versions = [
+            {"version": version, "filename": os.path.basename(file_path)}
+            for version, file_path in state_manager.list_versioned_files("world", novel_id)
+        ]
         
         return jsonify({
             "character_versions": character_versions,
@@ -581,12 +1160,9 @@ def get_settings_list(novel_id):
 def get_character_settings(novel_id, version):
     """获取指定版本的人物设定"""
     try:
-        import os
-        import json
-        
         # 构建文件路径
         filename = f"{novel_id}_chapter_{version}_state.json"
-        file_path = os.path.join("./data", filename)
+        file_path = generator.layout.read_path("./data", novel_id, filename)
         
         if not os.path.exists(file_path):
             return jsonify({"error": "人物设定文件不存在"}), 404
@@ -608,12 +1184,9 @@ def get_character_settings(novel_id, version):
 def get_world_settings(novel_id, version):
     """获取指定版本的世界设定"""
     try:
-        import os
-        import json
-        
         # 构建文件路径
         filename = f"{novel_id}_world_bible_{version}.json"
-        file_path = os.path.join("./data", filename)
+        file_path = generator.layout.read_path("./data", novel_id, filename)
         
         if not os.path.exists(file_path):
             return jsonify({"error": "世界设定文件不存在"}), 404
@@ -635,9 +1208,6 @@ def get_world_settings(novel_id, version):
 def save_character_settings(novel_id, version):
     """保存人物设定"""
     try:
-        import os
-        import json
-        
         data = request.get_json()
         content = data.get('content')
         
@@ -649,7 +1219,7 @@ def save_character_settings(novel_id, version):
         
         # 构建文件路径
         filename = f"{novel_id}_chapter_{version}_state.json"
-        file_path = os.path.join("./data", filename)
+        file_path = generator.layout.resolve_path("./data", novel_id, filename)
         
         # 保存文件
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -669,9 +1239,6 @@ def save_character_settings(novel_id, version):
 def save_world_settings(novel_id, version):
     """保存世界设定"""
     try:
-        import os
-        import json
-        
         data = request.get_json()
         content = data.get('content')
         
@@ -683,7 +1250,7 @@ def save_world_settings(novel_id, version):
         
         # 构建文件路径
         filename = f"{novel_id}_world_bible_{version}.json"
-        file_path = os.path.join("./data", filename)
+        file_path = generator.layout.resolve_path("./data", novel_id, filename)
         
         # 保存文件
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -703,26 +1270,16 @@ def save_world_settings(novel_id, version):
 def create_new_character_version(novel_id):
     """创建新的人物设定版本"""
     try:
-        import os
-        import json
-        import re
-        
         data = request.get_json()
         content = data.get('content')
         
         if not content:
             return jsonify({"error": "设定内容不能为空"}), 400
         
-        # 扫描现有版本，找到最大版本号
+        # 现有版本中的最大版本号
         data_path = "./data"
-        max_version = -1
-        
-        if os.path.exists(data_path):
-            for filename in os.listdir(data_path):
-                match = re.match(rf'{re.escape(novel_id)}_chapter_(\d+)_state\.json', filename)
-                if match:
-                    version = int(match.group(1))
-                    max_version = max(max_version, version)
+        versions = generator.state_manager.get_file_numbers("states", novel_id)
+        max_version = versions[-1] if versions else -1
         
         # 新版本号
         new_version = max_version + 1
@@ -733,7 +1290,7 @@ def create_new_character_version(novel_id):
         
         # 构建新文件路径
         filename = f"{novel_id}_chapter_{new_version_str}_state.json"
-        file_path = os.path.join(data_path, filename)
+        file_path = generator.layout.write_path(data_path, novel_id, filename)
         
         # 保存新版本
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -753,26 +1310,16 @@ def create_new_character_version(novel_id):
 def create_new_world_version(novel_id):
     """创建新的世界设定版本"""
     try:
-        import os
-        import json
-        import re
-        
         data = request.get_json()
         content = data.get('content')
         
         if not content:
             return jsonify({"error": "设定内容不能为空"}), 400
         
-        # 扫描现有版本，找到最大版本号
+        # 现有版本中的最大版本号
         data_path = "./data"
-        max_version = -1
-        
-        if os.path.exists(data_path):
-            for filename in os.listdir(data_path):
-                match = re.match(rf'{re.escape(novel_id)}_world_bible_(\d+)\.json', filename)
-                if match:
-                    version = int(match.group(1))
-                    max_version = max(max_version, version)
+        versions = generator.state_manager.get_file_numbers("world", novel_id)
+        max_version = versions[-1] if versions else -1
         
         # 新版本号
         new_version = max_version + 1
@@ -783,7 +1330,7 @@ def create_new_world_version(novel_id):
         
         # 构建新文件路径
         filename = f"{novel_id}_world_bible_{new_version_str}.json"
-        file_path = os.path.join(data_path, filename)
+        file_path = generator.layout.write_path(data_path, novel_id, filename)
         
         # 保存新版本
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -817,9 +1364,14 @@ if __name__ == '__main__':
     print("🚀 服务器地址: http://localhost:5000")
     print("=" * 50)
     
+    debug = os.getenv("FLASK_DEBUG") == "1"
+    # 调试模式的重载器在子进程中运行服务，父进程不启动后台任务
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background()
+    
     app.run(
         host='0.0.0.0',
         port=5000,
-        debug=True,
+        debug=debug,
         threaded=True
     ) 
\ No newline at end of file